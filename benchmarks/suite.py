@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Optional
+
+import redis
+
+from redorm import RedormBase, bind_database, measure, many_to_one, one_to_many
+
+__all__ = ["BenchResult", "run", "compare", "main"]
+
+DEFAULT_SIZES = (10, 1000, 100000)
+# Members in the dataset the single row benchmarks run against, spread over TEAMS teams
+DATASET_SIZE = 1000
+TEAMS = 10
+# The benchmark models are kept in a database of their own, so runs never touch what red is bound to
+DATABASE = "bench"
+
+
+@dataclass
+class BenchTeam(RedormBase):
+    name: str = field(metadata={"unique": True})
+    members = one_to_many("BenchMember", backref="team")
+
+    class Meta:
+        database = DATABASE
+
+
+@dataclass
+class BenchMember(RedormBase):
+    email: str = field(metadata={"unique": True})
+    group: int = field(metadata={"index": True})
+    score: float = field(metadata={"range_index": True})
+    team = many_to_one(BenchTeam, backref="members")
+
+    class Meta:
+        database = DATABASE
+
+
+@dataclass
+class BenchResult:
+    name: str
+    ops: int
+    ops_per_sec: float
+    p50_ms: float
+    p99_ms: float
+    round_trips: float
+    # Peak resident memory of the process once the benchmark finished
+    peak_rss_mb: float
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def bench(name: str, ops: int, op: Callable[[int], object]) -> BenchResult:
+    latencies = []
+    with measure() as stats:
+        for i in range(ops):
+            start = perf_counter()
+            op(i)
+            latencies.append(perf_counter() - start)
+    latencies.sort()
+    return BenchResult(
+        name=name,
+        ops=ops,
+        ops_per_sec=ops / sum(latencies),
+        p50_ms=percentile(latencies, 0.5) * 1000,
+        p99_ms=percentile(latencies, 0.99) * 1000,
+        round_trips=stats.round_trips / ops,
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+def seed(count: int, start: int = 0, teams: Optional[List[BenchTeam]] = None) -> List[str]:
+    ids = []
+    for offset in range(start, start + count, 10000):
+        rows = [
+            {
+                "email": f"member{i}@example.com",
+                "group": i % 10,
+                "score": float(i),
+                "team": teams[i % len(teams)] if teams else None,
+            }
+            for i in range(offset, min(start + count, offset + 10000))
+        ]
+        ids.extend(member.id for member in BenchMember.create_bulk(rows))
+    return ids
+
+
+def progress(line: str) -> None:
+    print(line, file=sys.stderr)
+
+
+def run(
+    ops: int = 1000, sizes=DEFAULT_SIZES, log: Callable[[str], None] = progress, url: str = ""
+) -> List[BenchResult]:
+    # Runs every benchmark against url, a redis-server started for the run or without one a fake redis of its own.
+    # Nothing is flushed, a server that already holds data is refused.
+    client = bind_database(DATABASE, url).client()
+    if client.client.dbsize():
+        raise RuntimeError(f"{url} already holds data, benchmarks only run against a server of their own")
+    # Loaded up front, so the first create isn't measured loading them
+    client.load_scripts()
+    teams = BenchTeam.create_bulk([{"name": f"team{i}"} for i in range(TEAMS)])
+    ids = seed(DATASET_SIZE, teams=teams)
+    results = []
+
+    def record(result: BenchResult) -> None:
+        log(f"{result.name:<20} {result.ops_per_sec:>10.0f} ops/s  p99 {result.p99_ms:.2f}ms")
+        results.append(result)
+
+    created: List[str] = []
+    record(
+        bench(
+            "create",
+            ops,
+            lambda i: created.append(BenchMember.create(email=f"new{i}@example.com", group=i % 10, score=i).id),
+        )
+    )
+    record(bench("get_by_id", ops, lambda i: BenchMember.get(ids[i % len(ids)])))
+    record(bench("get_by_unique", ops, lambda i: BenchMember.get(email=f"member{i % DATASET_SIZE}@example.com")))
+    record(bench("list_filtered", ops, lambda i: BenchMember.list(group=i % 10, score__gte=DATASET_SIZE / 2)))
+    record(bench("relationship_read", ops, lambda i: BenchTeam.get(teams[i % TEAMS].id).members))
+    members = BenchMember.get_bulk(set(ids[:ops]))
+    record(bench("relationship_write", ops, lambda i: setattr(members[i % len(members)], "team", teams[i % TEAMS])))
+    record(bench("update", ops, lambda i: members[i % len(members)].update(score=float(i))))
+    record(bench("delete", len(created), lambda i: BenchMember.get(created[i]).delete()))
+    for size in sorted(sizes):
+        if size > len(ids):
+            log(f"Seeding {size - len(ids)} more members")
+            ids.extend(seed(size - len(ids), start=len(ids)))
+        batch = set(ids[:size])
+        # Fewer repetitions for bigger batches, so every size takes a similar time
+        repeat = max(5, min(ops, ops * 10 // size))
+        record(bench(f"get_bulk_{size}", repeat, lambda i: BenchMember.get_bulk(batch)))
+    return results
+
+
+def compare(baseline: Dict[str, dict], results: List[BenchResult], tolerance: float) -> List[str]:
+    # Slower than the baseline by more than tolerance, or more round trips than it, is a regression
+    regressions = []
+    for result in results:
+        before = baseline.get(result.name)
+        if before is None:
+            continue
+        if result.ops_per_sec < before["ops_per_sec"] * (1 - tolerance):
+            regressions.append(f"{result.name}: {result.ops_per_sec:.0f} ops/s, was {before['ops_per_sec']:.0f}")
+        if result.p99_ms > before["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{result.name}: p99 {result.p99_ms:.2f}ms, was {before['p99_ms']:.2f}ms")
+        if result.round_trips > before["round_trips"]:
+            regressions.append(f"{result.name}: {result.round_trips:g} round trips, was {before['round_trips']:g}")
+    return regressions
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def redis_server(executable: str) -> Iterator[str]:
+    # A throwaway redis-server without persistence, so disk writes don't add noise
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        process = subprocess.Popen(
+            [executable, "--port", str(port), "--save", "", "--appendonly", "no", "--dir", directory],
+            stdout=subprocess.DEVNULL,
+        )
+        url = f"redis://127.0.0.1:{port}"
+        try:
+            client = redis.Redis.from_url(url)
+            for _ in range(100):
+                try:
+                    client.ping()
+                    break
+                except redis.ConnectionError:
+                    time.sleep(0.05)
+            else:
+                raise RuntimeError(f"redis-server didn't start on port {port}")
+            yield url
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def format_table(results: List[BenchResult], baseline: Dict[str, dict]) -> str:
+    lines = [
+        f"{'benchmark':<20} {'ops/s':>10} {'vs base':>8} {'p50 ms':>8} {'p99 ms':>8} {'trips/op':>9} {'rss MB':>8}"
+    ]
+    for result in results:
+        before = baseline.get(result.name)
+        change = f"{result.ops_per_sec / before['ops_per_sec'] - 1:+.0%}" if before else "-"
+        lines.append(
+            f"{result.name:<20} {result.ops_per_sec:>10.0f} {change:>8} {result.p50_ms:>8.3f} {result.p99_ms:>8.3f} "
+            f"{result.round_trips:>9.2f} {result.peak_rss_mb:>8.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmarks redorm's core operations")
+    parser.add_argument("--fake", action="store_true", help="use the in-process fake redis instead of redis-server")
+    parser.add_argument("--redis-server", default="redis-server", help="redis-server executable to spawn")
+    parser.add_argument("--ops", type=int, default=1000, help="operations per benchmark")
+    parser.add_argument(
+        "--sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=list(DEFAULT_SIZES),
+        help="comma separated get_bulk batch sizes",
+    )
+    parser.add_argument("--baseline", default=os.path.join(os.path.dirname(__file__), "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown allowed before failing, e.g. 0.2")
+    args = parser.parse_args(argv)
+
+    backend = "fakeredis" if args.fake else "redis-server"
+    baseline: Dict[str, dict] = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored["backend"] == backend:
+            baseline = stored["results"]
+        else:
+            print(f"Ignoring the {stored['backend']} baseline in {args.baseline}", file=sys.stderr)
+
+    if args.fake:
+        results = run(args.ops, args.sizes)
+    else:
+        executable = shutil.which(args.redis_server)
+        if executable is None:
+            parser.error(f"{args.redis_server} not found, install Redis or pass --fake")
+        with redis_server(executable) as url:
+            results = run(args.ops, args.sizes, url=url)
+
+    print(format_table(results, baseline))
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(
+                {
+                    "backend": backend,
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "results": {result.name: asdict(result) for result in results},
+                },
+                f,
+                indent=2,
+            )
+        print(f"Saved the baseline to {args.baseline}")
+        return 0
+    regressions = compare(baseline, results, args.tolerance)
+    for regression in regressions:
+        print(f"Regression: {regression}", file=sys.stderr)
+    return 1 if regressions else 0
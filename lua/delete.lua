@@ -0,0 +1,260 @@
+-- Deletes a model instance with its unique, index, range and prefix index entries and its relationship keys.
+-- Returns {0} if it does not exist, otherwise 1 followed by the related ids of each relationship.
+--
+
+-- Mirrors redorm.plan.index_value so old values decoded here match the keys written by the client
+local function idxval(v)
+    local t = type(v)
+    if t == 'string' then
+        return v
+    elseif t == 'boolean' then
+        if v then return 'True' else return 'False' end
+    elseif t == 'number' then
+        return string.format('%.17g', v)
+    end
+    return nil
+end
+
+-- Decodes JSON with integers of 16 characters or more quoted, so they come back as exact strings
+local function jsondecode(text)
+    if not string.find(text, '%d%d%d%d%d%d%d%d%d%d%d%d%d%d%d') then
+        return cjson.decode(text)
+    end
+    local parts = {}
+    local copied = 1
+    local pos = 1
+    while true do
+        local start = string.find(text, '[%-%d"]', pos)
+        if not start then
+            break
+        elseif string.sub(text, start, start) == '"' then
+            -- Strings are skipped, stepping over escaped characters
+            local stop = string.find(text, '["\\]', start + 1)
+            while string.sub(text, stop, stop) ~= '"' do
+                stop = string.find(text, '["\\]', stop + 2)
+            end
+            pos = stop + 1
+        else
+            local _, stop = string.find(text, '^%-?%d+', start)
+            local after = string.sub(text, stop + 1, stop + 1)
+            if stop - start >= 15 and after ~= '.' and after ~= 'e' and after ~= 'E' then
+                table.insert(parts, string.sub(text, copied, start - 1))
+                table.insert(parts, '"' .. string.sub(text, start, stop) .. '"')
+                copied = stop + 1
+            end
+            pos = string.find(text, '[^%-%d%.eE+]', start) or #text + 1
+        end
+    end
+    table.insert(parts, string.sub(text, copied))
+    return cjson.decode(table.concat(parts))
+end
+
+-- Decodes msgpack, with the 64 bit integers at the top level of the document read again from its bytes as decimal
+-- strings
+local function msgpackdecode(data)
+    local doc = cmsgpack.unpack(data)
+    local pos = 1
+    local sizes = {1, 2, 4, 8, 16}
+    local function uint(n)
+        local v = 0
+        for k=pos,pos+n-1 do
+            v = v * 256 + string.byte(data, k)
+        end
+        pos = pos + n
+        return v
+    end
+    local function decimal(signed)
+        local bytes = {string.byte(data, pos, pos + 7)}
+        pos = pos + 8
+        local negative = signed and bytes[1] >= 0x80
+        if negative then
+            local carry = 1
+            for k=8,1,-1 do
+                local v = 255 - bytes[k] + carry
+                bytes[k] = v % 256
+                carry = math.floor(v / 256)
+            end
+        end
+        local digits = ''
+        repeat
+            local rest = 0
+            local more = false
+            for k=1,8 do
+                local v = rest * 256 + bytes[k]
+                bytes[k] = math.floor(v / 10)
+                rest = v % 10
+                more = more or bytes[k] > 0
+            end
+            digits = string.format('%d', rest) .. digits
+        until not more
+        if negative then
+            return '-' .. digits
+        end
+        return digits
+    end
+    -- Moves past count values
+    local function skip(count)
+        while count > 0 do
+            count = count - 1
+            local b = uint(1)
+            if b >= 0x80 and b <= 0x8f then
+                count = count + (b - 0x80) * 2
+            elseif b >= 0x90 and b <= 0x9f then
+                count = count + b - 0x90
+            elseif b >= 0xa0 and b <= 0xbf then
+                pos = pos + b - 0xa0
+            elseif b >= 0xc4 and b <= 0xc6 then
+                local len = uint(sizes[b - 0xc3])
+                pos = pos + len
+            elseif b >= 0xc7 and b <= 0xc9 then
+                local len = uint(sizes[b - 0xc6])
+                pos = pos + len + 1
+            elseif b == 0xca or b == 0xcb then
+                pos = pos + sizes[b - 0xc7]
+            elseif b >= 0xcc and b <= 0xd3 then
+                pos = pos + sizes[(b - 0xcc) % 4 + 1]
+            elseif b >= 0xd4 and b <= 0xd8 then
+                pos = pos + sizes[b - 0xd3] + 1
+            elseif b >= 0xd9 and b <= 0xdb then
+                local len = uint(sizes[b - 0xd8])
+                pos = pos + len
+            elseif b == 0xdc or b == 0xdd then
+                count = count + uint(sizes[b - 0xda])
+            elseif b == 0xde or b == 0xdf then
+                count = count + uint(sizes[b - 0xdc]) * 2
+            end
+        end
+    end
+
+    local b = uint(1)
+    local count = 0
+    if b >= 0x80 and b <= 0x8f then
+        count = b - 0x80
+    elseif b == 0xde or b == 0xdf then
+        count = uint(sizes[b - 0xdc])
+    end
+    for _=1,count do
+        local k = uint(1)
+        local len
+        if k >= 0xa0 and k <= 0xbf then
+            len = k - 0xa0
+        elseif k >= 0xd9 and k <= 0xdb then
+            len = uint(sizes[k - 0xd8])
+        else
+            return doc
+        end
+        local name = string.sub(data, pos, pos + len - 1)
+        pos = pos + len
+        local v = string.byte(data, pos)
+        if v == 0xcf or v == 0xd3 then
+            pos = pos + 1
+            doc[name] = decimal(v == 0xd3)
+        else
+            skip(1)
+        end
+    end
+    return doc
+end
+
+local uuid = ARGV[1]
+local prefix = ARGV[2]
+local storage = ARGV[3]
+local uniquecnt = tonumber(ARGV[4])
+local indexcnt = tonumber(ARGV[5])
+local rangecnt = tonumber(ARGV[6])
+local lexcnt = tonumber(ARGV[7])
+local memberkey = KEYS[1]
+
+-- Unique, index and range field names follow the counts, then '1' if case folded and the name of each prefix index
+local beginunique = 8
+local beginindex = beginunique + uniquecnt
+local beginrange = beginindex + indexcnt
+local beginlex = beginrange + rangecnt
+local beginrels = beginlex + (lexcnt * 2)
+local relcnt = tonumber(ARGV[beginrels])
+
+-- Sweeps pass the time they started, instances are only deleted if they had expired by then
+local due = ARGV[beginrels + (relcnt * 4) + 1]
+if due then
+    local expireat = redis.call('zscore', prefix .. ':expiry', uuid)
+    if not expireat or tonumber(expireat) > tonumber(due) then
+        return {0}
+    end
+end
+redis.call('zrem', prefix .. ':expiry', uuid)
+
+local doc = {}
+if storage == 'json' then
+    local raw = redis.call('get', memberkey)
+    if not raw then
+        return {0}
+    elseif string.sub(raw, 1, 1) == '{' then
+        doc = jsondecode(raw)
+    else
+        doc = msgpackdecode(raw)
+    end
+else
+    local raw = redis.call('hgetall', memberkey)
+    if #raw == 0 then
+        return {0}
+    end
+    for i=1,#raw,2 do
+        doc[raw[i]] = jsondecode(raw[i+1])
+    end
+end
+
+for i=beginunique,beginindex-1 do
+    local value = idxval(doc[ARGV[i]])
+    if not value then
+        redis.call('srem', prefix .. ':keynull:' .. ARGV[i], uuid)
+    elseif redis.call('hget', prefix .. ':key:' .. ARGV[i], value) == uuid then
+        redis.call('hdel', prefix .. ':key:' .. ARGV[i], value)
+    end
+end
+for i=beginindex,beginrange-1 do
+    local value = idxval(doc[ARGV[i]])
+    if value then
+        redis.call('srem', prefix .. ':index:' .. ARGV[i] .. ':' .. value, uuid)
+    else
+        redis.call('srem', prefix .. ':indexnull:' .. ARGV[i], uuid)
+    end
+end
+for i=beginrange,beginlex-1 do
+    redis.call('zrem', prefix .. ':range:' .. ARGV[i], uuid)
+end
+for i=beginlex,beginrels-1,2 do
+    local value = idxval(doc[ARGV[i+1]])
+    if value then
+        if ARGV[i] == '1' then value = string.lower(value) end
+        redis.call('zrem', prefix .. ':lex:' .. ARGV[i+1], value .. '\0' .. uuid)
+    end
+end
+
+-- Each relationship is the key prefix of its entries, '1' if it's a set, the key prefix of the other end's entries if
+-- they're on this node otherwise '', and '1' if those are sets. The related ids are returned so the caller can clean up the other
+-- end when it's elsewhere.
+local removed = {1}
+for i=beginrels+1,beginrels+(relcnt*4),4 do
+    local key = ARGV[i] .. uuid
+    local related = {}
+    if ARGV[i+1] == '1' then
+        related = redis.call('smembers', key)
+    else
+        local ref = redis.call('get', key)
+        if ref then related = {ref} end
+    end
+    if ARGV[i+2] ~= '' then
+        for _,id in ipairs(related) do
+            if ARGV[i+3] == '1' then
+                redis.call('srem', ARGV[i+2] .. id, uuid)
+            elseif redis.call('get', ARGV[i+2] .. id) == uuid then
+                redis.call('del', ARGV[i+2] .. id)
+            end
+        end
+    end
+    redis.call('del', key)
+    table.insert(removed, related)
+end
+redis.call('del', memberkey)
+redis.call('srem', KEYS[2], uuid)
+return removed
@@ -0,0 +1,18 @@
+-- Sets the unix time an instance expires at, or clears it. Returns 0 if the instance doesn't exist.
+--
+
+local uuid = ARGV[1]
+local prefix = ARGV[2]
+-- Unix time the instance expires at, '' to keep it until it's deleted
+local expireat = ARGV[3]
+local memberkey = KEYS[1]
+
+if redis.call('exists', memberkey) == 0 then
+    return 0
+end
+if expireat == '' then
+    redis.call('zrem', prefix .. ':expiry', uuid)
+else
+    redis.call('zadd', prefix .. ':expiry', expireat, uuid)
+end
+return 1
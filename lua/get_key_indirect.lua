@@ -6,4 +6,11 @@
 -- To change this template use File | Settings | File Templates.
 --
 
-return {redis.call('get', redis.call('get', KEYS[1]))}
+local ref = redis.call('get', KEYS[2])
+if not ref then
+    return {}
+end
+if ARGV[1] == 'hash' then
+    return {redis.call('hgetall', KEYS[1] .. ref)}
+end
+return {redis.call('get', KEYS[1] .. ref)}
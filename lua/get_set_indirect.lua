@@ -8,6 +8,10 @@
 local l = {}
 local keys = redis.call('smembers', KEYS[2])
 for _,k in ipairs(keys) do
-    table.insert(l, redis.call('get', KEYS[1] .. k))
+    if ARGV[1] == 'hash' then
+        table.insert(l, redis.call('hgetall', KEYS[1] .. k))
+    else
+        table.insert(l, redis.call('get', KEYS[1] .. k))
+    end
 end
 return l
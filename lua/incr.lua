@@ -0,0 +1,251 @@
+-- Adds to a numeric field of a hash stored instance, keeping its unique, index and range entries in step.
+-- Returns the new value as stored and the new version, 0 for unversioned models.
+--
+
+-- Mirrors redorm.plan.index_value so old values decoded here match the keys written by the client
+local function idxval(v)
+    local t = type(v)
+    if t == 'string' then
+        return v
+    elseif t == 'boolean' then
+        if v then return 'True' else return 'False' end
+    elseif t == 'number' then
+        return string.format('%.17g', v)
+    end
+    return nil
+end
+
+-- Decodes JSON with integers of 16 characters or more quoted, so they come back as exact strings
+local function jsondecode(text)
+    if not string.find(text, '%d%d%d%d%d%d%d%d%d%d%d%d%d%d%d') then
+        return cjson.decode(text)
+    end
+    local parts = {}
+    local copied = 1
+    local pos = 1
+    while true do
+        local start = string.find(text, '[%-%d"]', pos)
+        if not start then
+            break
+        elseif string.sub(text, start, start) == '"' then
+            -- Strings are skipped, stepping over escaped characters
+            local stop = string.find(text, '["\\]', start + 1)
+            while string.sub(text, stop, stop) ~= '"' do
+                stop = string.find(text, '["\\]', stop + 2)
+            end
+            pos = stop + 1
+        else
+            local _, stop = string.find(text, '^%-?%d+', start)
+            local after = string.sub(text, stop + 1, stop + 1)
+            if stop - start >= 15 and after ~= '.' and after ~= 'e' and after ~= 'E' then
+                table.insert(parts, string.sub(text, copied, start - 1))
+                table.insert(parts, '"' .. string.sub(text, start, stop) .. '"')
+                copied = stop + 1
+            end
+            pos = string.find(text, '[^%-%d%.eE+]', start) or #text + 1
+        end
+    end
+    table.insert(parts, string.sub(text, copied))
+    return cjson.decode(table.concat(parts))
+end
+
+-- Decodes msgpack, with the 64 bit integers at the top level of the document read again from its bytes as decimal
+-- strings
+local function msgpackdecode(data)
+    local doc = cmsgpack.unpack(data)
+    local pos = 1
+    local sizes = {1, 2, 4, 8, 16}
+    local function uint(n)
+        local v = 0
+        for k=pos,pos+n-1 do
+            v = v * 256 + string.byte(data, k)
+        end
+        pos = pos + n
+        return v
+    end
+    local function decimal(signed)
+        local bytes = {string.byte(data, pos, pos + 7)}
+        pos = pos + 8
+        local negative = signed and bytes[1] >= 0x80
+        if negative then
+            local carry = 1
+            for k=8,1,-1 do
+                local v = 255 - bytes[k] + carry
+                bytes[k] = v % 256
+                carry = math.floor(v / 256)
+            end
+        end
+        local digits = ''
+        repeat
+            local rest = 0
+            local more = false
+            for k=1,8 do
+                local v = rest * 256 + bytes[k]
+                bytes[k] = math.floor(v / 10)
+                rest = v % 10
+                more = more or bytes[k] > 0
+            end
+            digits = string.format('%d', rest) .. digits
+        until not more
+        if negative then
+            return '-' .. digits
+        end
+        return digits
+    end
+    -- Moves past count values
+    local function skip(count)
+        while count > 0 do
+            count = count - 1
+            local b = uint(1)
+            if b >= 0x80 and b <= 0x8f then
+                count = count + (b - 0x80) * 2
+            elseif b >= 0x90 and b <= 0x9f then
+                count = count + b - 0x90
+            elseif b >= 0xa0 and b <= 0xbf then
+                pos = pos + b - 0xa0
+            elseif b >= 0xc4 and b <= 0xc6 then
+                local len = uint(sizes[b - 0xc3])
+                pos = pos + len
+            elseif b >= 0xc7 and b <= 0xc9 then
+                local len = uint(sizes[b - 0xc6])
+                pos = pos + len + 1
+            elseif b == 0xca or b == 0xcb then
+                pos = pos + sizes[b - 0xc7]
+            elseif b >= 0xcc and b <= 0xd3 then
+                pos = pos + sizes[(b - 0xcc) % 4 + 1]
+            elseif b >= 0xd4 and b <= 0xd8 then
+                pos = pos + sizes[b - 0xd3] + 1
+            elseif b >= 0xd9 and b <= 0xdb then
+                local len = uint(sizes[b - 0xd8])
+                pos = pos + len
+            elseif b == 0xdc or b == 0xdd then
+                count = count + uint(sizes[b - 0xda])
+            elseif b == 0xde or b == 0xdf then
+                count = count + uint(sizes[b - 0xdc]) * 2
+            end
+        end
+    end
+
+    local b = uint(1)
+    local count = 0
+    if b >= 0x80 and b <= 0x8f then
+        count = b - 0x80
+    elseif b == 0xde or b == 0xdf then
+        count = uint(sizes[b - 0xdc])
+    end
+    for _=1,count do
+        local k = uint(1)
+        local len
+        if k >= 0xa0 and k <= 0xbf then
+            len = k - 0xa0
+        elseif k >= 0xd9 and k <= 0xdb then
+            len = uint(sizes[k - 0xd8])
+        else
+            return doc
+        end
+        local name = string.sub(data, pos, pos + len - 1)
+        pos = pos + len
+        local v = string.byte(data, pos)
+        if v == 0xcf or v == 0xd3 then
+            pos = pos + 1
+            doc[name] = decimal(v == 0xd3)
+        else
+            skip(1)
+        end
+    end
+    return doc
+end
+
+-- The instance holding a unique value, nil if it's free as of now ('' when the model doesn't expire)
+local function holder(prefix, name, value, now)
+    local owner = redis.call('hget', prefix .. ':key:' .. name, value)
+    if owner and now ~= '' then
+        local expireat = redis.call('zscore', prefix .. ':expiry', owner)
+        if expireat and tonumber(expireat) <= tonumber(now) then
+            return nil
+        end
+    end
+    return owner
+end
+
+local uuid = ARGV[1]
+local prefix = ARGV[2]
+local field = ARGV[3]
+local amount = ARGV[4]
+-- 'int' or 'float'
+local kind = ARGV[5]
+-- 'unique', 'index' or '' for how the field is indexed, and '1' if it has a range index
+local index = ARGV[6]
+local ranged = ARGV[7] == '1'
+-- Bounds the new value must stay within, '' for none
+local minimum = ARGV[8]
+local maximum = ARGV[9]
+local versionfield = ARGV[10]
+-- The time now if the model expires, otherwise ''
+local now = ARGV[11]
+local memberkey = KEYS[1]
+
+if redis.call('exists', memberkey) == 0 then
+    return redis.error_reply('Not Found')
+end
+local raw = redis.call('hget', memberkey, field)
+local old = nil
+if raw then
+    old = tonumber(raw)
+end
+local new = (old or 0) + tonumber(amount)
+if (minimum ~= '' and new < tonumber(minimum)) or (maximum ~= '' and new > tonumber(maximum)) then
+    return redis.error_reply('Bounds Exceeded: ' .. field)
+end
+
+-- Index values of stored strings, integers are used as Redis writes them so they stay exact past 2^53
+local function indexed(value)
+    if kind == 'int' then
+        return value
+    end
+    return idxval(tonumber(value))
+end
+
+-- Redis does the arithmetic on the stored string, so integers stay exact
+local stored
+if kind == 'int' then
+    redis.call('hincrby', memberkey, field, amount)
+    stored = redis.call('hget', memberkey, field)
+else
+    stored = redis.call('hincrbyfloat', memberkey, field, amount)
+end
+new = tonumber(stored)
+
+if index == 'unique' then
+    local owner = holder(prefix, field, indexed(stored), now)
+    if owner and owner ~= uuid then
+        -- Nothing else has been written yet, so putting the field back undoes the increment
+        if raw then
+            redis.call('hset', memberkey, field, raw)
+        else
+            redis.call('hdel', memberkey, field)
+        end
+        return redis.error_reply('Unique Violation: ' .. field)
+    end
+    if old then
+        redis.call('hdel', prefix .. ':key:' .. field, indexed(raw))
+    else
+        redis.call('srem', prefix .. ':keynull:' .. field, uuid)
+    end
+    redis.call('hset', prefix .. ':key:' .. field, indexed(stored), uuid)
+elseif index == 'index' then
+    if old then
+        redis.call('srem', prefix .. ':index:' .. field .. ':' .. indexed(raw), uuid)
+    else
+        redis.call('srem', prefix .. ':indexnull:' .. field, uuid)
+    end
+    redis.call('sadd', prefix .. ':index:' .. field .. ':' .. indexed(stored), uuid)
+end
+if ranged then
+    redis.call('zadd', prefix .. ':range:' .. field, new, uuid)
+end
+local version = 0
+if versionfield ~= '' then
+    version = redis.call('hincrby', memberkey, versionfield, 1)
+end
+return {stored, version}
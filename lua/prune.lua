@@ -0,0 +1,233 @@
+-- Removes the entries of one unique, index or range key that no longer match the stored instance they point to.
+-- Returns the number removed.
+--
+
+-- Mirrors redorm.plan.index_value so old values decoded here match the keys written by the client
+local function idxval(v)
+    local t = type(v)
+    if t == 'string' then
+        return v
+    elseif t == 'boolean' then
+        if v then return 'True' else return 'False' end
+    elseif t == 'number' then
+        return string.format('%.17g', v)
+    end
+    return nil
+end
+
+-- Decodes JSON with integers of 16 characters or more quoted, so they come back as exact strings
+local function jsondecode(text)
+    if not string.find(text, '%d%d%d%d%d%d%d%d%d%d%d%d%d%d%d') then
+        return cjson.decode(text)
+    end
+    local parts = {}
+    local copied = 1
+    local pos = 1
+    while true do
+        local start = string.find(text, '[%-%d"]', pos)
+        if not start then
+            break
+        elseif string.sub(text, start, start) == '"' then
+            -- Strings are skipped, stepping over escaped characters
+            local stop = string.find(text, '["\\]', start + 1)
+            while string.sub(text, stop, stop) ~= '"' do
+                stop = string.find(text, '["\\]', stop + 2)
+            end
+            pos = stop + 1
+        else
+            local _, stop = string.find(text, '^%-?%d+', start)
+            local after = string.sub(text, stop + 1, stop + 1)
+            if stop - start >= 15 and after ~= '.' and after ~= 'e' and after ~= 'E' then
+                table.insert(parts, string.sub(text, copied, start - 1))
+                table.insert(parts, '"' .. string.sub(text, start, stop) .. '"')
+                copied = stop + 1
+            end
+            pos = string.find(text, '[^%-%d%.eE+]', start) or #text + 1
+        end
+    end
+    table.insert(parts, string.sub(text, copied))
+    return cjson.decode(table.concat(parts))
+end
+
+-- Decodes msgpack, with the 64 bit integers at the top level of the document read again from its bytes as decimal
+-- strings
+local function msgpackdecode(data)
+    local doc = cmsgpack.unpack(data)
+    local pos = 1
+    local sizes = {1, 2, 4, 8, 16}
+    local function uint(n)
+        local v = 0
+        for k=pos,pos+n-1 do
+            v = v * 256 + string.byte(data, k)
+        end
+        pos = pos + n
+        return v
+    end
+    local function decimal(signed)
+        local bytes = {string.byte(data, pos, pos + 7)}
+        pos = pos + 8
+        local negative = signed and bytes[1] >= 0x80
+        if negative then
+            local carry = 1
+            for k=8,1,-1 do
+                local v = 255 - bytes[k] + carry
+                bytes[k] = v % 256
+                carry = math.floor(v / 256)
+            end
+        end
+        local digits = ''
+        repeat
+            local rest = 0
+            local more = false
+            for k=1,8 do
+                local v = rest * 256 + bytes[k]
+                bytes[k] = math.floor(v / 10)
+                rest = v % 10
+                more = more or bytes[k] > 0
+            end
+            digits = string.format('%d', rest) .. digits
+        until not more
+        if negative then
+            return '-' .. digits
+        end
+        return digits
+    end
+    -- Moves past count values
+    local function skip(count)
+        while count > 0 do
+            count = count - 1
+            local b = uint(1)
+            if b >= 0x80 and b <= 0x8f then
+                count = count + (b - 0x80) * 2
+            elseif b >= 0x90 and b <= 0x9f then
+                count = count + b - 0x90
+            elseif b >= 0xa0 and b <= 0xbf then
+                pos = pos + b - 0xa0
+            elseif b >= 0xc4 and b <= 0xc6 then
+                local len = uint(sizes[b - 0xc3])
+                pos = pos + len
+            elseif b >= 0xc7 and b <= 0xc9 then
+                local len = uint(sizes[b - 0xc6])
+                pos = pos + len + 1
+            elseif b == 0xca or b == 0xcb then
+                pos = pos + sizes[b - 0xc7]
+            elseif b >= 0xcc and b <= 0xd3 then
+                pos = pos + sizes[(b - 0xcc) % 4 + 1]
+            elseif b >= 0xd4 and b <= 0xd8 then
+                pos = pos + sizes[b - 0xd3] + 1
+            elseif b >= 0xd9 and b <= 0xdb then
+                local len = uint(sizes[b - 0xd8])
+                pos = pos + len
+            elseif b == 0xdc or b == 0xdd then
+                count = count + uint(sizes[b - 0xda])
+            elseif b == 0xde or b == 0xdf then
+                count = count + uint(sizes[b - 0xdc]) * 2
+            end
+        end
+    end
+
+    local b = uint(1)
+    local count = 0
+    if b >= 0x80 and b <= 0x8f then
+        count = b - 0x80
+    elseif b == 0xde or b == 0xdf then
+        count = uint(sizes[b - 0xdc])
+    end
+    for _=1,count do
+        local k = uint(1)
+        local len
+        if k >= 0xa0 and k <= 0xbf then
+            len = k - 0xa0
+        elseif k >= 0xd9 and k <= 0xdb then
+            len = uint(sizes[k - 0xd8])
+        else
+            return doc
+        end
+        local name = string.sub(data, pos, pos + len - 1)
+        pos = pos + len
+        local v = string.byte(data, pos)
+        if v == 0xcf or v == 0xd3 then
+            pos = pos + 1
+            doc[name] = decimal(v == 0xd3)
+        else
+            skip(1)
+        end
+    end
+    return doc
+end
+
+-- Stored instances are at this followed by their id
+local memberprefix = ARGV[1]
+local storage = ARGV[2]
+-- 'key', 'keynull', 'index', 'indexnull', 'range', 'lex', 'all' or 'expiry' for the structure KEYS[1] is
+local kind = ARGV[3]
+local name = ARGV[4]
+-- The value an index set is for, or '1' if a prefix index is case folded
+local indexed = ARGV[5]
+
+-- Whether the instance exists and the field value it has, read the same way the save script reads old values
+local function current(uuid)
+    local memberkey = memberprefix .. uuid
+    if storage == 'json' then
+        local data = redis.call('get', memberkey)
+        if not data then
+            return false, nil
+        elseif name == '' then
+            return true, nil
+        elseif string.sub(data, 1, 1) == '{' then
+            return true, jsondecode(data)[name]
+        end
+        return true, msgpackdecode(data)[name]
+    end
+    if redis.call('exists', memberkey) == 0 then
+        return false, nil
+    end
+    local raw = name ~= '' and redis.call('hget', memberkey, name)
+    if raw then
+        return true, jsondecode(raw)
+    end
+    return true, nil
+end
+
+-- Entries follow, values and ids for a unique hash, prefix index members and ids otherwise. Entries not matching
+-- the stored instance they point to are removed.
+local removed = 0
+local step = 1
+if kind == 'key' then
+    step = 2
+end
+for i=6,#ARGV,step do
+    local uuid = ARGV[i + step - 1]
+    if kind == 'lex' then
+        uuid = string.match(ARGV[i], '^.*%z(.*)$') or ''
+    end
+    local exists, value = current(uuid)
+    local valid = exists
+    if kind == 'lex' then
+        value = idxval(value)
+        if value and indexed == '1' then value = string.lower(value) end
+        valid = exists and value ~= nil and ARGV[i] == value .. '\0' .. uuid
+    elseif kind == 'key' then
+        valid = exists and idxval(value) == ARGV[i]
+    elseif kind == 'index' then
+        valid = exists and idxval(value) == indexed
+    elseif kind == 'keynull' or kind == 'indexnull' then
+        valid = exists and idxval(value) == nil
+    elseif kind == 'range' then
+        valid = exists and tonumber(value) ~= nil
+    end
+    if not valid then
+        if kind == 'key' then
+            if redis.call('hget', KEYS[1], ARGV[i]) == uuid then
+                removed = removed + redis.call('hdel', KEYS[1], ARGV[i])
+            end
+        elseif kind == 'range' or kind == 'expiry' then
+            removed = removed + redis.call('zrem', KEYS[1], uuid)
+        elseif kind == 'lex' then
+            removed = removed + redis.call('zrem', KEYS[1], ARGV[i])
+        else
+            removed = removed + redis.call('srem', KEYS[1], uuid)
+        end
+    end
+end
+return removed
@@ -0,0 +1,273 @@
+-- Adds the missing unique, index, range and prefix index entries of a batch of stored instances, for fields that
+-- became indexed after they were saved. Returns the number of entries changed and (id, field, owner) triples of
+-- unique conflicts.
+--
+
+-- Mirrors redorm.plan.index_value so old values decoded here match the keys written by the client
+local function idxval(v)
+    local t = type(v)
+    if t == 'string' then
+        return v
+    elseif t == 'boolean' then
+        if v then return 'True' else return 'False' end
+    elseif t == 'number' then
+        return string.format('%.17g', v)
+    end
+    return nil
+end
+
+-- Decodes JSON with integers of 16 characters or more quoted, so they come back as exact strings
+local function jsondecode(text)
+    if not string.find(text, '%d%d%d%d%d%d%d%d%d%d%d%d%d%d%d') then
+        return cjson.decode(text)
+    end
+    local parts = {}
+    local copied = 1
+    local pos = 1
+    while true do
+        local start = string.find(text, '[%-%d"]', pos)
+        if not start then
+            break
+        elseif string.sub(text, start, start) == '"' then
+            -- Strings are skipped, stepping over escaped characters
+            local stop = string.find(text, '["\\]', start + 1)
+            while string.sub(text, stop, stop) ~= '"' do
+                stop = string.find(text, '["\\]', stop + 2)
+            end
+            pos = stop + 1
+        else
+            local _, stop = string.find(text, '^%-?%d+', start)
+            local after = string.sub(text, stop + 1, stop + 1)
+            if stop - start >= 15 and after ~= '.' and after ~= 'e' and after ~= 'E' then
+                table.insert(parts, string.sub(text, copied, start - 1))
+                table.insert(parts, '"' .. string.sub(text, start, stop) .. '"')
+                copied = stop + 1
+            end
+            pos = string.find(text, '[^%-%d%.eE+]', start) or #text + 1
+        end
+    end
+    table.insert(parts, string.sub(text, copied))
+    return cjson.decode(table.concat(parts))
+end
+
+-- Decodes msgpack, with the 64 bit integers at the top level of the document read again from its bytes as decimal
+-- strings
+local function msgpackdecode(data)
+    local doc = cmsgpack.unpack(data)
+    local pos = 1
+    local sizes = {1, 2, 4, 8, 16}
+    local function uint(n)
+        local v = 0
+        for k=pos,pos+n-1 do
+            v = v * 256 + string.byte(data, k)
+        end
+        pos = pos + n
+        return v
+    end
+    local function decimal(signed)
+        local bytes = {string.byte(data, pos, pos + 7)}
+        pos = pos + 8
+        local negative = signed and bytes[1] >= 0x80
+        if negative then
+            local carry = 1
+            for k=8,1,-1 do
+                local v = 255 - bytes[k] + carry
+                bytes[k] = v % 256
+                carry = math.floor(v / 256)
+            end
+        end
+        local digits = ''
+        repeat
+            local rest = 0
+            local more = false
+            for k=1,8 do
+                local v = rest * 256 + bytes[k]
+                bytes[k] = math.floor(v / 10)
+                rest = v % 10
+                more = more or bytes[k] > 0
+            end
+            digits = string.format('%d', rest) .. digits
+        until not more
+        if negative then
+            return '-' .. digits
+        end
+        return digits
+    end
+    -- Moves past count values
+    local function skip(count)
+        while count > 0 do
+            count = count - 1
+            local b = uint(1)
+            if b >= 0x80 and b <= 0x8f then
+                count = count + (b - 0x80) * 2
+            elseif b >= 0x90 and b <= 0x9f then
+                count = count + b - 0x90
+            elseif b >= 0xa0 and b <= 0xbf then
+                pos = pos + b - 0xa0
+            elseif b >= 0xc4 and b <= 0xc6 then
+                local len = uint(sizes[b - 0xc3])
+                pos = pos + len
+            elseif b >= 0xc7 and b <= 0xc9 then
+                local len = uint(sizes[b - 0xc6])
+                pos = pos + len + 1
+            elseif b == 0xca or b == 0xcb then
+                pos = pos + sizes[b - 0xc7]
+            elseif b >= 0xcc and b <= 0xd3 then
+                pos = pos + sizes[(b - 0xcc) % 4 + 1]
+            elseif b >= 0xd4 and b <= 0xd8 then
+                pos = pos + sizes[b - 0xd3] + 1
+            elseif b >= 0xd9 and b <= 0xdb then
+                local len = uint(sizes[b - 0xd8])
+                pos = pos + len
+            elseif b == 0xdc or b == 0xdd then
+                count = count + uint(sizes[b - 0xda])
+            elseif b == 0xde or b == 0xdf then
+                count = count + uint(sizes[b - 0xdc]) * 2
+            end
+        end
+    end
+
+    local b = uint(1)
+    local count = 0
+    if b >= 0x80 and b <= 0x8f then
+        count = b - 0x80
+    elseif b == 0xde or b == 0xdf then
+        count = uint(sizes[b - 0xdc])
+    end
+    for _=1,count do
+        local k = uint(1)
+        local len
+        if k >= 0xa0 and k <= 0xbf then
+            len = k - 0xa0
+        elseif k >= 0xd9 and k <= 0xdb then
+            len = uint(sizes[k - 0xd8])
+        else
+            return doc
+        end
+        local name = string.sub(data, pos, pos + len - 1)
+        pos = pos + len
+        local v = string.byte(data, pos)
+        if v == 0xcf or v == 0xd3 then
+            pos = pos + 1
+            doc[name] = decimal(v == 0xd3)
+        else
+            skip(1)
+        end
+    end
+    return doc
+end
+
+-- The instance holding a unique value, nil if it's free as of now ('' when the model doesn't expire)
+local function holder(prefix, name, value, now)
+    local owner = redis.call('hget', prefix .. ':key:' .. name, value)
+    if owner and now ~= '' then
+        local expireat = redis.call('zscore', prefix .. ':expiry', owner)
+        if expireat and tonumber(expireat) <= tonumber(now) then
+            return nil
+        end
+    end
+    return owner
+end
+
+local prefix = ARGV[1]
+-- Stored instances are at this followed by their id
+local memberprefix = ARGV[2]
+local storage = ARGV[3]
+local uniquecnt = tonumber(ARGV[4])
+local indexcnt = tonumber(ARGV[5])
+local rangecnt = tonumber(ARGV[6])
+local lexcnt = tonumber(ARGV[7])
+-- The time now if the model expires, otherwise ''
+local now = ARGV[8]
+-- Unique, index and range field names follow, then '1' if case folded and the name of each prefix index, and then the
+-- ids of the batch
+local beginunique = 9
+local beginindex = beginunique + uniquecnt
+local beginrange = beginindex + indexcnt
+local beginlex = beginrange + rangecnt
+local beginids = beginlex + (lexcnt * 2)
+
+-- The stored fields of an instance, read the same way the save script reads old values
+local function load(uuid)
+    local memberkey = memberprefix .. uuid
+    if storage == 'json' then
+        local data = redis.call('get', memberkey)
+        if not data then
+            return nil
+        elseif string.sub(data, 1, 1) == '{' then
+            return jsondecode(data)
+        end
+        return msgpackdecode(data)
+    end
+    local fields = redis.call('hgetall', memberkey)
+    if #fields == 0 then
+        return nil
+    end
+    local doc = {}
+    for i=1,#fields,2 do
+        doc[fields[i]] = jsondecode(fields[i+1])
+    end
+    return doc
+end
+
+local fixed = 0
+local conflicts = {}
+for j=beginids,#ARGV do
+    local uuid = ARGV[j]
+    local doc = load(uuid)
+    if doc then
+        for i=beginunique,beginindex-1 do
+            local name = ARGV[i]
+            local value = idxval(doc[name])
+            if value then
+                local owner = holder(prefix, name, value, now)
+                if not owner then
+                    if redis.call('hget', prefix .. ':key:' .. name, value) ~= uuid then
+                        fixed = fixed + 1
+                    end
+                    redis.call('hset', prefix .. ':key:' .. name, value, uuid)
+                elseif owner ~= uuid then
+                    table.insert(conflicts, uuid)
+                    table.insert(conflicts, name)
+                    table.insert(conflicts, owner)
+                end
+                fixed = fixed + redis.call('srem', prefix .. ':keynull:' .. name, uuid)
+            else
+                fixed = fixed + redis.call('sadd', prefix .. ':keynull:' .. name, uuid)
+            end
+        end
+        for i=beginindex,beginrange-1 do
+            local name = ARGV[i]
+            local value = idxval(doc[name])
+            if value then
+                fixed = fixed + redis.call('sadd', prefix .. ':index:' .. name .. ':' .. value, uuid)
+                fixed = fixed + redis.call('srem', prefix .. ':indexnull:' .. name, uuid)
+            else
+                fixed = fixed + redis.call('sadd', prefix .. ':indexnull:' .. name, uuid)
+            end
+        end
+        for i=beginrange,beginlex-1 do
+            local name = ARGV[i]
+            local score = tonumber(doc[name])
+            if score then
+                local current = redis.call('zscore', prefix .. ':range:' .. name, uuid)
+                if tonumber(current) ~= score then
+                    redis.call('zadd', prefix .. ':range:' .. name, string.format('%.17g', score), uuid)
+                    fixed = fixed + 1
+                end
+            else
+                fixed = fixed + redis.call('zrem', prefix .. ':range:' .. name, uuid)
+            end
+        end
+        for i=beginlex,beginids-1,2 do
+            local name = ARGV[i+1]
+            local value = idxval(doc[name])
+            if value then
+                if ARGV[i] == '1' then value = string.lower(value) end
+                fixed = fixed + redis.call('zadd', prefix .. ':lex:' .. name, 0, value .. '\0' .. uuid)
+            end
+        end
+        fixed = fixed + redis.call('sadd', KEYS[1], uuid)
+    end
+end
+return {fixed, conflicts}
@@ -0,0 +1,85 @@
+-- Changes a relationship and, when they are on the same node, the backrefs of the related instances.
+-- Returns the related ids added and removed.
+--
+
+local uuid = ARGV[1]
+-- 'set' replaces the related ids with the given ones, 'add' and 'remove' change just those
+local mode = ARGV[2]
+local tomany = ARGV[3] == '1'
+-- The key prefix of the other end's entries if they're on this node otherwise '', and whether those are sets
+local backref = ARGV[4]
+local backrefmany = ARGV[5] == '1'
+local key = KEYS[1]
+
+-- With '1' the relationship is only written if the instance was saved, for a save queued in the same pipeline
+if ARGV[6] == '1' and redis.call('exists', KEYS[2]) == 0 then
+    return {{}, {}}
+end
+
+local old = {}
+if tomany then
+    for _,id in ipairs(redis.call('smembers', key)) do
+        old[id] = true
+    end
+else
+    local ref = redis.call('get', key)
+    if ref then
+        old[ref] = true
+    end
+end
+local given = {}
+for i=7,#ARGV do
+    given[ARGV[i]] = true
+end
+
+local added = {}
+local removed = {}
+for id in pairs(given) do
+    if mode == 'remove' then
+        if old[id] then table.insert(removed, id) end
+    elseif not old[id] then
+        table.insert(added, id)
+    end
+end
+if mode == 'set' then
+    for id in pairs(old) do
+        if not given[id] then table.insert(removed, id) end
+    end
+end
+if #added == 0 and #removed == 0 then
+    return {added, removed}
+end
+
+-- Large sets are changed in chunks to stay within Lua's argument limits
+local function each_chunk(command, ids)
+    for i=1,#ids,1000 do
+        redis.call(command, key, unpack(ids, i, math.min(i+999, #ids)))
+    end
+end
+
+if tomany then
+    each_chunk('srem', removed)
+    each_chunk('sadd', added)
+elseif #added > 0 then
+    redis.call('set', key, added[1])
+else
+    redis.call('del', key)
+end
+
+if backref ~= '' then
+    for _,id in ipairs(removed) do
+        if backrefmany then
+            redis.call('srem', backref .. id, uuid)
+        elseif redis.call('get', backref .. id) == uuid then
+            redis.call('del', backref .. id)
+        end
+    end
+    for _,id in ipairs(added) do
+        if backrefmany then
+            redis.call('sadd', backref .. id, uuid)
+        else
+            redis.call('set', backref .. id, uuid)
+        end
+    end
+end
+return {added, removed}
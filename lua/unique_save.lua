@@ -1,58 +1,330 @@
--- Saves a model, provided it satisfies unique constraints otherwise doesn't side effect
+-- Saves a model, diffing its unique, index, range and prefix index entries against the stored document.
+-- Provided it satisfies unique constraints, otherwise doesn't side effect
 --
 
-local uniquecnt = ARGV[1]
-local uniquenullcnt = ARGV[2]
-local indexcnt = ARGV[3]
-local indexnullcnt = ARGV[4]
-local data = ARGV[5]
-local uuid = ARGV[6]
-local clsname = ARGV[7]
+-- Mirrors redorm.plan.index_value so old values decoded here match the keys written by the client
+local function idxval(v)
+    local t = type(v)
+    if t == 'string' then
+        return v
+    elseif t == 'boolean' then
+        if v then return 'True' else return 'False' end
+    elseif t == 'number' then
+        return string.format('%.17g', v)
+    end
+    return nil
+end
+
+-- Decodes JSON with integers of 16 characters or more quoted, so they come back as exact strings
+local function jsondecode(text)
+    if not string.find(text, '%d%d%d%d%d%d%d%d%d%d%d%d%d%d%d') then
+        return cjson.decode(text)
+    end
+    local parts = {}
+    local copied = 1
+    local pos = 1
+    while true do
+        local start = string.find(text, '[%-%d"]', pos)
+        if not start then
+            break
+        elseif string.sub(text, start, start) == '"' then
+            -- Strings are skipped, stepping over escaped characters
+            local stop = string.find(text, '["\\]', start + 1)
+            while string.sub(text, stop, stop) ~= '"' do
+                stop = string.find(text, '["\\]', stop + 2)
+            end
+            pos = stop + 1
+        else
+            local _, stop = string.find(text, '^%-?%d+', start)
+            local after = string.sub(text, stop + 1, stop + 1)
+            if stop - start >= 15 and after ~= '.' and after ~= 'e' and after ~= 'E' then
+                table.insert(parts, string.sub(text, copied, start - 1))
+                table.insert(parts, '"' .. string.sub(text, start, stop) .. '"')
+                copied = stop + 1
+            end
+            pos = string.find(text, '[^%-%d%.eE+]', start) or #text + 1
+        end
+    end
+    table.insert(parts, string.sub(text, copied))
+    return cjson.decode(table.concat(parts))
+end
+
+-- Decodes msgpack, with the 64 bit integers at the top level of the document read again from its bytes as decimal
+-- strings
+local function msgpackdecode(data)
+    local doc = cmsgpack.unpack(data)
+    local pos = 1
+    local sizes = {1, 2, 4, 8, 16}
+    local function uint(n)
+        local v = 0
+        for k=pos,pos+n-1 do
+            v = v * 256 + string.byte(data, k)
+        end
+        pos = pos + n
+        return v
+    end
+    local function decimal(signed)
+        local bytes = {string.byte(data, pos, pos + 7)}
+        pos = pos + 8
+        local negative = signed and bytes[1] >= 0x80
+        if negative then
+            local carry = 1
+            for k=8,1,-1 do
+                local v = 255 - bytes[k] + carry
+                bytes[k] = v % 256
+                carry = math.floor(v / 256)
+            end
+        end
+        local digits = ''
+        repeat
+            local rest = 0
+            local more = false
+            for k=1,8 do
+                local v = rest * 256 + bytes[k]
+                bytes[k] = math.floor(v / 10)
+                rest = v % 10
+                more = more or bytes[k] > 0
+            end
+            digits = string.format('%d', rest) .. digits
+        until not more
+        if negative then
+            return '-' .. digits
+        end
+        return digits
+    end
+    -- Moves past count values
+    local function skip(count)
+        while count > 0 do
+            count = count - 1
+            local b = uint(1)
+            if b >= 0x80 and b <= 0x8f then
+                count = count + (b - 0x80) * 2
+            elseif b >= 0x90 and b <= 0x9f then
+                count = count + b - 0x90
+            elseif b >= 0xa0 and b <= 0xbf then
+                pos = pos + b - 0xa0
+            elseif b >= 0xc4 and b <= 0xc6 then
+                local len = uint(sizes[b - 0xc3])
+                pos = pos + len
+            elseif b >= 0xc7 and b <= 0xc9 then
+                local len = uint(sizes[b - 0xc6])
+                pos = pos + len + 1
+            elseif b == 0xca or b == 0xcb then
+                pos = pos + sizes[b - 0xc7]
+            elseif b >= 0xcc and b <= 0xd3 then
+                pos = pos + sizes[(b - 0xcc) % 4 + 1]
+            elseif b >= 0xd4 and b <= 0xd8 then
+                pos = pos + sizes[b - 0xd3] + 1
+            elseif b >= 0xd9 and b <= 0xdb then
+                local len = uint(sizes[b - 0xd8])
+                pos = pos + len
+            elseif b == 0xdc or b == 0xdd then
+                count = count + uint(sizes[b - 0xda])
+            elseif b == 0xde or b == 0xdf then
+                count = count + uint(sizes[b - 0xdc]) * 2
+            end
+        end
+    end
+
+    local b = uint(1)
+    local count = 0
+    if b >= 0x80 and b <= 0x8f then
+        count = b - 0x80
+    elseif b == 0xde or b == 0xdf then
+        count = uint(sizes[b - 0xdc])
+    end
+    for _=1,count do
+        local k = uint(1)
+        local len
+        if k >= 0xa0 and k <= 0xbf then
+            len = k - 0xa0
+        elseif k >= 0xd9 and k <= 0xdb then
+            len = uint(sizes[k - 0xd8])
+        else
+            return doc
+        end
+        local name = string.sub(data, pos, pos + len - 1)
+        pos = pos + len
+        local v = string.byte(data, pos)
+        if v == 0xcf or v == 0xd3 then
+            pos = pos + 1
+            doc[name] = decimal(v == 0xd3)
+        else
+            skip(1)
+        end
+    end
+    return doc
+end
+
+-- The instance holding a unique value, nil if it's free as of now ('' when the model doesn't expire)
+local function holder(prefix, name, value, now)
+    local owner = redis.call('hget', prefix .. ':key:' .. name, value)
+    if owner and now ~= '' then
+        local expireat = redis.call('zscore', prefix .. ':expiry', owner)
+        if expireat and tonumber(expireat) <= tonumber(now) then
+            return nil
+        end
+    end
+    return owner
+end
+
+local data = ARGV[1]
+local uuid = ARGV[2]
+-- Key prefix of the model, hash tagged in cluster mode so every key derived from it shares the slot of KEYS
+local prefix = ARGV[3]
+local uniquecnt = tonumber(ARGV[4])
+local indexcnt = tonumber(ARGV[5])
+local rangecnt = tonumber(ARGV[6])
+local lexcnt = tonumber(ARGV[7])
+-- 'json' stores the document as a string, 'hash' replaces a hash of JSON encoded fields
+-- and 'hashpatch' only writes the fields in data
+local mode = ARGV[8]
+-- The version field if the model has one, and the version the stored document must be at ('' to skip the check)
+local versionfield = ARGV[9]
+local expected = ARGV[10]
+-- Unix time new instances expire at, '' if they don't, and the time now if the model expires
+local expireat = ARGV[11]
+local now = ARGV[12]
+local memberkey = KEYS[1]
+
+local old
+local olddoc = {}
+if mode == 'json' then
+    old = redis.call('get', memberkey)
+    if old and string.sub(old, 1, 1) == '{' then
+        olddoc = jsondecode(old)
+    elseif old then
+        olddoc = msgpackdecode(old)
+    end
+else
+    old = redis.call('exists', memberkey) == 1
+end
 
-local beginunique = 8
+local function oldvalue(name)
+    if mode == 'json' then
+        return olddoc[name]
+    end
+    local raw = redis.call('hget', memberkey, name)
+    if raw then
+        return jsondecode(raw)
+    end
+    return nil
+end
+
+if mode == 'hashpatch' and not old then
+    return redis.error_reply('Not Found')
+end
+if versionfield ~= '' and expected ~= '' and old then
+    if (tonumber(oldvalue(versionfield)) or 0) ~= tonumber(expected) then
+        return redis.error_reply('Version Conflict: ' .. versionfield)
+    end
+end
+
+-- Each field is a triple of field name, '1' if the new value is not null otherwise '0', new value.
+-- Prefix index fields are preceded by '1' when their values are case folded.
+local beginunique = 13
 local endofunique = beginunique+(uniquecnt*3)-1
--- Check uniqueness constraints, triples of field name, old value, new value
+local beginindex = endofunique + 1
+local endofindex = beginindex+(indexcnt*3)-1
+local beginrange = endofindex + 1
+local endofrange = beginrange+(rangecnt*3)-1
+local beginlex = endofrange + 1
+local endoflex = beginlex+(lexcnt*4)-1
+
+-- Check uniqueness constraints before writing anything
 for i=beginunique,endofunique,3 do
-     if redis.call('hexists', clsname .. ':key:' .. ARGV[i], ARGV[i+2]) == 1 then
-         return redis.error_reply('Unique Violation: ' .. ARGV[i])
-     end
+    if ARGV[i+1] == '1' and ARGV[i+2] ~= idxval(oldvalue(ARGV[i])) then
+        local owner = holder(prefix, ARGV[i], ARGV[i+2], now)
+        if owner and owner ~= uuid then
+            return redis.error_reply('Unique Violation: ' .. ARGV[i])
+        end
+    end
 end
 
 -- Update unique hash maps
 for i=beginunique,endofunique,3 do
-    redis.call('hdel', clsname .. ':key:' .. ARGV[i], ARGV[i+1])
-    redis.call('hset', clsname .. ':key:' .. ARGV[i], ARGV[i+2], uuid)
-    redis.call('srem', clsname .. ':keynull:' .. ARGV[i], uuid)
+    local oldval = idxval(oldvalue(ARGV[i]))
+    local newval = nil
+    if ARGV[i+1] == '1' then newval = ARGV[i+2] end
+    if (not old) or oldval ~= newval then
+        if oldval then
+            redis.call('hdel', prefix .. ':key:' .. ARGV[i], oldval)
+        end
+        if newval then
+            redis.call('hset', prefix .. ':key:' .. ARGV[i], newval, uuid)
+            redis.call('srem', prefix .. ':keynull:' .. ARGV[i], uuid)
+        else
+            redis.call('sadd', prefix .. ':keynull:' .. ARGV[i], uuid)
+        end
+    end
 end
 
-local beginuniquenull = endofunique + 1
-local endofuniquenull = beginuniquenull+(uniquenullcnt*2)-1
--- Update unique hash maps, pairs of field name, old value
-for i=beginuniquenull,endofuniquenull,2 do
-    redis.call('hdel', clsname .. ':key:' .. ARGV[i], ARGV[i+1])
-    redis.call('sadd', clsname .. ':keynull:' .. ARGV[i], uuid)
+-- Update index sets
+for i=beginindex,endofindex,3 do
+    local oldval = idxval(oldvalue(ARGV[i]))
+    local newval = nil
+    if ARGV[i+1] == '1' then newval = ARGV[i+2] end
+    if (not old) or oldval ~= newval then
+        if oldval then
+            redis.call('srem', prefix .. ':index:' .. ARGV[i] .. ':' .. oldval, uuid)
+        end
+        if newval then
+            redis.call('srem', prefix .. ':indexnull:' .. ARGV[i], uuid)
+            redis.call('sadd', prefix .. ':index:' .. ARGV[i] .. ':' .. newval, uuid)
+        else
+            redis.call('sadd', prefix .. ':indexnull:' .. ARGV[i], uuid)
+        end
+    end
 end
 
-local beginindex = endofuniquenull + 1
-local endofindex = beginindex+(indexcnt*3)-1
--- Update index sets, triples of field name, old value, new value
-for i=beginindex,endofindex,3 do
-    -- Remove from old index
-    redis.call('srem', clsname .. ':index:' .. ARGV[i] .. ':' .. ARGV[i+1], uuid)
-    -- Remove from old null index in case was null
-    redis.call('srem', clsname .. ':indexnull:' .. ARGV[i], uuid)
-    -- Add to new index
-    redis.call('sadd', clsname .. ':index:' .. ARGV[i] .. ':' .. ARGV[i+2], uuid)
-end
-
-local beginindexnull = endofindex + 1
-local endofindexnull = beginindexnull+(indexnullcnt*2)-1
--- Update unique hash maps, pairs of field name, old value
-for i=beginindexnull,endofindexnull,2 do
-    -- Remove from old index
-    redis.call('srem', clsname .. ':index:' .. ARGV[i] .. ':' .. ARGV[i+1], uuid)
-    -- Add to null index
-    redis.call('sadd', clsname .. ':indexnull:' .. ARGV[i], uuid)
-end
-redis.call('set', clsname .. ':member:' .. uuid, data)
-redis.call('sadd', clsname .. ':all', uuid)
+-- Update range index sorted sets, nulls are left out
+for i=beginrange,endofrange,3 do
+    if ARGV[i+1] == '1' then
+        redis.call('zadd', prefix .. ':range:' .. ARGV[i], ARGV[i+2], uuid)
+    else
+        redis.call('zrem', prefix .. ':range:' .. ARGV[i], uuid)
+    end
+end
+
+-- Update prefix index sorted sets, members are the value and id separated by a null byte
+for i=beginlex,endoflex,4 do
+    local name = ARGV[i+1]
+    local oldval = idxval(oldvalue(name))
+    local newval = nil
+    if ARGV[i+2] == '1' then newval = ARGV[i+3] end
+    if (not old) or oldval ~= newval then
+        if oldval then
+            if ARGV[i] == '1' then oldval = string.lower(oldval) end
+            redis.call('zrem', prefix .. ':lex:' .. name, oldval .. '\0' .. uuid)
+        end
+        if newval then
+            if ARGV[i] == '1' then newval = string.lower(newval) end
+            redis.call('zadd', prefix .. ':lex:' .. name, 0, newval .. '\0' .. uuid)
+        end
+    end
+end
+if mode == 'json' then
+    redis.call('set', memberkey, data)
+else
+    if mode == 'hash' then
+        redis.call('del', memberkey)
+    end
+    for name, value in pairs(cjson.decode(data)) do
+        if value == cjson.null then
+            redis.call('hdel', memberkey, name)
+        else
+            redis.call('hset', memberkey, name, value)
+        end
+    end
+end
+redis.call('sadd', KEYS[2], uuid)
+if expireat ~= '' and not old then
+    redis.call('zadd', prefix .. ':expiry', expireat, uuid)
+end
+-- Returns the new version, patches increment it here while full documents carry it
+if versionfield ~= '' then
+    if mode == 'hashpatch' then
+        return redis.call('hincrby', memberkey, versionfield, 1)
+    end
+    return tonumber(expected) + 1
+end
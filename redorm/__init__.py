@@ -1,4 +1,6 @@
-from redorm.model import all_models, RedormBase, red
+from redorm.model import all_models, RedormBase, red, red_async
+from redorm.client import bind_database
+from redorm.session import Session
 from redorm.relationships import (
     many_to_many,
     many_to_one,
@@ -9,3 +11,4 @@ from redorm.relationships import (
 )
 from redorm.exceptions import InstanceNotFound, RedormException
 from redorm.types import Binary
+from redorm.instrumentation import OperationStats, add_listener, remove_listener, measure, assert_max_round_trips
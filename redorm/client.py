@@ -1,100 +1,1003 @@
+import asyncio
+import bisect
+import hashlib
+import random
+import time
 import warnings
 
 import redis
+import redis.asyncio
+import redis.asyncio.cluster
+import redis.asyncio.sentinel
+import redis.cluster
+import redis.sentinel
 import fakeredis
-from typing import Optional
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union, cast
 
 from redis.client import Script
-from redis.exceptions import NoScriptError
+from redis.commands import READ_COMMANDS
+from redis.commands.core import AsyncScript
+from redis.exceptions import NoScriptError, ResponseError
 
-from redorm.settings import REDORM_URL
+from redorm.instrumentation import instrument_client, instrument_pipeline, pipeline_args
+from redorm.settings import (
+    REDORM_URL,
+    REDORM_CLUSTER,
+    REDORM_READ_FROM,
+    REDORM_REPLICA_LAG,
+    REDORM_REPLICA_URLS,
+    REDORM_SENTINEL_SERVICE,
+    REDORM_SENTINELS,
+)
 
 GET_SET_INDIRECT = """
 local l = {}
 local keys = redis.call('smembers', KEYS[2])
 for _,k in ipairs(keys) do
-    table.insert(l, redis.call('get', KEYS[1] .. k))
+    if ARGV[1] == 'hash' then
+        table.insert(l, redis.call('hgetall', KEYS[1] .. k))
+    else
+        table.insert(l, redis.call('get', KEYS[1] .. k))
+    end
 end
 return l
 """
 
 GET_KEY_INDIRECT = """
-return {redis.call('get', redis.call('get', KEYS[1]))}
+local ref = redis.call('get', KEYS[2])
+if not ref then
+    return {}
+end
+if ARGV[1] == 'hash' then
+    return {redis.call('hgetall', KEYS[1] .. ref)}
+end
+return {redis.call('get', KEYS[1] .. ref)}
 """
 
-UNIQUE_SAVE = """
-local uniquecnt = ARGV[1]
-local uniquenullcnt = ARGV[2]
-local indexcnt = ARGV[3]
-local indexnullcnt = ARGV[4]
-local data = ARGV[5]
-local uuid = ARGV[6]
-local clsname = ARGV[7]
+# Prepended to the scripts that read stored documents. cjson and cmsgpack decode numbers to doubles, which can't hold
+# every integer, so long integers are read as the strings the client indexes them by.
+DECODE = """
+-- Mirrors redorm.plan.index_value so old values decoded here match the keys written by the client
+local function idxval(v)
+    local t = type(v)
+    if t == 'string' then
+        return v
+    elseif t == 'boolean' then
+        if v then return 'True' else return 'False' end
+    elseif t == 'number' then
+        return string.format('%.17g', v)
+    end
+    return nil
+end
 
-local beginunique = 8
+-- Decodes JSON with integers of 16 characters or more quoted, so they come back as exact strings
+local function jsondecode(text)
+    if not string.find(text, '%d%d%d%d%d%d%d%d%d%d%d%d%d%d%d') then
+        return cjson.decode(text)
+    end
+    local parts = {}
+    local copied = 1
+    local pos = 1
+    while true do
+        local start = string.find(text, '[%-%d"]', pos)
+        if not start then
+            break
+        elseif string.sub(text, start, start) == '"' then
+            -- Strings are skipped, stepping over escaped characters
+            local stop = string.find(text, '["\\\\]', start + 1)
+            while string.sub(text, stop, stop) ~= '"' do
+                stop = string.find(text, '["\\\\]', stop + 2)
+            end
+            pos = stop + 1
+        else
+            local _, stop = string.find(text, '^%-?%d+', start)
+            local after = string.sub(text, stop + 1, stop + 1)
+            if stop - start >= 15 and after ~= '.' and after ~= 'e' and after ~= 'E' then
+                table.insert(parts, string.sub(text, copied, start - 1))
+                table.insert(parts, '"' .. string.sub(text, start, stop) .. '"')
+                copied = stop + 1
+            end
+            pos = string.find(text, '[^%-%d%.eE+]', start) or #text + 1
+        end
+    end
+    table.insert(parts, string.sub(text, copied))
+    return cjson.decode(table.concat(parts))
+end
+
+-- Decodes msgpack, with the 64 bit integers at the top level of the document read again from its bytes as decimal
+-- strings
+local function msgpackdecode(data)
+    local doc = cmsgpack.unpack(data)
+    local pos = 1
+    local sizes = {1, 2, 4, 8, 16}
+    local function uint(n)
+        local v = 0
+        for k=pos,pos+n-1 do
+            v = v * 256 + string.byte(data, k)
+        end
+        pos = pos + n
+        return v
+    end
+    local function decimal(signed)
+        local bytes = {string.byte(data, pos, pos + 7)}
+        pos = pos + 8
+        local negative = signed and bytes[1] >= 0x80
+        if negative then
+            local carry = 1
+            for k=8,1,-1 do
+                local v = 255 - bytes[k] + carry
+                bytes[k] = v % 256
+                carry = math.floor(v / 256)
+            end
+        end
+        local digits = ''
+        repeat
+            local rest = 0
+            local more = false
+            for k=1,8 do
+                local v = rest * 256 + bytes[k]
+                bytes[k] = math.floor(v / 10)
+                rest = v % 10
+                more = more or bytes[k] > 0
+            end
+            digits = string.format('%d', rest) .. digits
+        until not more
+        if negative then
+            return '-' .. digits
+        end
+        return digits
+    end
+    -- Moves past count values
+    local function skip(count)
+        while count > 0 do
+            count = count - 1
+            local b = uint(1)
+            if b >= 0x80 and b <= 0x8f then
+                count = count + (b - 0x80) * 2
+            elseif b >= 0x90 and b <= 0x9f then
+                count = count + b - 0x90
+            elseif b >= 0xa0 and b <= 0xbf then
+                pos = pos + b - 0xa0
+            elseif b >= 0xc4 and b <= 0xc6 then
+                local len = uint(sizes[b - 0xc3])
+                pos = pos + len
+            elseif b >= 0xc7 and b <= 0xc9 then
+                local len = uint(sizes[b - 0xc6])
+                pos = pos + len + 1
+            elseif b == 0xca or b == 0xcb then
+                pos = pos + sizes[b - 0xc7]
+            elseif b >= 0xcc and b <= 0xd3 then
+                pos = pos + sizes[(b - 0xcc) % 4 + 1]
+            elseif b >= 0xd4 and b <= 0xd8 then
+                pos = pos + sizes[b - 0xd3] + 1
+            elseif b >= 0xd9 and b <= 0xdb then
+                local len = uint(sizes[b - 0xd8])
+                pos = pos + len
+            elseif b == 0xdc or b == 0xdd then
+                count = count + uint(sizes[b - 0xda])
+            elseif b == 0xde or b == 0xdf then
+                count = count + uint(sizes[b - 0xdc]) * 2
+            end
+        end
+    end
+
+    local b = uint(1)
+    local count = 0
+    if b >= 0x80 and b <= 0x8f then
+        count = b - 0x80
+    elseif b == 0xde or b == 0xdf then
+        count = uint(sizes[b - 0xdc])
+    end
+    for _=1,count do
+        local k = uint(1)
+        local len
+        if k >= 0xa0 and k <= 0xbf then
+            len = k - 0xa0
+        elseif k >= 0xd9 and k <= 0xdb then
+            len = uint(sizes[k - 0xd8])
+        else
+            return doc
+        end
+        local name = string.sub(data, pos, pos + len - 1)
+        pos = pos + len
+        local v = string.byte(data, pos)
+        if v == 0xcf or v == 0xd3 then
+            pos = pos + 1
+            doc[name] = decimal(v == 0xd3)
+        else
+            skip(1)
+        end
+    end
+    return doc
+end
+"""
+
+# Prepended to the scripts that check unique values. Expired instances keep their values until they're swept, so
+# their values are free to take once they're due.
+HOLDER = """
+-- The instance holding a unique value, nil if it's free as of now ('' when the model doesn't expire)
+local function holder(prefix, name, value, now)
+    local owner = redis.call('hget', prefix .. ':key:' .. name, value)
+    if owner and now ~= '' then
+        local expireat = redis.call('zscore', prefix .. ':expiry', owner)
+        if expireat and tonumber(expireat) <= tonumber(now) then
+            return nil
+        end
+    end
+    return owner
+end
+"""
+
+UNIQUE_SAVE = DECODE + HOLDER + """
+local data = ARGV[1]
+local uuid = ARGV[2]
+-- Key prefix of the model, hash tagged in cluster mode so every key derived from it shares the slot of KEYS
+local prefix = ARGV[3]
+local uniquecnt = tonumber(ARGV[4])
+local indexcnt = tonumber(ARGV[5])
+local rangecnt = tonumber(ARGV[6])
+local lexcnt = tonumber(ARGV[7])
+-- 'json' stores the document as a string, 'hash' replaces a hash of JSON encoded fields
+-- and 'hashpatch' only writes the fields in data
+local mode = ARGV[8]
+-- The version field if the model has one, and the version the stored document must be at ('' to skip the check)
+local versionfield = ARGV[9]
+local expected = ARGV[10]
+-- Unix time new instances expire at, '' if they don't, and the time now if the model expires
+local expireat = ARGV[11]
+local now = ARGV[12]
+local memberkey = KEYS[1]
+
+local old
+local olddoc = {}
+if mode == 'json' then
+    old = redis.call('get', memberkey)
+    if old and string.sub(old, 1, 1) == '{' then
+        olddoc = jsondecode(old)
+    elseif old then
+        olddoc = msgpackdecode(old)
+    end
+else
+    old = redis.call('exists', memberkey) == 1
+end
+
+local function oldvalue(name)
+    if mode == 'json' then
+        return olddoc[name]
+    end
+    local raw = redis.call('hget', memberkey, name)
+    if raw then
+        return jsondecode(raw)
+    end
+    return nil
+end
+
+if mode == 'hashpatch' and not old then
+    return redis.error_reply('Not Found')
+end
+if versionfield ~= '' and expected ~= '' and old then
+    if (tonumber(oldvalue(versionfield)) or 0) ~= tonumber(expected) then
+        return redis.error_reply('Version Conflict: ' .. versionfield)
+    end
+end
+
+-- Each field is a triple of field name, '1' if the new value is not null otherwise '0', new value.
+-- Prefix index fields are preceded by '1' when their values are case folded.
+local beginunique = 13
 local endofunique = beginunique+(uniquecnt*3)-1
--- Check uniqueness constraints, triples of field name, old value, new value
+local beginindex = endofunique + 1
+local endofindex = beginindex+(indexcnt*3)-1
+local beginrange = endofindex + 1
+local endofrange = beginrange+(rangecnt*3)-1
+local beginlex = endofrange + 1
+local endoflex = beginlex+(lexcnt*4)-1
+
+-- Check uniqueness constraints before writing anything
 for i=beginunique,endofunique,3 do
-     if redis.call('hexists', clsname .. ':key:' .. ARGV[i], ARGV[i+2]) == 1 then
-         return redis.error_reply('Unique Violation: ' .. ARGV[i])
-     end
+    if ARGV[i+1] == '1' and ARGV[i+2] ~= idxval(oldvalue(ARGV[i])) then
+        local owner = holder(prefix, ARGV[i], ARGV[i+2], now)
+        if owner and owner ~= uuid then
+            return redis.error_reply('Unique Violation: ' .. ARGV[i])
+        end
+    end
 end
 
 -- Update unique hash maps
 for i=beginunique,endofunique,3 do
-    redis.call('hdel', clsname .. ':key:' .. ARGV[i], ARGV[i+1])
-    redis.call('hset', clsname .. ':key:' .. ARGV[i], ARGV[i+2], uuid)
-    redis.call('srem', clsname .. ':keynull:' .. ARGV[i], uuid)
+    local oldval = idxval(oldvalue(ARGV[i]))
+    local newval = nil
+    if ARGV[i+1] == '1' then newval = ARGV[i+2] end
+    if (not old) or oldval ~= newval then
+        if oldval then
+            redis.call('hdel', prefix .. ':key:' .. ARGV[i], oldval)
+        end
+        if newval then
+            redis.call('hset', prefix .. ':key:' .. ARGV[i], newval, uuid)
+            redis.call('srem', prefix .. ':keynull:' .. ARGV[i], uuid)
+        else
+            redis.call('sadd', prefix .. ':keynull:' .. ARGV[i], uuid)
+        end
+    end
 end
 
-local beginuniquenull = endofunique + 1
-local endofuniquenull = beginuniquenull+(uniquenullcnt*2)-1
--- Update unique hash maps, pairs of field name, old value
-for i=beginuniquenull,endofuniquenull,2 do
-    redis.call('hdel', clsname .. ':key:' .. ARGV[i], ARGV[i+1])
-    redis.call('sadd', clsname .. ':keynull:' .. ARGV[i], uuid)
+-- Update index sets
+for i=beginindex,endofindex,3 do
+    local oldval = idxval(oldvalue(ARGV[i]))
+    local newval = nil
+    if ARGV[i+1] == '1' then newval = ARGV[i+2] end
+    if (not old) or oldval ~= newval then
+        if oldval then
+            redis.call('srem', prefix .. ':index:' .. ARGV[i] .. ':' .. oldval, uuid)
+        end
+        if newval then
+            redis.call('srem', prefix .. ':indexnull:' .. ARGV[i], uuid)
+            redis.call('sadd', prefix .. ':index:' .. ARGV[i] .. ':' .. newval, uuid)
+        else
+            redis.call('sadd', prefix .. ':indexnull:' .. ARGV[i], uuid)
+        end
+    end
 end
 
-local beginindex = endofuniquenull + 1
-local endofindex = beginindex+(indexcnt*3)-1
--- Update index sets, triples of field name, old value, new value
-for i=beginindex,endofindex,3 do
-    -- Remove from old index
-    redis.call('srem', clsname .. ':index:' .. ARGV[i] .. ':' .. ARGV[i+1], uuid)
-    -- Remove from old null index in case was null
-    redis.call('srem', clsname .. ':indexnull:' .. ARGV[i], uuid)
-    -- Add to new index
-    redis.call('sadd', clsname .. ':index:' .. ARGV[i] .. ':' .. ARGV[i+2], uuid)
-end
-
-local beginindexnull = endofindex + 1
-local endofindexnull = beginindexnull+(indexnullcnt*2)-1
--- Update unique hash maps, pairs of field name, old value
-for i=beginindexnull,endofindexnull,2 do
-    -- Remove from old index
-    redis.call('srem', clsname .. ':index:' .. ARGV[i] .. ':' .. ARGV[i+1], uuid)
-    -- Add to null index
-    redis.call('sadd', clsname .. ':indexnull:' .. ARGV[i], uuid)
-end
-redis.call('set', clsname .. ':member:' .. uuid, data)
-redis.call('sadd', clsname .. ':all', uuid)
+-- Update range index sorted sets, nulls are left out
+for i=beginrange,endofrange,3 do
+    if ARGV[i+1] == '1' then
+        redis.call('zadd', prefix .. ':range:' .. ARGV[i], ARGV[i+2], uuid)
+    else
+        redis.call('zrem', prefix .. ':range:' .. ARGV[i], uuid)
+    end
+end
+
+-- Update prefix index sorted sets, members are the value and id separated by a null byte
+for i=beginlex,endoflex,4 do
+    local name = ARGV[i+1]
+    local oldval = idxval(oldvalue(name))
+    local newval = nil
+    if ARGV[i+2] == '1' then newval = ARGV[i+3] end
+    if (not old) or oldval ~= newval then
+        if oldval then
+            if ARGV[i] == '1' then oldval = string.lower(oldval) end
+            redis.call('zrem', prefix .. ':lex:' .. name, oldval .. '\\0' .. uuid)
+        end
+        if newval then
+            if ARGV[i] == '1' then newval = string.lower(newval) end
+            redis.call('zadd', prefix .. ':lex:' .. name, 0, newval .. '\\0' .. uuid)
+        end
+    end
+end
+if mode == 'json' then
+    redis.call('set', memberkey, data)
+else
+    if mode == 'hash' then
+        redis.call('del', memberkey)
+    end
+    for name, value in pairs(cjson.decode(data)) do
+        if value == cjson.null then
+            redis.call('hdel', memberkey, name)
+        else
+            redis.call('hset', memberkey, name, value)
+        end
+    end
+end
+redis.call('sadd', KEYS[2], uuid)
+if expireat ~= '' and not old then
+    redis.call('zadd', prefix .. ':expiry', expireat, uuid)
+end
+-- Returns the new version, patches increment it here while full documents carry it
+if versionfield ~= '' then
+    if mode == 'hashpatch' then
+        return redis.call('hincrby', memberkey, versionfield, 1)
+    end
+    return tonumber(expected) + 1
+end
+"""
+
+DELETE = DECODE + """
+local uuid = ARGV[1]
+local prefix = ARGV[2]
+local storage = ARGV[3]
+local uniquecnt = tonumber(ARGV[4])
+local indexcnt = tonumber(ARGV[5])
+local rangecnt = tonumber(ARGV[6])
+local lexcnt = tonumber(ARGV[7])
+local memberkey = KEYS[1]
+
+-- Unique, index and range field names follow the counts, then '1' if case folded and the name of each prefix index
+local beginunique = 8
+local beginindex = beginunique + uniquecnt
+local beginrange = beginindex + indexcnt
+local beginlex = beginrange + rangecnt
+local beginrels = beginlex + (lexcnt * 2)
+local relcnt = tonumber(ARGV[beginrels])
+
+-- Sweeps pass the time they started, instances are only deleted if they had expired by then
+local due = ARGV[beginrels + (relcnt * 4) + 1]
+if due then
+    local expireat = redis.call('zscore', prefix .. ':expiry', uuid)
+    if not expireat or tonumber(expireat) > tonumber(due) then
+        return {0}
+    end
+end
+redis.call('zrem', prefix .. ':expiry', uuid)
+
+local doc = {}
+if storage == 'json' then
+    local raw = redis.call('get', memberkey)
+    if not raw then
+        return {0}
+    elseif string.sub(raw, 1, 1) == '{' then
+        doc = jsondecode(raw)
+    else
+        doc = msgpackdecode(raw)
+    end
+else
+    local raw = redis.call('hgetall', memberkey)
+    if #raw == 0 then
+        return {0}
+    end
+    for i=1,#raw,2 do
+        doc[raw[i]] = jsondecode(raw[i+1])
+    end
+end
+
+for i=beginunique,beginindex-1 do
+    local value = idxval(doc[ARGV[i]])
+    if not value then
+        redis.call('srem', prefix .. ':keynull:' .. ARGV[i], uuid)
+    elseif redis.call('hget', prefix .. ':key:' .. ARGV[i], value) == uuid then
+        redis.call('hdel', prefix .. ':key:' .. ARGV[i], value)
+    end
+end
+for i=beginindex,beginrange-1 do
+    local value = idxval(doc[ARGV[i]])
+    if value then
+        redis.call('srem', prefix .. ':index:' .. ARGV[i] .. ':' .. value, uuid)
+    else
+        redis.call('srem', prefix .. ':indexnull:' .. ARGV[i], uuid)
+    end
+end
+for i=beginrange,beginlex-1 do
+    redis.call('zrem', prefix .. ':range:' .. ARGV[i], uuid)
+end
+for i=beginlex,beginrels-1,2 do
+    local value = idxval(doc[ARGV[i+1]])
+    if value then
+        if ARGV[i] == '1' then value = string.lower(value) end
+        redis.call('zrem', prefix .. ':lex:' .. ARGV[i+1], value .. '\\0' .. uuid)
+    end
+end
+
+-- Each relationship is the key prefix of its entries, '1' if it's a set, the key prefix of the other end's entries if
+-- they're on this node otherwise '', and '1' if those are sets. The related ids are returned so the caller can clean up the other
+-- end when it's elsewhere.
+local removed = {1}
+for i=beginrels+1,beginrels+(relcnt*4),4 do
+    local key = ARGV[i] .. uuid
+    local related = {}
+    if ARGV[i+1] == '1' then
+        related = redis.call('smembers', key)
+    else
+        local ref = redis.call('get', key)
+        if ref then related = {ref} end
+    end
+    if ARGV[i+2] ~= '' then
+        for _,id in ipairs(related) do
+            if ARGV[i+3] == '1' then
+                redis.call('srem', ARGV[i+2] .. id, uuid)
+            elseif redis.call('get', ARGV[i+2] .. id) == uuid then
+                redis.call('del', ARGV[i+2] .. id)
+            end
+        end
+    end
+    redis.call('del', key)
+    table.insert(removed, related)
+end
+redis.call('del', memberkey)
+redis.call('srem', KEYS[2], uuid)
+return removed
+"""
+
+RELATE = """
+local uuid = ARGV[1]
+-- 'set' replaces the related ids with the given ones, 'add' and 'remove' change just those
+local mode = ARGV[2]
+local tomany = ARGV[3] == '1'
+-- The key prefix of the other end's entries if they're on this node otherwise '', and whether those are sets
+local backref = ARGV[4]
+local backrefmany = ARGV[5] == '1'
+local key = KEYS[1]
+
+-- With '1' the relationship is only written if the instance was saved, for a save queued in the same pipeline
+if ARGV[6] == '1' and redis.call('exists', KEYS[2]) == 0 then
+    return {{}, {}}
+end
+
+local old = {}
+if tomany then
+    for _,id in ipairs(redis.call('smembers', key)) do
+        old[id] = true
+    end
+else
+    local ref = redis.call('get', key)
+    if ref then
+        old[ref] = true
+    end
+end
+local given = {}
+for i=7,#ARGV do
+    given[ARGV[i]] = true
+end
+
+local added = {}
+local removed = {}
+for id in pairs(given) do
+    if mode == 'remove' then
+        if old[id] then table.insert(removed, id) end
+    elseif not old[id] then
+        table.insert(added, id)
+    end
+end
+if mode == 'set' then
+    for id in pairs(old) do
+        if not given[id] then table.insert(removed, id) end
+    end
+end
+if #added == 0 and #removed == 0 then
+    return {added, removed}
+end
+
+-- Large sets are changed in chunks to stay within Lua's argument limits
+local function each_chunk(command, ids)
+    for i=1,#ids,1000 do
+        redis.call(command, key, unpack(ids, i, math.min(i+999, #ids)))
+    end
+end
+
+if tomany then
+    each_chunk('srem', removed)
+    each_chunk('sadd', added)
+elseif #added > 0 then
+    redis.call('set', key, added[1])
+else
+    redis.call('del', key)
+end
+
+if backref ~= '' then
+    for _,id in ipairs(removed) do
+        if backrefmany then
+            redis.call('srem', backref .. id, uuid)
+        elseif redis.call('get', backref .. id) == uuid then
+            redis.call('del', backref .. id)
+        end
+    end
+    for _,id in ipairs(added) do
+        if backrefmany then
+            redis.call('sadd', backref .. id, uuid)
+        else
+            redis.call('set', backref .. id, uuid)
+        end
+    end
+end
+return {added, removed}
 """
 
+INCR = DECODE + HOLDER + """
+local uuid = ARGV[1]
+local prefix = ARGV[2]
+local field = ARGV[3]
+local amount = ARGV[4]
+-- 'int' or 'float'
+local kind = ARGV[5]
+-- 'unique', 'index' or '' for how the field is indexed, and '1' if it has a range index
+local index = ARGV[6]
+local ranged = ARGV[7] == '1'
+-- Bounds the new value must stay within, '' for none
+local minimum = ARGV[8]
+local maximum = ARGV[9]
+local versionfield = ARGV[10]
+-- The time now if the model expires, otherwise ''
+local now = ARGV[11]
+local memberkey = KEYS[1]
+
+if redis.call('exists', memberkey) == 0 then
+    return redis.error_reply('Not Found')
+end
+local raw = redis.call('hget', memberkey, field)
+local old = nil
+if raw then
+    old = tonumber(raw)
+end
+local new = (old or 0) + tonumber(amount)
+if (minimum ~= '' and new < tonumber(minimum)) or (maximum ~= '' and new > tonumber(maximum)) then
+    return redis.error_reply('Bounds Exceeded: ' .. field)
+end
+
+-- Index values of stored strings, integers are used as Redis writes them so they stay exact past 2^53
+local function indexed(value)
+    if kind == 'int' then
+        return value
+    end
+    return idxval(tonumber(value))
+end
+
+-- Redis does the arithmetic on the stored string, so integers stay exact
+local stored
+if kind == 'int' then
+    redis.call('hincrby', memberkey, field, amount)
+    stored = redis.call('hget', memberkey, field)
+else
+    stored = redis.call('hincrbyfloat', memberkey, field, amount)
+end
+new = tonumber(stored)
+
+if index == 'unique' then
+    local owner = holder(prefix, field, indexed(stored), now)
+    if owner and owner ~= uuid then
+        -- Nothing else has been written yet, so putting the field back undoes the increment
+        if raw then
+            redis.call('hset', memberkey, field, raw)
+        else
+            redis.call('hdel', memberkey, field)
+        end
+        return redis.error_reply('Unique Violation: ' .. field)
+    end
+    if old then
+        redis.call('hdel', prefix .. ':key:' .. field, indexed(raw))
+    else
+        redis.call('srem', prefix .. ':keynull:' .. field, uuid)
+    end
+    redis.call('hset', prefix .. ':key:' .. field, indexed(stored), uuid)
+elseif index == 'index' then
+    if old then
+        redis.call('srem', prefix .. ':index:' .. field .. ':' .. indexed(raw), uuid)
+    else
+        redis.call('srem', prefix .. ':indexnull:' .. field, uuid)
+    end
+    redis.call('sadd', prefix .. ':index:' .. field .. ':' .. indexed(stored), uuid)
+end
+if ranged then
+    redis.call('zadd', prefix .. ':range:' .. field, new, uuid)
+end
+local version = 0
+if versionfield ~= '' then
+    version = redis.call('hincrby', memberkey, versionfield, 1)
+end
+return {stored, version}
+"""
+
+EXPIRE = """
+local uuid = ARGV[1]
+local prefix = ARGV[2]
+-- Unix time the instance expires at, '' to keep it until it's deleted
+local expireat = ARGV[3]
+local memberkey = KEYS[1]
+
+if redis.call('exists', memberkey) == 0 then
+    return 0
+end
+if expireat == '' then
+    redis.call('zrem', prefix .. ':expiry', uuid)
+else
+    redis.call('zadd', prefix .. ':expiry', expireat, uuid)
+end
+return 1
+"""
+
+REINDEX = DECODE + HOLDER + """
+local prefix = ARGV[1]
+-- Stored instances are at this followed by their id
+local memberprefix = ARGV[2]
+local storage = ARGV[3]
+local uniquecnt = tonumber(ARGV[4])
+local indexcnt = tonumber(ARGV[5])
+local rangecnt = tonumber(ARGV[6])
+local lexcnt = tonumber(ARGV[7])
+-- The time now if the model expires, otherwise ''
+local now = ARGV[8]
+-- Unique, index and range field names follow, then '1' if case folded and the name of each prefix index, and then the
+-- ids of the batch
+local beginunique = 9
+local beginindex = beginunique + uniquecnt
+local beginrange = beginindex + indexcnt
+local beginlex = beginrange + rangecnt
+local beginids = beginlex + (lexcnt * 2)
+
+-- The stored fields of an instance, read the same way the save script reads old values
+local function load(uuid)
+    local memberkey = memberprefix .. uuid
+    if storage == 'json' then
+        local data = redis.call('get', memberkey)
+        if not data then
+            return nil
+        elseif string.sub(data, 1, 1) == '{' then
+            return jsondecode(data)
+        end
+        return msgpackdecode(data)
+    end
+    local fields = redis.call('hgetall', memberkey)
+    if #fields == 0 then
+        return nil
+    end
+    local doc = {}
+    for i=1,#fields,2 do
+        doc[fields[i]] = jsondecode(fields[i+1])
+    end
+    return doc
+end
+
+local fixed = 0
+local conflicts = {}
+for j=beginids,#ARGV do
+    local uuid = ARGV[j]
+    local doc = load(uuid)
+    if doc then
+        for i=beginunique,beginindex-1 do
+            local name = ARGV[i]
+            local value = idxval(doc[name])
+            if value then
+                local owner = holder(prefix, name, value, now)
+                if not owner then
+                    if redis.call('hget', prefix .. ':key:' .. name, value) ~= uuid then
+                        fixed = fixed + 1
+                    end
+                    redis.call('hset', prefix .. ':key:' .. name, value, uuid)
+                elseif owner ~= uuid then
+                    table.insert(conflicts, uuid)
+                    table.insert(conflicts, name)
+                    table.insert(conflicts, owner)
+                end
+                fixed = fixed + redis.call('srem', prefix .. ':keynull:' .. name, uuid)
+            else
+                fixed = fixed + redis.call('sadd', prefix .. ':keynull:' .. name, uuid)
+            end
+        end
+        for i=beginindex,beginrange-1 do
+            local name = ARGV[i]
+            local value = idxval(doc[name])
+            if value then
+                fixed = fixed + redis.call('sadd', prefix .. ':index:' .. name .. ':' .. value, uuid)
+                fixed = fixed + redis.call('srem', prefix .. ':indexnull:' .. name, uuid)
+            else
+                fixed = fixed + redis.call('sadd', prefix .. ':indexnull:' .. name, uuid)
+            end
+        end
+        for i=beginrange,beginlex-1 do
+            local name = ARGV[i]
+            local score = tonumber(doc[name])
+            if score then
+                local current = redis.call('zscore', prefix .. ':range:' .. name, uuid)
+                if tonumber(current) ~= score then
+                    redis.call('zadd', prefix .. ':range:' .. name, string.format('%.17g', score), uuid)
+                    fixed = fixed + 1
+                end
+            else
+                fixed = fixed + redis.call('zrem', prefix .. ':range:' .. name, uuid)
+            end
+        end
+        for i=beginlex,beginids-1,2 do
+            local name = ARGV[i+1]
+            local value = idxval(doc[name])
+            if value then
+                if ARGV[i] == '1' then value = string.lower(value) end
+                fixed = fixed + redis.call('zadd', prefix .. ':lex:' .. name, 0, value .. '\\0' .. uuid)
+            end
+        end
+        fixed = fixed + redis.call('sadd', KEYS[1], uuid)
+    end
+end
+return {fixed, conflicts}
+"""
+
+PRUNE = DECODE + """
+-- Stored instances are at this followed by their id
+local memberprefix = ARGV[1]
+local storage = ARGV[2]
+-- 'key', 'keynull', 'index', 'indexnull', 'range', 'lex', 'all' or 'expiry' for the structure KEYS[1] is
+local kind = ARGV[3]
+local name = ARGV[4]
+-- The value an index set is for, or '1' if a prefix index is case folded
+local indexed = ARGV[5]
+
+-- Whether the instance exists and the field value it has, read the same way the save script reads old values
+local function current(uuid)
+    local memberkey = memberprefix .. uuid
+    if storage == 'json' then
+        local data = redis.call('get', memberkey)
+        if not data then
+            return false, nil
+        elseif name == '' then
+            return true, nil
+        elseif string.sub(data, 1, 1) == '{' then
+            return true, jsondecode(data)[name]
+        end
+        return true, msgpackdecode(data)[name]
+    end
+    if redis.call('exists', memberkey) == 0 then
+        return false, nil
+    end
+    local raw = name ~= '' and redis.call('hget', memberkey, name)
+    if raw then
+        return true, jsondecode(raw)
+    end
+    return true, nil
+end
+
+-- Entries follow, values and ids for a unique hash, prefix index members and ids otherwise. Entries not matching
+-- the stored instance they point to are removed.
+local removed = 0
+local step = 1
+if kind == 'key' then
+    step = 2
+end
+for i=6,#ARGV,step do
+    local uuid = ARGV[i + step - 1]
+    if kind == 'lex' then
+        uuid = string.match(ARGV[i], '^.*%z(.*)$') or ''
+    end
+    local exists, value = current(uuid)
+    local valid = exists
+    if kind == 'lex' then
+        value = idxval(value)
+        if value and indexed == '1' then value = string.lower(value) end
+        valid = exists and value ~= nil and ARGV[i] == value .. '\\0' .. uuid
+    elseif kind == 'key' then
+        valid = exists and idxval(value) == ARGV[i]
+    elseif kind == 'index' then
+        valid = exists and idxval(value) == indexed
+    elseif kind == 'keynull' or kind == 'indexnull' then
+        valid = exists and idxval(value) == nil
+    elseif kind == 'range' then
+        valid = exists and tonumber(value) ~= nil
+    end
+    if not valid then
+        if kind == 'key' then
+            if redis.call('hget', KEYS[1], ARGV[i]) == uuid then
+                removed = removed + redis.call('hdel', KEYS[1], ARGV[i])
+            end
+        elseif kind == 'range' or kind == 'expiry' then
+            removed = removed + redis.call('zrem', KEYS[1], uuid)
+        elseif kind == 'lex' then
+            removed = removed + redis.call('zrem', KEYS[1], ARGV[i])
+        else
+            removed = removed + redis.call('srem', KEYS[1], uuid)
+        end
+    end
+end
+return removed
+"""
+
+
+def slot_groups(keys: Iterable[str]) -> List[List[str]]:
+    # Groups keys that can be used together in one multi-key command on a cluster
+    groups = defaultdict(list)
+    for key in keys:
+        groups[key_slot(key)].append(key)
+    return list(groups.values())
+
+
+def key_slot(key: str) -> int:
+    return redis.cluster.key_slot(key.encode("utf-8", "surrogateescape"))
+
+
+def sentinel_addresses(sentinels: Sequence[str]) -> List[Tuple[str, int]]:
+    addresses = []
+    for sentinel in sentinels:
+        host, _, port = sentinel.rpartition(":")
+        addresses.append((host, int(port)))
+    return addresses
+
 
-class RedormClient:
+# Shared between the sync and async fake clients so both see the same data
+fake_server = fakeredis.FakeServer()
+# Set while reads have to see the latest writes, see read_from_primary
+primary_reads: ContextVar[bool] = ContextVar("redorm_primary_reads", default=False)
+
+
+class ReadRouting:
+    # Picks the connection for reads. Reads go to a replica unless the policy says primary, the caller asked for the
+    # primary, or this process wrote within the last replica_lag seconds.
+    client: Union[redis.Redis, redis.asyncio.Redis]
+    replicas: List
+    read_from = REDORM_READ_FROM
+    replica_lag = REDORM_REPLICA_LAG
+    last_write = float("-inf")
+
+    @property
+    def reader(self):
+        if (
+            not self.replicas
+            or self.read_from == "primary"
+            or primary_reads.get()
+            or time.monotonic() - self.last_write < self.replica_lag
+        ):
+            return self.client
+        return random.choice(self.replicas)
+
+    def mark_write(self) -> None:
+        self.last_write = time.monotonic()
+
+    def track_writes(self, client) -> None:
+        # Whatever sends them, commands the primary gets that aren't reads mark a write. Pipelines mark theirs when
+        # they're executed.
+        execute_command = client.execute_command
+        if asyncio.iscoroutinefunction(execute_command):
+
+            async def async_marked(*args, **options):
+                try:
+                    return await execute_command(*args, **options)
+                finally:
+                    if str(args[0]).upper() not in READ_COMMANDS:
+                        self.mark_write()
+
+            client.execute_command = async_marked
+        else:
+
+            def marked(*args, **options):
+                try:
+                    return execute_command(*args, **options)
+                finally:
+                    if str(args[0]).upper() not in READ_COMMANDS:
+                        self.mark_write()
+
+            client.execute_command = marked
+
+    @contextmanager
+    def read_from_primary(self):
+        token = primary_reads.set(True)
+        try:
+            yield
+        finally:
+            primary_reads.reset(token)
+
+
+class RedormClient(ReadRouting):
     pool: redis.ConnectionPool
     client: redis.Redis
     get_set_indirect_script: Script
     get_key_indirect_script: Script
     unique_save_script: Script
+    delete_script: Script
+    relate_script: Script
+    incr_script: Script
 
-    def __init__(self, redorm_url=REDORM_URL):
-        self.server = None
-        self.bind(redorm_url)
+    def __init__(
+        self,
+        redorm_url=REDORM_URL,
+        cluster=REDORM_CLUSTER,
+        replica_urls=REDORM_REPLICA_URLS,
+        sentinels=REDORM_SENTINELS,
+        sentinel_service=REDORM_SENTINEL_SERVICE,
+        server=None,
+    ):
+        # The fake redis server used without a URL, the shared one unless given
+        self.server = server
+        self.bind(redorm_url, cluster, replica_urls, sentinels, sentinel_service)
 
-    def bind(self, url):
-        if url:
-            self.client = redis.Redis.from_url(url, decode_responses=True)
+    def bind(self, url, cluster=False, replica_urls=(), sentinels=(), sentinel_service=REDORM_SENTINEL_SERVICE):
+        # In cluster mode keys are hash tagged by model. Without a URL the fake redis keeps that key layout,
+        # but isn't actually clustered.
+        self.cluster = cluster
+        self.replicas = [
+            redis.Redis.from_url(replica_url, decode_responses=True, encoding_errors="surrogateescape")
+            for replica_url in replica_urls
+        ]
+        if sentinels:
+            sentinel = redis.sentinel.Sentinel(
+                sentinel_addresses(sentinels), decode_responses=True, encoding_errors="surrogateescape"
+            )
+            self.client = sentinel.master_for(sentinel_service)
+            # Balances reads over the replicas Sentinel knows about
+            self.replicas = [sentinel.slave_for(sentinel_service)]
+        elif url and cluster:
+            self.client = redis.cluster.RedisCluster.from_url(
+                url, decode_responses=True, encoding_errors="surrogateescape"
+            )
+        elif url:
+            self.client = redis.Redis.from_url(url, decode_responses=True, encoding_errors="surrogateescape")
         else:
             warnings.warn(
                 "Redorm was not provided a Redis URL and will fall back to the in-built incredibly slow fake redis. "
@@ -102,24 +1005,418 @@ class RedormClient:
                 RuntimeWarning,
             )
             # Fake redis for developement
-            self.client = fakeredis.FakeRedis(decode_responses=True)
+            self.client = fakeredis.FakeRedis(
+                server=self.server or fake_server, decode_responses=True, encoding_errors="surrogateescape"
+            )
+        for client in (self.client, *self.replicas):
+            instrument_client(client)
+        self.track_writes(self.client)
         self.setup_scripts()
 
     def setup_scripts(self):
-        self.get_key_indirect_script = self.client.register_script(GET_KEY_INDIRECT)
-        self.get_set_indirect_script = self.client.register_script(GET_SET_INDIRECT)
-        self.unique_save_script = self.client.register_script(UNIQUE_SAVE)
+        self.script_sources: Dict[str, str] = {}
+        self.scripts_loaded = False
+        self.get_key_indirect_script = self.register_script(GET_KEY_INDIRECT)
+        self.get_set_indirect_script = self.register_script(GET_SET_INDIRECT)
+        self.unique_save_script = self.register_script(UNIQUE_SAVE)
+        self.delete_script = self.register_script(DELETE)
+        self.relate_script = self.register_script(RELATE)
+        self.incr_script = self.register_script(INCR)
+        self.expire_script = self.register_script(EXPIRE)
+        self.reindex_script = self.register_script(REINDEX)
+        self.prune_script = self.register_script(PRUNE)
+
+    def register_script(self, source: str) -> Script:
+        script = self.client.register_script(source)
+        self.script_sources[script.sha] = source
+        return script
+
+    def load_scripts(self) -> None:
+        # Loaded once per client rather than checked before every pipeline, on every primary of a cluster
+        if self.scripts_loaded:
+            return
+        for client in (self.client, *self.replicas):
+            if self.cluster:
+                for source in self.script_sources.values():
+                    client.script_load(source)
+            else:
+                p = instrument_pipeline(client.pipeline(transaction=False))
+                for source in self.script_sources.values():
+                    p.script_load(source)
+                p.execute()
+        self.scripts_loaded = True
 
     def init_app(self, app):
         url = app.config.get("REDORM_URL")
-        if url:
-            self.bind(url)
+        sentinels = app.config.get("REDORM_SENTINELS", ())
+        if url or sentinels:
+            self.bind(
+                url,
+                app.config.get("REDORM_CLUSTER", False),
+                app.config.get("REDORM_REPLICA_URLS", ()),
+                sentinels,
+                app.config.get("REDORM_SENTINEL_SERVICE", REDORM_SENTINEL_SERVICE),
+            )
+
+    def pipeline(self, transaction=True, temporary=False):
+        # Cluster pipelines are split by node, so they can't be transactions. Pipelines that only write temporary keys
+        # don't change what replicas would return, so they don't mark a write.
+        return instrument_pipeline(self.scripted(self.client, transaction, writes=not temporary))
+
+    def read_pipeline(self, transaction=True):
+        # For pipelines that only read, served by a replica when the read policy allows
+        return instrument_pipeline(self.scripted(self.reader, transaction))
+
+    def scripted(self, target, transaction: bool, writes: bool = False):
+        # Runs the EVALSHAs queued by queue_evalsha, loading the scripts first if this client hasn't yet. Any the
+        # server has lost since, restarted or flushed, are run again with EVAL, which caches them again.
+        pipeline = target.pipeline(transaction=transaction and not self.cluster)
+        execute = pipeline.execute
+
+        def run(raise_on_error: bool = True):
+            try:
+                sent = pipeline_args(pipeline)
+                if not any(args[0] == "EVALSHA" for args in sent):
+                    return execute(raise_on_error=raise_on_error)
+                self.load_scripts()
+                results = execute(raise_on_error=False)
+                missing = [i for i, result in enumerate(results) if isinstance(result, NoScriptError)]
+                if missing:
+                    retry = instrument_pipeline(target.pipeline(transaction=False))
+                    for i in missing:
+                        retry.eval(self.script_sources[sent[i][1]], *sent[i][2:])
+                    for i, result in zip(missing, retry.execute(raise_on_error=False)):
+                        results[i] = result
+                return checked(results, raise_on_error)
+            finally:
+                if writes:
+                    self.mark_write()
+
+        pipeline.execute = run
+        return pipeline
+
+    def queue_evalsha(self, pipeline, script: Script, *args) -> None:
+        pipeline.evalsha(script.sha, *args)
+
+    def slot_groups(self, keys: Iterable[str]) -> List[List[str]]:
+        keys = list(keys)
+        if self.cluster:
+            return slot_groups(keys)
+        return [keys] if keys else []
+
+    def run_script(self, script: Script, *args):
+        # Marked as a write by the client, as every command that isn't a read is
+        try:
+            return self.client.evalsha(script.sha, *args)
+        except NoScriptError:
+            return self.client.eval(cast(str, script.script), *args)
 
     def unique_save(self, *args):
+        return self.run_script(self.unique_save_script, *args)
+
+    def delete_member(self, *args):
+        return self.run_script(self.delete_script, *args)
+
+    def relate(self, *args):
+        return self.run_script(self.relate_script, *args)
+
+    def incr(self, *args):
+        return self.run_script(self.incr_script, *args)
+
+    def expire(self, *args):
+        return self.run_script(self.expire_script, *args)
+
+    def reindex(self, *args):
+        return self.run_script(self.reindex_script, *args)
+
+    def prune(self, *args):
+        return self.run_script(self.prune_script, *args)
+
+
+class AsyncRedormClient(ReadRouting):
+    client: redis.asyncio.Redis
+    get_set_indirect_script: AsyncScript
+    get_key_indirect_script: AsyncScript
+    unique_save_script: AsyncScript
+    delete_script: AsyncScript
+    relate_script: AsyncScript
+    incr_script: AsyncScript
+
+    def __init__(
+        self,
+        redorm_url=REDORM_URL,
+        cluster=REDORM_CLUSTER,
+        replica_urls=REDORM_REPLICA_URLS,
+        sentinels=REDORM_SENTINELS,
+        sentinel_service=REDORM_SENTINEL_SERVICE,
+        server=None,
+    ):
+        self.server = server
+        self.bind(redorm_url, cluster, replica_urls, sentinels, sentinel_service)
+
+    def bind(self, url, cluster=False, replica_urls=(), sentinels=(), sentinel_service=REDORM_SENTINEL_SERVICE):
+        self.cluster = cluster
+        self.replicas = [
+            redis.asyncio.Redis.from_url(replica_url, decode_responses=True, encoding_errors="surrogateescape")
+            for replica_url in replica_urls
+        ]
+        if sentinels:
+            sentinel = redis.asyncio.sentinel.Sentinel(
+                sentinel_addresses(sentinels), decode_responses=True, encoding_errors="surrogateescape"
+            )
+            self.client = sentinel.master_for(sentinel_service)
+            self.replicas = [sentinel.slave_for(sentinel_service)]
+        elif url and cluster:
+            self.client = redis.asyncio.cluster.RedisCluster.from_url(
+                url, decode_responses=True, encoding_errors="surrogateescape"
+            )
+        elif url:
+            self.client = redis.asyncio.Redis.from_url(url, decode_responses=True, encoding_errors="surrogateescape")
+        else:
+            warnings.warn(
+                "Redorm was not provided a Redis URL and will fall back to the in-built incredibly slow fake redis. "
+                "Set REDORM_URL environment variable to fix.",
+                RuntimeWarning,
+            )
+            self.client = fakeredis.FakeAsyncRedis(
+                server=self.server or fake_server, decode_responses=True, encoding_errors="surrogateescape"
+            )
+        for client in (self.client, *self.replicas):
+            instrument_client(client)
+        self.track_writes(self.client)
+        self.setup_scripts()
+
+    def setup_scripts(self):
+        self.script_sources: Dict[str, str] = {}
+        self.scripts_loaded = False
+        self.get_key_indirect_script = self.register_script(GET_KEY_INDIRECT)
+        self.get_set_indirect_script = self.register_script(GET_SET_INDIRECT)
+        self.unique_save_script = self.register_script(UNIQUE_SAVE)
+        self.delete_script = self.register_script(DELETE)
+        self.relate_script = self.register_script(RELATE)
+        self.incr_script = self.register_script(INCR)
+        self.expire_script = self.register_script(EXPIRE)
+
+    def register_script(self, source: str) -> AsyncScript:
+        script = self.client.register_script(source)
+        self.script_sources[script.sha] = source
+        return script
+
+    def init_app(self, app):
+        url = app.config.get("REDORM_URL")
+        sentinels = app.config.get("REDORM_SENTINELS", ())
+        if url or sentinels:
+            self.bind(
+                url,
+                app.config.get("REDORM_CLUSTER", False),
+                app.config.get("REDORM_REPLICA_URLS", ()),
+                sentinels,
+                app.config.get("REDORM_SENTINEL_SERVICE", REDORM_SENTINEL_SERVICE),
+            )
+
+    def pipeline(self, transaction=True, temporary=False):
+        return instrument_pipeline(self.scripted(self.client, transaction, writes=not temporary))
+
+    def read_pipeline(self, transaction=True):
+        return instrument_pipeline(self.scripted(self.reader, transaction))
+
+    def scripted(self, target, transaction: bool, writes: bool = False):
+        pipeline = target.pipeline(transaction=transaction and not self.cluster)
+        execute = pipeline.execute
+
+        async def run(raise_on_error: bool = True):
+            try:
+                sent = pipeline_args(pipeline)
+                if not any(args[0] == "EVALSHA" for args in sent):
+                    return await execute(raise_on_error=raise_on_error)
+                await self.load_scripts()
+                results = await execute(raise_on_error=False)
+                missing = [i for i, result in enumerate(results) if isinstance(result, NoScriptError)]
+                if missing:
+                    retry = instrument_pipeline(target.pipeline(transaction=False))
+                    for i in missing:
+                        retry.eval(self.script_sources[sent[i][1]], *sent[i][2:])
+                    for i, result in zip(missing, await retry.execute(raise_on_error=False)):
+                        results[i] = result
+                return checked(results, raise_on_error)
+            finally:
+                if writes:
+                    self.mark_write()
+
+        pipeline.execute = run
+        return pipeline
+
+    def queue_evalsha(self, pipeline, script: AsyncScript, *args) -> None:
+        pipeline.evalsha(script.sha, *args)
+
+    async def load_scripts(self) -> None:
+        if self.scripts_loaded:
+            return
+        for client in (self.client, *self.replicas):
+            if self.cluster:
+                for source in self.script_sources.values():
+                    await client.script_load(source)
+            else:
+                p = instrument_pipeline(client.pipeline(transaction=False))
+                for source in self.script_sources.values():
+                    p.script_load(source)
+                await p.execute()
+        self.scripts_loaded = True
+
+    def slot_groups(self, keys: Iterable[str]) -> List[List[str]]:
+        keys = list(keys)
+        if self.cluster:
+            return slot_groups(keys)
+        return [keys] if keys else []
+
+    async def run_script(self, script: AsyncScript, *args):
         try:
-            return self.client.evalsha(self.unique_save_script.sha, *args)
+            return await self.client.evalsha(script.sha, *args)
         except NoScriptError:
-            return self.client.eval(UNIQUE_SAVE, *args)
+            return await self.client.eval(cast(str, script.script), *args)
+
+    async def unique_save(self, *args):
+        return await self.run_script(self.unique_save_script, *args)
+
+    async def delete_member(self, *args):
+        return await self.run_script(self.delete_script, *args)
+
+    async def relate(self, *args):
+        return await self.run_script(self.relate_script, *args)
+
+    async def incr(self, *args):
+        return await self.run_script(self.incr_script, *args)
+
+    async def expire(self, *args):
+        return await self.run_script(self.expire_script, *args)
+
+    async def close(self):
+        await self.client.aclose()
 
 
 red = RedormClient()
+red_async = AsyncRedormClient()
+
+
+def checked(results: List, raise_on_error: bool) -> List:
+    # Raises the first error of a pipeline's results, as execute(raise_on_error=True) does
+    if raise_on_error:
+        for result in results:
+            if isinstance(result, ResponseError):
+                raise result
+    return results
+
+
+def ring_hash(key: str) -> int:
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8", "surrogateescape"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    # Consistent hashing: every node owns many points on a ring and a key belongs to the node owning the next point,
+    # so adding a node only moves the keys landing on its points
+    points_per_node = 160
+
+    def __init__(self, names: Sequence[str]):
+        self.points = sorted(
+            (ring_hash(f"{name}#{i}"), node) for node, name in enumerate(names) for i in range(self.points_per_node)
+        )
+        self.hashes = [h for h, _ in self.points]
+
+    def node(self, key: str) -> int:
+        return self.points[bisect.bisect(self.hashes, ring_hash(key)) % len(self.points)][1]
+
+
+class Database:
+    # Where a group of models is stored. With several nodes each instance lives on one of them, picked by its id,
+    # along with its own entries in the model's indexes.
+    def __init__(self, clients: List[RedormClient], async_clients: List[AsyncRedormClient], names: Sequence[str]):
+        self.clients = clients
+        self.async_clients = async_clients
+        self.ring = HashRing(names) if len(clients) > 1 else None
+
+    @property
+    def sharded(self) -> bool:
+        return self.ring is not None
+
+    @property
+    def cluster(self) -> bool:
+        return self.clients[0].cluster
+
+    def node(self, instance_id: Optional[str] = None) -> int:
+        if self.ring is None:
+            return 0
+        if instance_id is None:
+            raise ValueError("A sharded database needs an instance id to pick a node")
+        return self.ring.node(instance_id)
+
+    def client(self, instance_id: Optional[str] = None) -> RedormClient:
+        return self.clients[self.node(instance_id)]
+
+    def aclient(self, instance_id: Optional[str] = None) -> AsyncRedormClient:
+        return self.async_clients[self.node(instance_id)]
+
+
+databases: Dict[str, Database] = {"default": Database([red], [red_async], ["default"])}
+
+
+def bind_database(name: str, *urls: str, cluster: bool = False) -> Database:
+    # Binds a named database, for models with `database = name` in their Meta. Given several URLs, instances are
+    # sharded over them by id. An empty URL is a fake redis of its own.
+    if not urls:
+        raise ValueError("A database needs at least one URL")
+    clients, async_clients = [], []
+    for url in urls:
+        server = None if url else fakeredis.FakeServer()
+        clients.append(RedormClient(url, cluster, (), (), REDORM_SENTINEL_SERVICE, server))
+        async_clients.append(AsyncRedormClient(url, cluster, (), (), REDORM_SENTINEL_SERVICE, server))
+    database = databases[name] = Database(clients, async_clients, [url or str(i) for i, url in enumerate(urls)])
+    return database
+
+
+def gather(calls: List[Callable[[], Any]]) -> List:
+    # Runs blocking calls to different nodes in parallel, the common single call runs inline
+    if len(calls) <= 1:
+        return [call() for call in calls]
+    # Each call runs in a copy of the caller's context, so read_from_primary() and measurements carry over
+    contexts = [copy_context() for _ in calls]
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        return list(executor.map(lambda context, call: context.run(call), contexts, calls))
+
+
+class PipelineGroup:
+    # One pipeline per node, for work spanning databases or shards. Nodes are picked by model and instance id.
+    def __init__(self, is_async: bool = False, read: bool = False, transaction: bool = True):
+        self.is_async = is_async
+        self.read = read
+        self.transaction = transaction
+        self.pipelines: Dict[Any, Any] = {}
+
+    def client(self, database: Database, instance_id: Optional[str] = None):
+        return database.aclient(instance_id) if self.is_async else database.client(instance_id)
+
+    def on(self, client):
+        pipeline = self.pipelines.get(client)
+        if pipeline is None:
+            if self.read:
+                pipeline = client.read_pipeline(transaction=self.transaction)
+            else:
+                pipeline = client.pipeline(transaction=self.transaction)
+            self.pipelines[client] = pipeline
+        return pipeline
+
+    def of(self, model, instance_id: Optional[str] = None):
+        return self.on(self.client(model._database(), instance_id))
+
+    def __len__(self) -> int:
+        return sum(len(pipeline) for pipeline in self.pipelines.values())
+
+    def execute(self, raise_on_error: bool = True) -> Dict[Any, List]:
+        pipelines = [(client, p) for client, p in self.pipelines.items() if len(p)]
+        results = gather([partial(p.execute, raise_on_error=raise_on_error) for _, p in pipelines])
+        return {client: result for (client, _), result in zip(pipelines, results)}
+
+    async def aexecute(self, raise_on_error: bool = True) -> Dict[Any, List]:
+        pipelines = [(client, p) for client, p in self.pipelines.items() if len(p)]
+        results = await asyncio.gather(*(p.execute(raise_on_error=raise_on_error) for _, p in pipelines))
+        return {client: result for (client, _), result in zip(pipelines, results)}
@@ -0,0 +1,102 @@
+import json
+from io import BytesIO
+from typing import Dict, List, Type, Union
+
+from redorm.settings import REDORM_CODEC
+
+__all__ = ["Codec", "JsonCodec", "OrjsonCodec", "MsgpackCodec", "get_codec", "register_codec"]
+
+
+class Codec:
+    # Turns an already encoded document (a dict of JSON compatible values) into the string stored in Redis and back
+    name: str
+
+    def dumps(self, document: dict) -> str:
+        raise NotImplementedError
+
+    def loads(self, payload: str) -> dict:
+        raise NotImplementedError
+
+    def loads_many(self, payloads: List[str]) -> List[dict]:
+        return [self.loads(payload) for payload in payloads]
+
+
+class JsonCodec(Codec):
+    name = "json"
+
+    def dumps(self, document: dict) -> str:
+        return json.dumps(document, sort_keys=True)
+
+    def loads(self, payload: str) -> dict:
+        return json.loads(payload)
+
+    def loads_many(self, payloads: List[str]) -> List[dict]:
+        # One parser call for the whole batch rather than one per document
+        return json.loads("[" + ",".join(payloads) + "]")
+
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def __init__(self):
+        try:
+            import orjson
+        except ImportError as e:
+            raise ImportError("The orjson codec requires orjson, install redorm[orjson]") from e
+        self.orjson = orjson
+
+    def dumps(self, document: dict) -> str:
+        return self.orjson.dumps(document, option=self.orjson.OPT_SORT_KEYS).decode("utf-8")
+
+    def loads(self, payload: str) -> dict:
+        return self.orjson.loads(payload)
+
+    def loads_many(self, payloads: List[str]) -> List[dict]:
+        return self.orjson.loads("[" + ",".join(payloads) + "]")
+
+
+class MsgpackCodec(Codec):
+    # Payloads are binary, the clients decode them with surrogateescape so they round trip through str.
+    # Documents written before switching codecs are still JSON, and are recognised by their leading brace.
+    name = "msgpack"
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError as e:
+            raise ImportError("The msgpack codec requires msgpack, install redorm[msgpack]") from e
+        self.msgpack = msgpack
+
+    def dumps(self, document: dict) -> str:
+        return self.msgpack.packb(document, use_bin_type=True).decode("utf-8", "surrogateescape")
+
+    def loads(self, payload: str) -> dict:
+        if payload.startswith("{"):
+            return json.loads(payload)
+        return self.msgpack.unpackb(payload.encode("utf-8", "surrogateescape"), raw=False)
+
+    def loads_many(self, payloads: List[str]) -> List[dict]:
+        if any(payload.startswith("{") for payload in payloads):
+            return [self.loads(payload) for payload in payloads]
+        packed = "".join(payloads).encode("utf-8", "surrogateescape")
+        return list(self.msgpack.Unpacker(BytesIO(packed), raw=False))
+
+
+codec_classes: Dict[str, Type[Codec]] = {"json": JsonCodec, "orjson": OrjsonCodec, "msgpack": MsgpackCodec}
+codecs: Dict[str, Codec] = {}
+
+
+def register_codec(codec_class: Type[Codec]) -> None:
+    codec_classes[codec_class.name] = codec_class
+    codecs.pop(codec_class.name, None)
+
+
+def get_codec(name: Union[str, Codec, None] = None) -> Codec:
+    if isinstance(name, Codec):
+        return name
+    name = name or REDORM_CODEC
+    if name not in codecs:
+        if name not in codec_classes:
+            raise ValueError(f"Unknown codec {name!r}, expected one of {sorted(codec_classes)}")
+        codecs[name] = codec_classes[name]()
+    return codecs[name]
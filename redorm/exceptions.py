@@ -10,6 +10,29 @@ class UniqueContstraintViolation(RedormException):
     pass
 
 
+class VersionConflict(RedormException):
+    pass
+
+
+class BoundsExceeded(RedormException):
+    pass
+
+
+class BulkWriteError(RedormException):
+    message = "{} rows couldn't be saved"
+
+    def __init__(self, errors, saved):
+        super().__init__(self.message.format(len(errors)))
+        # Maps the position of each failed row to its error, a unique violation or version conflict
+        self.errors = errors
+        self.saved = saved
+
+
+class BulkUniqueConstraintViolation(BulkWriteError, UniqueContstraintViolation):
+    # Raised when every failed row violated a unique constraint
+    message = "{} rows violated unique constraints"
+
+
 class UnknownFieldName(RedormException):
     pass
 
@@ -20,3 +43,7 @@ class FilterOnUnindexedField(RedormException):
 
 class MultipleInstancesReturned(RedormException):
     pass
+
+
+class UnknownDatabase(RedormException):
+    pass
@@ -0,0 +1,39 @@
+import os
+import string
+import time
+from typing import Callable, Dict
+from uuid import uuid4
+
+__all__ = ["ID_FORMATS", "uuid_id", "base62_id", "ulid_id"]
+
+BASE62 = string.digits + string.ascii_uppercase + string.ascii_lowercase
+# Crockford's base32, which ULIDs are written in
+BASE32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+
+def encode(number: int, alphabet: str, length: int) -> str:
+    # Fixed length, so ids in the same format sort as their numbers do
+    digits = []
+    for _ in range(length):
+        number, digit = divmod(number, len(alphabet))
+        digits.append(alphabet[digit])
+    return "".join(reversed(digits))
+
+
+def uuid_id() -> str:
+    return str(uuid4())
+
+
+def base62_id() -> str:
+    # The same 128 bits as a uuid in 22 characters rather than 36
+    return encode(uuid4().int, BASE62, 22)
+
+
+def ulid_id() -> str:
+    # A millisecond timestamp followed by 80 random bits in 26 characters, so ids sort in the order they were made
+    return encode((time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), "big"), BASE32, 26)
+
+
+# Formats generated by the client. Models can also use "int" ids, counted up in Redis, which sets of up to
+# set-max-intset-entries members store as compact intsets.
+ID_FORMATS: Dict[str, Callable[[], str]] = {"uuid": uuid_id, "base62": base62_id, "ulid": ulid_id}
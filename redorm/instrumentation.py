@@ -0,0 +1,218 @@
+import asyncio
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from functools import wraps
+from time import perf_counter
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from redorm.settings import REDORM_SLOW_OPERATION_MS
+
+__all__ = [
+    "OperationStats",
+    "add_listener",
+    "remove_listener",
+    "measure",
+    "assert_max_round_trips",
+    "logger",
+]
+
+logger = logging.getLogger("redorm")
+
+
+@dataclass
+class OperationStats:
+    model: str
+    operation: str
+    commands: int = 0
+    round_trips: int = 0
+    bytes_out: int = 0
+    bytes_in: int = 0
+    # Seconds
+    duration: float = 0.0
+
+
+listeners: List[Callable[[OperationStats], None]] = []
+# Operations taking longer than this many seconds are logged as warnings, None turns the log off
+slow_operation_threshold: Optional[float] = (
+    None if REDORM_SLOW_OPERATION_MS is None else REDORM_SLOW_OPERATION_MS / 1000
+)
+
+# Everything being measured in the current context, commands count towards all of them
+active: ContextVar[Tuple[OperationStats, ...]] = ContextVar("redorm_operations", default=())
+
+
+def add_listener(listener: Callable[[OperationStats], None]) -> None:
+    # Called with the stats of every model operation that isn't part of another one
+    listeners.append(listener)
+
+
+def remove_listener(listener: Callable[[OperationStats], None]) -> None:
+    listeners.remove(listener)
+
+
+@contextmanager
+def measure(model: str = "", operation: str = "") -> Iterator[OperationStats]:
+    stats = OperationStats(model, operation)
+    token = active.set(active.get() + (stats,))
+    start = perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.duration = perf_counter() - start
+        active.reset(token)
+
+
+@contextmanager
+def assert_max_round_trips(limit: int) -> Iterator[OperationStats]:
+    # For tests, fails if the block makes more than limit round trips to Redis
+    with measure() as stats:
+        yield stats
+    assert stats.round_trips <= limit, f"{stats.round_trips} round trips ({stats.commands} commands), expected {limit}"
+
+
+def report(stats: OperationStats) -> None:
+    for listener in listeners:
+        listener(stats)
+    if slow_operation_threshold is not None and stats.duration >= slow_operation_threshold:
+        logger.warning(
+            "Slow %s.%s took %.1fms: %d commands in %d round trips, %d bytes out, %d bytes in",
+            stats.model,
+            stats.operation,
+            stats.duration * 1000,
+            stats.commands,
+            stats.round_trips,
+            stats.bytes_out,
+            stats.bytes_in,
+        )
+
+
+def instrumented(operation: str):
+    # Measures a model method. Operations inside another one count towards it
+    # rather than being reported on their own, and nothing is measured without a listener or slow log.
+    def decorate(func):
+        def measuring() -> bool:
+            return bool(listeners or slow_operation_threshold is not None) and not active.get()
+
+        def model_name(owner) -> str:
+            # Called on a model, an instance or a QuerySet of a model
+            if not isinstance(owner, type):
+                model = vars(owner).get("model")
+                owner = model if isinstance(model, type) else type(owner)
+            return owner.__name__
+
+        if asyncio.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                # Model fields can be passed as keywords, so the model or instance is only taken positionally
+                if not measuring():
+                    return await func(*args, **kwargs)
+                with measure(model_name(args[0]), operation) as stats:
+                    result = await func(*args, **kwargs)
+                report(stats)
+                return result
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not measuring():
+                return func(*args, **kwargs)
+            with measure(model_name(args[0]), operation) as stats:
+                result = func(*args, **kwargs)
+            report(stats)
+            return result
+
+        return wrapper
+
+    return decorate
+
+
+def record(commands: int, round_trips: int, sent, received) -> None:
+    for stats in active.get():
+        stats.commands += commands
+        stats.round_trips += round_trips
+        stats.bytes_out += payload_size(sent)
+        stats.bytes_in += payload_size(received)
+
+
+def payload_size(value) -> int:
+    # Approximate size on the wire of command arguments or a reply
+    if value is None:
+        return 0
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8", "surrogateescape"))
+    if isinstance(value, dict):
+        return sum(payload_size(k) + payload_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sum(payload_size(v) for v in value)
+    return len(str(value))
+
+
+def instrument_client(client, method: str = "execute_command") -> None:
+    # Counts the commands a redis client sends while something is measured
+    execute_command = getattr(client, method)
+    if asyncio.iscoroutinefunction(execute_command):
+
+        async def async_counted(*args, **options):
+            if not active.get():
+                return await execute_command(*args, **options)
+            response = await execute_command(*args, **options)
+            record(1, 1, args, response)
+            return response
+
+        setattr(client, method, async_counted)
+    else:
+
+        def counted(*args, **options):
+            if not active.get():
+                return execute_command(*args, **options)
+            response = execute_command(*args, **options)
+            record(1, 1, args, response)
+            return response
+
+        setattr(client, method, counted)
+
+
+def instrument_pipeline(pipeline):
+    # A pipeline is one round trip per execute, whatever it holds, plus one for each command it sends immediately,
+    # such as WATCH or the SCRIPT EXISTS and SCRIPT LOAD redis-py sends before running scripts
+    execute = pipeline.execute
+    if hasattr(pipeline, "immediate_execute_command"):
+        instrument_client(pipeline, "immediate_execute_command")
+    if asyncio.iscoroutinefunction(execute):
+
+        async def async_counted(raise_on_error: bool = True):
+            if not active.get():
+                return await execute(raise_on_error=raise_on_error)
+            sent = pipeline_args(pipeline)
+            results = await execute(raise_on_error=raise_on_error)
+            record(len(sent), 1, sent, results)
+            return results
+
+        pipeline.execute = async_counted
+    else:
+
+        def counted(raise_on_error: bool = True):
+            if not active.get():
+                return execute(raise_on_error=raise_on_error)
+            sent = pipeline_args(pipeline)
+            results = execute(raise_on_error=raise_on_error)
+            record(len(sent), 1, sent, results)
+            return results
+
+        pipeline.execute = counted
+    return pipeline
+
+
+def pipeline_args(pipeline) -> List:
+    # Cluster pipelines queue command objects, the others (args, options) pairs. The async cluster pipeline keeps
+    # its queue in its execution strategy.
+    stack = getattr(pipeline, "command_stack", None)
+    if stack is None:
+        stack = getattr(getattr(pipeline, "_execution_strategy", None), "_command_queue", [])
+    return [command.args if hasattr(command, "args") else command[0] for command in stack]
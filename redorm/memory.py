@@ -0,0 +1,83 @@
+import random
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, List, Type
+
+from redorm.plan import ModelPlan
+
+if TYPE_CHECKING:
+    from redorm.model import RedormBase
+
+__all__ = ["MemoryReport", "memory_report"]
+
+
+@dataclass
+class MemoryReport:
+    model: str
+    instances: int = 0
+    # Bytes used by each kind of key, estimated from the MEMORY USAGE of samples
+    members: int = 0
+    # The ids, unique, index, range, prefix index and expiry keys
+    indexes: int = 0
+    relationships: int = 0
+    # Keys measured to make the estimates
+    sampled: int = 0
+
+    @property
+    def total(self) -> int:
+        return self.members + self.indexes + self.relationships
+
+    @property
+    def per_instance(self) -> float:
+        return self.total / self.instances if self.instances else 0.0
+
+
+def memory_report(model: "Type[RedormBase]", samples: int = 100) -> MemoryReport:
+    # Measures up to samples random instances on each node, with their relationship keys, and up to samples of the
+    # model's index sets, scaling them up to the number there are. Keys the model has one of are measured exactly.
+    plan = model._plan()
+    report = MemoryReport(model.__name__)
+    bases = [f"{plan.relationship_prefix}{name}:" for name, *_ in model._relationship_ends()]
+    fixed = fixed_keys(plan)
+    for client in model._database().clients:
+        p = client.read_pipeline(transaction=False)
+        p.scard(plan.all_key)
+        p.srandmember(plan.all_key, samples)
+        instances, ids = p.execute()
+        index_sets = list(client.reader.scan_iter(match=f"{plan.key_prefix}:index:*", count=1000))
+        measured = random.sample(index_sets, min(samples, len(index_sets)))
+        p = client.read_pipeline(transaction=False)
+        for key in fixed + measured:
+            p.memory_usage(key)
+        for instance_id in ids:
+            p.memory_usage(plan.member_key(instance_id))
+            for base in bases:
+                p.memory_usage(base + instance_id)
+        usage = [size or 0 for size in p.execute()] if len(p) else []
+        report.instances += instances
+        report.sampled += len(usage)
+        sets_end = len(fixed) + len(measured)
+        report.indexes += sum(usage[: len(fixed)]) + scaled(usage[len(fixed) : sets_end], len(index_sets))
+        per_id = usage[sets_end:]
+        step = 1 + len(bases)
+        report.members += scaled(per_id[::step], instances)
+        report.relationships += scaled([sum(per_id[i + 1 : i + step]) for i in range(0, len(per_id), step)], instances)
+    return report
+
+
+def fixed_keys(plan: ModelPlan) -> List[str]:
+    keys = [plan.all_key, plan.expiry_key, plan.id_counter_key]
+    for f in plan.field_list:
+        if f.unique:
+            keys.append(f.key)
+        if f.unique or f.index:
+            keys.append(f.null_key)
+        if f.range_index:
+            keys.append(f.range_key)
+        if f.prefix_index:
+            keys.append(f.lex_key)
+    return keys
+
+
+def scaled(sizes: List[int], count: int) -> int:
+    # The total size of count keys, from the sizes of a sample of them
+    return round(sum(sizes) / len(sizes) * count) if sizes else 0
@@ -0,0 +1,199 @@
+import argparse
+import importlib
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple, Type, cast
+
+from redorm.client import RedormClient
+from redorm.model import RedormBase
+from redorm.plan import ModelPlan
+
+__all__ = ["ReindexReport", "reindex"]
+
+# The index structures of a model, keyed by the part of their name after the model's key prefix
+STRUCTURES = ("key", "keynull", "index", "indexnull", "range", "lex")
+
+
+@dataclass
+class ReindexReport:
+    model: str
+    scanned: int = 0
+    # Entries added or corrected for stored instances
+    fixed: int = 0
+    # Entries removed for instances that are gone or no longer have the indexed value
+    removed: int = 0
+    # Instance id, field name and the id of the instance already holding its value
+    conflicts: List[Tuple[str, str, str]] = field(default_factory=list)
+    # Index keys of fields that aren't indexed that way any more
+    dropped: List[str] = field(default_factory=list)
+
+
+def reindex(
+    model: Type[RedormBase],
+    batch_size: int = 500,
+    pause: float = 0.0,
+    verify: bool = True,
+    drop: bool = True,
+    restart: bool = False,
+) -> ReindexReport:
+    # Brings a model's index entries in line with its stored instances, e.g. after a field becomes
+    # indexed. Works batch_size entries at a time with a short script each, sleeping pause seconds between batches,
+    # so it can run next to production traffic. Progress is kept in Redis and an interrupted run resumes from it.
+    plan = model._plan()
+    report = ReindexReport(model.__name__)
+    progress_key = f"{plan.key_prefix}:reindex"
+    names = [f.name for f in (*plan.unique, *plan.index, *plan.ranged)]
+    for f in plan.lexical:
+        names.extend(("1" if f.casefold else "0", f.name))
+    for client in model._database().clients:
+        if restart:
+            client.client.delete(progress_key)
+        for ids in scan_batches(client, progress_key, "backfill", plan.all_key, "all", batch_size, pause):
+            report.scanned += len(ids)
+            fixed, conflicts = client.reindex(
+                1,
+                plan.all_key,
+                plan.key_prefix,
+                plan.member_prefix,
+                plan.storage,
+                len(plan.unique),
+                len(plan.index),
+                len(plan.ranged),
+                len(plan.lexical),
+                repr(time.time()) if plan.expiring else "",
+                *names,
+                *ids,
+            )
+            report.fixed += fixed
+            report.conflicts.extend(zip(conflicts[::3], conflicts[1::3], conflicts[2::3]))
+        if verify or drop:
+            for key, kind, name, value in index_keys(client, plan):
+                if obsolete(plan, kind, name):
+                    if drop:
+                        client.client.unlink(key)
+                        report.dropped.append(key)
+                elif verify:
+                    if kind == "lex":
+                        value = "1" if plan.fields[name].casefold else "0"
+                    report.removed += prune(client, plan, progress_key, key, kind, name, value, batch_size, pause)
+        if verify:
+            report.removed += prune(client, plan, progress_key, plan.all_key, "all", "", "", batch_size, pause)
+            if plan.expiring:
+                report.removed += prune(
+                    client, plan, progress_key, plan.expiry_key, "expiry", "", "", batch_size, pause
+                )
+        client.client.delete(progress_key)
+    return report
+
+
+def prune(
+    client: RedormClient,
+    plan: ModelPlan,
+    progress_key: str,
+    key: str,
+    kind: str,
+    name: str,
+    value: str,
+    batch_size: int,
+    pause: float,
+) -> int:
+    removed = 0
+    for entries in scan_batches(client, progress_key, "verify", key, kind, batch_size, pause):
+        removed += client.prune(1, key, plan.member_prefix, plan.storage, kind, name, value, *entries)
+    return removed
+
+
+def scan_batches(
+    client: RedormClient, progress_key: str, stage: str, key: str, kind: str, batch_size: int, pause: float
+) -> Iterator[List[str]]:
+    # Entries of one index structure a batch at a time: ids, or values and ids for unique hashes. The cursor is
+    # saved once the caller is done with a batch.
+    progress = f"{stage}:{key}"
+    saved = client.client.hget(progress_key, progress)
+    if saved == "done":
+        return
+    cursor = int(saved or 0)
+    # Replies are decoded, so the entries are str
+    while True:
+        if kind == "key":
+            cursor, values = client.client.hscan(key, cursor, count=batch_size)
+            entries = [entry for pair in cast(Dict[str, str], values).items() for entry in pair]
+        elif kind in ("range", "lex", "expiry"):
+            cursor, scored = client.client.zscan(key, cursor, count=batch_size)
+            entries = [member for member, _ in cast(List[Tuple[str, float]], scored)]
+        else:
+            cursor, members = client.client.sscan(key, cursor, count=batch_size)
+            entries = cast(List[str], members)
+        if entries:
+            yield entries
+        client.client.hset(progress_key, progress, cursor or "done")
+        if not cursor:
+            return
+        if pause:
+            time.sleep(pause)
+
+
+def index_keys(client: RedormClient, plan: ModelPlan) -> Iterator[Tuple[str, str, str, str]]:
+    # Every unique, index, range and prefix index key of a model as (key, kind, field name, indexed value)
+    start = len(plan.key_prefix) + 1
+    for key in client.client.scan_iter(match=f"{plan.key_prefix}:[ikrl]*", count=1000):
+        kind, _, rest = key[start:].partition(":")
+        if kind not in STRUCTURES:
+            continue
+        name, _, value = rest.partition(":") if kind == "index" else (rest, "", "")
+        yield key, kind, name, value
+
+
+def obsolete(plan: ModelPlan, kind: str, name: str) -> bool:
+    f = plan.fields.get(name)
+    if f is None:
+        return True
+    if kind in ("key", "keynull"):
+        return not f.unique
+    if kind in ("index", "indexnull"):
+        return not f.index
+    if kind == "lex":
+        return not f.prefix_index
+    return not f.range_index
+
+
+def load_model(path: str) -> Type[RedormBase]:
+    module, _, name = path.rpartition(":") if ":" in path else path.rpartition(".")
+    return getattr(importlib.import_module(module), name)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m redorm.migrate", description="Backfills and verifies the indexes of stored instances"
+    )
+    parser.add_argument("models", nargs="+", help="models to reindex, as package.module:Model")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    parser.add_argument("--no-verify", action="store_true", help="only add missing entries")
+    parser.add_argument("--no-drop", action="store_true", help="keep the indexes of fields no longer indexed")
+    parser.add_argument("--restart", action="store_true", help="start over instead of resuming an earlier run")
+    args = parser.parse_args(argv)
+
+    conflicted = False
+    for path in args.models:
+        report = reindex(
+            load_model(path),
+            batch_size=args.batch_size,
+            pause=args.pause,
+            verify=not args.no_verify,
+            drop=not args.no_drop,
+            restart=args.restart,
+        )
+        print(
+            f"{report.model}: scanned {report.scanned}, fixed {report.fixed}, removed {report.removed}, "
+            f"dropped {len(report.dropped)} keys"
+        )
+        for instance_id, name, owner in report.conflicts:
+            conflicted = True
+            print(f"{report.model} {instance_id}: {name} is already taken by {owner}", file=sys.stderr)
+    return 1 if conflicted else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,10 @@
+import asyncio
 import json
-from collections import OrderedDict, namedtuple
-from dataclasses import dataclass, field, fields, Field
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import partial
 from typing import (
     List,
     Type,
@@ -9,180 +13,905 @@ from typing import (
     ClassVar,
     Callable,
     Optional,
+    Tuple,
+    Iterator,
+    AsyncIterator,
+    Iterable,
+    Dict,
+    Union,
+    Sequence,
+    cast,
+    Any,
 )
 from uuid import uuid4
 
+if sys.version_info >= (3, 8):
+    from typing import Protocol, runtime_checkable
+else:
+    # Installed along with redis on Python 3.7
+    from typing_extensions import Protocol, runtime_checkable
+
 from dataclasses_jsonschema import JsonSchemaMixin
 from redis import ResponseError
 from redis.lock import Lock
 
-from redorm.client import red
+from redorm.client import Database, PipelineGroup, databases, gather, red, red_async
+from redorm.ids import ID_FORMATS
+from redorm.memory import MemoryReport, memory_report
+from redorm.instrumentation import instrumented, logger
+from redorm.plan import FieldPlan, ModelPlan, LEX_LOOKUPS, index_value, lex_ids
+from redorm.queryset import QuerySet, RANGE_LOOKUPS, TEMP_KEY_TTL
+from redorm.session import current_session
+from redorm.settings import REDORM_SWEEP_INTERVAL
 from redorm.exceptions import (
     InstanceNotFound,
     UniqueContstraintViolation,
+    BulkUniqueConstraintViolation,
+    BulkWriteError,
     UnknownFieldName,
     FilterOnUnindexedField,
     MultipleInstancesReturned,
+    RedormException,
+    UnknownDatabase,
+    VersionConflict,
+    BoundsExceeded,
 )
 
 S = TypeVar("S", bound="RedormBase")
 
-all_models = dict()
-FieldChange = namedtuple("FieldChange", ["name", "old", "new"])
+all_models: Dict[str, Type["RedormBase"]] = dict()
+BULK_BATCH_SIZE = 1000
+# Attempts update() makes on a versioned model before giving up to conflicting writers
+VERSION_RETRIES = 10
+# Seconds between the sweeps that creating instances of an expiring model runs, 0 turns them off
+sweep_interval: float = REDORM_SWEEP_INTERVAL
+# When this process last swept each expiring model
+last_sweeps: Dict[str, float] = {}
+# Expired instances a create deletes at most when it sweeps, so sweeping adds a bounded amount to creates
+SWEEP_BATCH_SIZE = 100
 
 
 class Query:
     pipeline_results: Optional[List]
+    is_async = False
 
     def __init__(self):
         self.results = []
         self.pipeline_results = None
-        self.resolvers: List[Callable[["Query"], S]] = []
-        self.pipeline = red.client.pipeline()
+        # Reads are queued on the pipeline of the node holding each instance
+        self.pipelines = PipelineGroup(is_async=self.is_async, read=True)
+        self.resolvers: List[Tuple[object, Callable[["Query"], S]]] = []
+        # Pipeline positions of stored documents, by node and model, so they can be decoded in one batch
+        self.documents: Dict[Tuple[object, Type["RedormBase"]], List[int]] = {}
+        self.client = None
+        self.pipeline = None
+
+    def use(self, cls: Type["RedormBase"], instance_id: str) -> None:
+        # Selects the node and pipeline the following reads of an instance are queued on
+        self.client = self.pipelines.client(cls._database(), instance_id)
+        self.pipeline = self.pipelines.on(self.client)
+
+    def queue_document(self, cls: Type["RedormBase"]) -> None:
+        self.documents.setdefault((self.client, cls), []).append(len(self.pipeline) - 1)
+
+    def add_resolver(self, resolver: Callable[["Query"], S]) -> None:
+        self.resolvers.append((self.client, resolver))
 
     def execute(self) -> List:
-        self.pipeline_results: List = self.pipeline.execute()
-        results: List = []
+        return self._resolve_all(self.pipelines.execute())
+
+    def _decode_documents(self, results: Dict[object, List]) -> None:
+        for (client, cls), positions in self.documents.items():
+            pipeline_results = results[client]
+            present = [i for i in positions if pipeline_results[i] is not None]
+            decoded = cls._plan().codec.loads_many([pipeline_results[i] for i in present]) if present else []
+            for i, document in zip(present, decoded):
+                pipeline_results[i] = document
+
+    def _resolve_all(self, results: Dict[object, List]) -> List:
+        self._decode_documents(results)
+        resolved: List = []
         while self.resolvers:
-            resolver = self.resolvers.pop()
+            client, resolver = self.resolvers.pop()
+            # Each resolver pops its own results off the end of its node's results
+            self.pipeline_results = results[client]
             try:
-                results.append(resolver(self))
+                resolved.append(resolver(self))
             except InstanceNotFound:
                 pass
-        return list(reversed(results))
+        return list(reversed(resolved))
+
+
+class AsyncQuery(Query):
+    is_async = True
+
+    async def execute(self) -> List:  # type: ignore[override]
+        return self._resolve_all(await self.pipelines.aexecute())
+
+
+class DeferredDefault:
+    # Stands in for a field's class level default on a model's projection, so a projected instance loads the real
+    # value on access. Non-data descriptor, so values already loaded are read straight from the instance's __dict__.
+    def __init__(self, name: str, default):
+        self.name = name
+        self.default = default
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self.default
+        return instance.__getattr__(self.name)
+
+
+def projected_eq(self, other) -> bool:
+    # Projected instances compare as the instances of the model they become once their fields are loaded
+    self._load_deferred()
+    if isinstance(other, RedormBase):
+        other._load_deferred()
+    return self == other
+
+
+class InstanceOrIdMethod:
+    # A method called on an instance, or on the model with an instance id in the instance's place
+    def __init__(self, func: Callable):
+        self.func = func
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return partial(self.func, owner)
+        return partial(self.func, owner, instance)
 
 
 @dataclass
 class RedormBase(JsonSchemaMixin):
     id: str = field(metadata={"unique": True})
     _relationships: ClassVar = OrderedDict()
+    _compiled_plan: ClassVar[ModelPlan]
+    _projection_class: ClassVar[type]
 
     @classmethod
+    @instrumented("get")
     def get(cls: Type[S], instance_id=None, **kwargs) -> S:
-        if instance_id is not None and len(kwargs) == 0:
+        if instance_id is None or len(kwargs) > 0:
+            instance_id = cls._single_id(cls._list_ids(**cls._get_filters(instance_id, kwargs)))
+        session = current_session.get()
+        tracked = None if session is None else session.lookup(cls, instance_id)
+        if tracked is not None:
+            return tracked
+        if cls._eager_prefetch(None):
+            # get_bulk prefetches eager relationships from their own slots or nodes
+            res = cls.get_bulk({instance_id})
+        else:
             query = Query()
             cls._get(query, instance_id)
             res = query.execute()
-            if res:
-                return res[0]
-            else:
-                raise InstanceNotFound
+        if res:
+            return res[0] if session is None else session.track(res[0])
         else:
-            if instance_id is None:
-                if kwargs:
-                    instance_ids = cls._list_ids(**kwargs)
-                else:
-                    raise InstanceNotFound
-            else:
-                instance_ids = cls._list_ids(id=instance_id, **kwargs)
+            raise InstanceNotFound
 
-            if len(instance_ids) == 1:
-                instance_id = instance_ids.pop()
-                query = Query()
-                cls._get(query, instance_id)
-                return query.execute()[0]
-            elif len(instance_ids) > 1:
-                raise MultipleInstancesReturned
-            else:
+    @classmethod
+    @instrumented("aget")
+    async def aget(cls: Type[S], instance_id=None, **kwargs) -> S:
+        if instance_id is None or len(kwargs) > 0:
+            instance_id = cls._single_id(await cls._alist_ids(**cls._get_filters(instance_id, kwargs)))
+        session = current_session.get()
+        tracked = None if session is None else session.lookup(cls, instance_id)
+        if tracked is not None:
+            return tracked
+        if cls._eager_prefetch(None):
+            res = await cls.aget_bulk({instance_id})
+        else:
+            query = AsyncQuery()
+            cls._get(query, instance_id)
+            res = await query.execute()
+        if res:
+            return res[0] if session is None else session.track(res[0])
+        else:
+            raise InstanceNotFound
+
+    @staticmethod
+    def _get_filters(instance_id, kwargs) -> dict:
+        if instance_id is None:
+            if not kwargs:
                 raise InstanceNotFound
+            return kwargs
+        return dict(id=instance_id, **kwargs)
+
+    @staticmethod
+    def _single_id(instance_ids: Set[str]) -> str:
+        if len(instance_ids) == 1:
+            return instance_ids.pop()
+        elif len(instance_ids) > 1:
+            raise MultipleInstancesReturned
+        else:
+            raise InstanceNotFound
 
     @classmethod
-    def _resolve(cls: Type[S], query: Query) -> S:
+    def _resolve(cls: Type[S], query: Query, only: Optional[List[str]] = None) -> S:
         assert query.pipeline_results is not None
+        related: Dict[str, dict] = {}
         for rel_name, relation in reversed(cls._relationships.items()):
-            relation.cached_ref = query.pipeline_results.pop()
-            if not relation.lazy:
+            related[rel_name] = {"ref": query.pipeline_results.pop()}
+            if cls._scripted_eager(relation):
                 res = query.pipeline_results.pop()
-                if res is None:
-                    relation.cached_class = None
-                elif isinstance(res, list):
-                    relation.cached_class = [
-                        relation.get_foreign_type().from_json(d, validate=False) for d in res if d is not None
-                    ]
+                loaded = relation.get_foreign_type()._from_members([d for d in res if d])
+                if relation.to_many:
+                    related[rel_name]["loaded"] = loaded
                 else:
-                    relation.cached_class = relation.get_foreign_type().from_json(res, validate=False)
+                    related[rel_name]["loaded"] = loaded[0] if loaded else None
         data = query.pipeline_results.pop()
-        if data is None:
-            print(
-                f"None for data, class={cls.__name__!r}, query.pipeline_results={query.pipeline_results!r}, query.resolvers={query.resolvers!r}"
-            )
+        if only is not None:
+            data = dict(zip(only, data)) if data[0] is not None else None
+        if cls._plan().expiring and cls._expired(query.pipeline_results.pop()):
+            data = None
+        if not data:
+            logger.debug("No data for %s, remaining results %r", cls.__name__, query.pipeline_results)
             raise InstanceNotFound
-        return cls.from_json(data, validate=False)
+        instance = cls._from_member(data) if only is None else cls._from_fields(data)
+        instance.__dict__["_related"] = related
+        return instance
 
     @classmethod
-    def _get(cls: Type[S], query: Query, instance_id: str):
-        query.pipeline.get(f"{cls.__name__}:member:{instance_id}")
+    def _plan(cls) -> ModelPlan:
+        plan = cls.__dict__.get("_compiled_plan")
+        database = cls._database()
+        cluster, sharded = database.cluster, database.sharded
+        if plan is None or plan.hash_tags != cluster or plan.sharded != sharded:
+            plan = cls._compiled_plan = ModelPlan(cls, cluster, sharded)
+        return plan
+
+    @classmethod
+    def _database(cls) -> Database:
+        name = getattr(getattr(cls, "Meta", None), "database", "default")
+        try:
+            return databases[name]
+        except KeyError:
+            raise UnknownDatabase(f"{cls.__name__} is stored in database {name!r}, which isn't bound") from None
+
+    @classmethod
+    def _client(cls, instance_id: Optional[str] = None):
+        # The node holding an instance, its model's only node unless the database is sharded
+        return cls._database().client(instance_id)
+
+    @classmethod
+    def _aclient(cls, instance_id: Optional[str] = None):
+        return cls._database().aclient(instance_id)
+
+    def _to_document(self, names: Optional[Set[str]] = None) -> dict:
+        return self._plan().encode(self, names)
+
+    @classmethod
+    def _from_document(cls: Type[S], document: dict) -> S:
+        return cls(**cls._plan().decode(document))
+
+    @classmethod
+    def _from_member(cls: Type[S], data: Union[str, dict, list]) -> S:
+        # Decodes a stored document, a HGETALL reply, or a flat field/value list from a script
+        plan = cls._plan()
+        if plan.storage == "json":
+            return cls._from_document(data if isinstance(data, dict) else plan.codec.loads(cast(str, data)))
+        if isinstance(data, list):
+            data = dict(zip(data[::2], data[1::2]))
+        return cls._from_document({k: json.loads(v) for k, v in cast(dict, data).items()})
+
+    @classmethod
+    def _from_members(cls: Type[S], members: List) -> List[S]:
+        plan = cls._plan()
+        if plan.storage == "json":
+            return [cls._from_document(document) for document in plan.codec.loads_many(members)] if members else []
+        return [cls._from_member(member) for member in members]
+
+    @classmethod
+    def _from_fields(cls: Type[S], data: Dict[str, Optional[str]]) -> S:
+        # Builds an instance holding only the given hash fields, the rest are loaded on first access
+        plan = cls._plan()
+        projection = cls._projected_class()
+        instance = projection.__new__(projection)
+        instance.__dict__.update(cls._decode_fields(data.keys(), data.values()))
+        instance.__dict__["_deferred"] = plan.field_names - set(data)
+        return instance
+
+    @classmethod
+    def _projected_class(cls: Type[S]) -> Type[S]:
+        # Projected instances are of a subclass whose class level defaults load the deferred fields, so the model's
+        # own attributes are left alone. Once their fields are loaded they're instances of the model again.
+        projection = cls.__dict__.get("_projection_class")
+        if projection is None:
+            namespace: Dict[str, Any] = {
+                name: DeferredDefault(name, cls.__dict__[name]) for name in cls._plan().fields if name in cls.__dict__
+            }
+            namespace.update(
+                __module__=cls.__module__,
+                __qualname__=cls.__qualname__,
+                __eq__=projected_eq,
+                __hash__=cls.__hash__,
+                _projected_from=cls,
+            )
+            projection = cls._projection_class = type(cls.__name__, (cls,), namespace)
+        return projection
+
+    def __getattr__(self, name):
+        deferred = self.__dict__.get("_deferred")
+        if not deferred or name not in deferred:
+            raise AttributeError(name)
+        self._load_deferred()
+        return self.__dict__[name]
+
+    def _load_deferred(self) -> None:
+        deferred = self.__dict__.get("_deferred")
+        if deferred:
+            names = sorted(deferred)
+            raw_values = self._client(self.id).reader.hmget(self._member_key(), names)
+            self.__dict__.update(self._decode_fields(names, raw_values))
+        self._fully_loaded()
+
+    def _fully_loaded(self) -> None:
+        self.__dict__.pop("_deferred", None)
+        self.__class__ = self.__class__.__dict__.get("_projected_from", self.__class__)
+
+    @classmethod
+    def _decode_fields(cls, names: Iterable[str], raw_values: Iterable[Optional[str]]) -> dict:
+        plan_fields = cls._plan().fields
+        return {
+            name: None if raw is None else plan_fields[name].decode_value(json.loads(raw))
+            for name, raw in zip(names, raw_values)
+        }
+
+    def _member_key(self) -> str:
+        return self._plan().member_prefix + self.id
+
+    @classmethod
+    def _get(cls: Type[S], query: Query, instance_id: str, only: Optional[List[str]] = None):
+        plan = cls._plan()
+        member_key = plan.member_prefix + instance_id
+        query.use(cls, instance_id)
+        if plan.expiring:
+            query.pipeline.zscore(plan.expiry_key, instance_id)
+        if plan.storage == "json":
+            if only is not None:
+                raise NotImplementedError("Field projections require the hash storage layout")
+            query.pipeline.get(member_key)
+            query.queue_document(cls)
+        elif only is not None:
+            query.pipeline.hmget(member_key, only)
+        else:
+            query.pipeline.hgetall(member_key)
         for rel_name, relation in cls._relationships.items():
-            rel_key = f"{cls.__name__}:relationship:{rel_name}:{instance_id}"
-            if not relation.lazy:
-                if relation.to_many:
-                    query.pipeline.evalsha(
-                        red.get_set_indirect_script.sha,
-                        2,
-                        f"{relation.get_foreign_type().__name__}:member:",
-                        rel_key,
-                    )
-                else:
-                    query.pipeline.evalsha(
-                        red.get_key_indirect_script.sha,
-                        1,
-                        rel_key,
-                    )
+            rel_key = relation.key(instance_id)
+            if cls._scripted_eager(relation):
+                foreign_plan = relation.get_foreign_type()._plan()
+                script = (
+                    query.client.get_set_indirect_script if relation.to_many else query.client.get_key_indirect_script
+                )
+                query.client.queue_evalsha(
+                    query.pipeline, script, 2, foreign_plan.member_prefix, rel_key, foreign_plan.storage
+                )
             if relation.to_many:
                 query.pipeline.smembers(rel_key)
             else:
                 query.pipeline.get(rel_key)
 
-        query.resolvers.append(cls._resolve)
+        if only is None:
+            query.add_resolver(cls._resolve)
+        else:
+            query.add_resolver(lambda q: cls._resolve(q, only))
 
     @classmethod
-    def get_bulk(cls: Type[S], instance_ids: Set[str]) -> List[S]:
+    @instrumented("get_bulk")
+    def get_bulk(
+        cls: Type[S], instance_ids: Set[str], prefetch: Optional[List[str]] = None, only: Optional[List[str]] = None
+    ) -> List[S]:
         if len(instance_ids) == 0:
             return []
+        only = cls._projection(only)
+        session = current_session.get()
+        found, missing = ([], instance_ids) if session is None else session.partition(cls, instance_ids)
         query = Query()
-        for instance_id in instance_ids:
-            cls._get(query, instance_id)
-        return query.execute()
+        for instance_id in missing:
+            cls._get(query, instance_id, only)
+        instances = found + cls._tracked(query.execute() if missing else [])
+        prefetch = cls._eager_prefetch(prefetch)
+        if prefetch:
+            level = cls._prefetch_level(instances, prefetch)
+            while level:
+                query = Query()
+                cls._queue_prefetch(query, level)
+                level = cls._apply_prefetch(level, query.execute())
+        return instances
 
     @classmethod
-    def create(cls: Type[S], **kwargs) -> S:
+    @instrumented("aget_bulk")
+    async def aget_bulk(
+        cls: Type[S], instance_ids: Set[str], prefetch: Optional[List[str]] = None, only: Optional[List[str]] = None
+    ) -> List[S]:
+        if len(instance_ids) == 0:
+            return []
+        only = cls._projection(only)
+        session = current_session.get()
+        found, missing = ([], instance_ids) if session is None else session.partition(cls, instance_ids)
+        query = AsyncQuery()
+        for instance_id in missing:
+            cls._get(query, instance_id, only)
+        instances = found + cls._tracked(await query.execute() if missing else [])
+        prefetch = cls._eager_prefetch(prefetch)
+        if prefetch:
+            level = cls._prefetch_level(instances, prefetch)
+            while level:
+                query = AsyncQuery()
+                cls._queue_prefetch(query, level)
+                level = cls._apply_prefetch(level, await query.execute())
+        return instances
+
+    @classmethod
+    def _scripted_eager(cls, relation: "IRelationship") -> bool:
+        # Eager relationships are read by a script alongside the instance when the related members are on the same
+        # node. On a cluster they live in another slot, and with databases or shards possibly on another node.
+        return not relation.lazy and cls._same_node(relation.get_foreign_type())
+
+    @classmethod
+    def _eager_prefetch(cls, prefetch: Optional[List[str]]) -> Optional[List[str]]:
+        # Eager relationships that can't be read by a script are prefetched instead
+        eager = [name for name, rel in cls._relationships.items() if not rel.lazy and not cls._scripted_eager(rel)]
+        return [*(prefetch or []), *eager] or None
+
+    @classmethod
+    def _projection(cls, only: Optional[List[str]]) -> Optional[List[str]]:
+        if only is None:
+            return None
+        field_names = cls._plan().field_names
+        for name in only:
+            if name not in field_names:
+                raise UnknownFieldName(name)
+        # The id is always fetched, it tells a missing instance apart from one with null fields
+        return ["id", *[name for name in only if name != "id"]]
+
+    @staticmethod
+    def _tracked(instances: List[S]) -> List[S]:
+        session = current_session.get()
+        if session is None:
+            return instances
+        return [session.track(instance) for instance in instances]
+
+    @classmethod
+    def _prefetch_level(
+        cls, instances: List["RedormBase"], prefetch: List[str]
+    ) -> List[Tuple[List, "IRelationship", dict]]:
+        # Turns dotted paths into a tree, and returns the first level of (instances, relationship, subtree) to load
+        tree: dict = {}
+        for path in prefetch:
+            node = tree
+            for name in path.split("."):
+                node = node.setdefault(name, {})
+        return [(instances, cls._named_relationship(name), subtree) for name, subtree in tree.items()]
+
+    @classmethod
+    def _named_relationship(cls, name: str):
+        if name not in cls._relationships:
+            raise UnknownFieldName(f"Unknown relationship {name!r} on {cls.__name__}")
+        return cls._relationships[name]
+
+    @staticmethod
+    def _queue_prefetch(query: Query, level: List[Tuple[List, "IRelationship", dict]]) -> None:
+        queued = set()
+        for instances, rel, _ in level:
+            foreign_type = rel.get_foreign_type()
+            for instance in instances:
+                cache = instance._relationship_cache().get(rel.relationship_name, {})
+                # Instances that were never loaded from redis have no refs and are left to load lazily
+                if "loaded" in cache or "ref" not in cache:
+                    continue
+                related_ids = cache["ref"] if rel.to_many else [cache["ref"]] if cache["ref"] is not None else []
+                for related_id in related_ids:
+                    if (foreign_type.__name__, related_id) not in queued:
+                        queued.add((foreign_type.__name__, related_id))
+                        foreign_type._get(query, related_id)
+
+    @staticmethod
+    def _apply_prefetch(level: List[Tuple[List, "IRelationship", dict]], results: List) -> List:
+        fetched = {(type(r).__name__, r.id): r for r in RedormBase._tracked(results)}
+        next_level: List[Tuple[List, IRelationship, dict]] = []
+        for instances, rel, subtree in level:
+            foreign_type = rel.get_foreign_type()
+            related: Dict[int, RedormBase] = {}
+            for instance in instances:
+                cache = instance._relationship_cache().setdefault(rel.relationship_name, {})
+                if "loaded" not in cache and "ref" in cache:
+                    if rel.to_many:
+                        cache["loaded"] = [
+                            fetched[(foreign_type.__name__, r)]
+                            for r in cache["ref"]
+                            if (foreign_type.__name__, r) in fetched
+                        ]
+                    else:
+                        cache["loaded"] = fetched.get((foreign_type.__name__, cache["ref"]))
+                loaded = cache.get("loaded")
+                for r in loaded if rel.to_many else [] if loaded is None else [loaded]:
+                    related[id(r)] = r
+            next_level.extend(
+                (list(related.values()), foreign_type._named_relationship(name), child)
+                for name, child in subtree.items()
+            )
+        return next_level
+
+    @classmethod
+    def _new_ids(cls, count: int) -> List[str]:
+        plan = cls._plan()
+        if plan.id_format != "int":
+            return [ID_FORMATS[plan.id_format]() for _ in range(count)]
+        # One INCRBY reserves the ids of a whole batch, counted on the first node of a sharded database
+        last = cls._database().clients[0].client.incrby(plan.id_counter_key, count)
+        return [str(i) for i in range(last - count + 1, last + 1)]
+
+    @classmethod
+    async def _anew_ids(cls, count: int) -> List[str]:
+        plan = cls._plan()
+        if plan.id_format != "int":
+            return [ID_FORMATS[plan.id_format]() for _ in range(count)]
+        last = await cls._database().async_clients[0].client.incrby(plan.id_counter_key, count)
+        return [str(i) for i in range(last - count + 1, last + 1)]
+
+    @classmethod
+    def _new_instance(cls: Type[S], kwargs, instance_id: str) -> Tuple[S, dict]:
         # Handle non-relationship parts
-        instance_fields = fields(cls)
-        field_values = {f.name: kwargs.get(f.name) for f in instance_fields if f.name in kwargs}
-        new_id = str(uuid4())
-        new_instance = cls.from_dict(dict(id=new_id, **field_values))
-        for k, v in kwargs.items():
-            if k not in field_values:
+        plan = cls._plan()
+        field_values = {k: v for k, v in kwargs.items() if k in plan.fields}
+        field_values["id"] = instance_id
+        if plan.validate:
+            new_instance = cls.from_dict(field_values)
+        else:
+            # Values are given in their stored form, as with from_dict, but without schema validation
+            new_instance = cls(
+                **{
+                    f.name: f.decode_value(field_values.get(f.name))
+                    for f in plan.field_list
+                    if f.required or f.name in field_values
+                }
+            )
+        return new_instance, {k: v for k, v in kwargs.items() if k not in field_values}
+
+    @classmethod
+    @instrumented("create")
+    def create(cls: Type[S], **kwargs) -> S:
+        cls._sweep_if_due()
+        new_instance, others = cls._new_instance(kwargs, *cls._new_ids(1))
+        if current_session.get() is not None:
+            for k, v in others.items():
                 setattr(new_instance, k, v)
-        new_instance.save()
+            new_instance.save()
+            return new_instance
+        # The save and the relationship scripts go in one pipeline, backrefs on other nodes follow
+        pipelines = PipelineGroup()
+        positions = cls._queue_saves(pipelines, [new_instance])
+        related = cls._queue_new_relationships(pipelines, [(new_instance, others)])
+        results = pipelines.execute(raise_on_error=False)
+        [saved] = cls._save_results(results, positions, [new_instance])
+        if isinstance(saved, ResponseError):
+            raise cls._save_error(saved) from saved
+        followups = PipelineGroup(transaction=False)
+        if cls._queue_followups(followups, results, related):
+            followups.execute()
+        return new_instance
+
+    @classmethod
+    @instrumented("acreate")
+    async def acreate(cls: Type[S], **kwargs) -> S:
+        await cls._asweep_if_due()
+        new_instance, others = cls._new_instance(kwargs, *await cls._anew_ids(1))
+        if current_session.get() is not None:
+            for k, v in others.items():
+                if k in cls._relationships:
+                    await cls._relationships[k].aset(new_instance, v)
+                else:
+                    setattr(new_instance, k, v)
+            await new_instance.asave()
+            return new_instance
+        pipelines = PipelineGroup(is_async=True)
+        positions = cls._queue_saves(pipelines, [new_instance])
+        related = cls._queue_new_relationships(pipelines, [(new_instance, others)])
+        results = await pipelines.aexecute(raise_on_error=False)
+        [saved] = cls._save_results(results, positions, [new_instance])
+        if isinstance(saved, ResponseError):
+            raise cls._save_error(saved) from saved
+        followups = PipelineGroup(is_async=True, transaction=False)
+        if cls._queue_followups(followups, results, related):
+            await followups.aexecute()
         return new_instance
 
+    @classmethod
+    @instrumented("create_bulk")
+    def create_bulk(cls: Type[S], rows: Iterable[dict], batch_size: int = BULK_BATCH_SIZE) -> List[S]:
+        cls._sweep_if_due()
+        rows = list(rows)
+        created = [cls._new_instance(kwargs, instance_id) for kwargs, instance_id in zip(rows, cls._new_ids(len(rows)))]
+        errors: Dict[int, RedormException] = {}
+        for start in range(0, len(created), batch_size):
+            batch = created[start : start + batch_size]
+            pipelines = PipelineGroup(transaction=False)
+            positions = cls._queue_saves(pipelines, [instance for instance, _ in batch])
+            related = cls._queue_new_relationships(pipelines, batch)
+            results = pipelines.execute(raise_on_error=False)
+            cls._bulk_saved(cls._save_results(results, positions, [instance for instance, _ in batch]), start, errors)
+            followups = PipelineGroup(transaction=False)
+            if cls._queue_followups(followups, results, related):
+                followups.execute()
+        return cls._bulk_outcome([instance for instance, _ in created], errors)
+
+    @classmethod
+    @instrumented("acreate_bulk")
+    async def acreate_bulk(cls: Type[S], rows: Iterable[dict], batch_size: int = BULK_BATCH_SIZE) -> List[S]:
+        await cls._asweep_if_due()
+        rows = list(rows)
+        ids = await cls._anew_ids(len(rows))
+        created = [cls._new_instance(kwargs, instance_id) for kwargs, instance_id in zip(rows, ids)]
+        errors: Dict[int, RedormException] = {}
+        for start in range(0, len(created), batch_size):
+            batch = created[start : start + batch_size]
+            pipelines = PipelineGroup(is_async=True, transaction=False)
+            positions = cls._queue_saves(pipelines, [instance for instance, _ in batch])
+            related = cls._queue_new_relationships(pipelines, batch)
+            results = await pipelines.aexecute(raise_on_error=False)
+            cls._bulk_saved(cls._save_results(results, positions, [instance for instance, _ in batch]), start, errors)
+            followups = PipelineGroup(is_async=True, transaction=False)
+            if cls._queue_followups(followups, results, related):
+                await followups.aexecute()
+        return cls._bulk_outcome([instance for instance, _ in created], errors)
+
+    @classmethod
+    @instrumented("save_many")
+    def save_many(cls: Type[S], instances: List[S], batch_size: int = BULK_BATCH_SIZE) -> None:
+        errors: Dict[int, RedormException] = {}
+        for start in range(0, len(instances), batch_size):
+            batch = instances[start : start + batch_size]
+            pipelines = PipelineGroup(transaction=False)
+            positions = cls._queue_saves(pipelines, batch)
+            cls._bulk_saved(cls._save_results(pipelines.execute(raise_on_error=False), positions, batch), start, errors)
+        cls._bulk_outcome(instances, errors)
+
+    @classmethod
+    @instrumented("asave_many")
+    async def asave_many(cls: Type[S], instances: List[S], batch_size: int = BULK_BATCH_SIZE) -> None:
+        errors: Dict[int, RedormException] = {}
+        for start in range(0, len(instances), batch_size):
+            batch = instances[start : start + batch_size]
+            pipelines = PipelineGroup(is_async=True, transaction=False)
+            positions = cls._queue_saves(pipelines, batch)
+            results = await pipelines.aexecute(raise_on_error=False)
+            cls._bulk_saved(cls._save_results(results, positions, batch), start, errors)
+        cls._bulk_outcome(instances, errors)
+
+    @staticmethod
+    def _queue_saves(pipelines: PipelineGroup, instances: Sequence["RedormBase"]) -> List[Tuple[object, int]]:
+        # Queues each save on the pipeline of its instance's node, returning where each result will be.
+        # Scripts are loaded once per client, so each node gets the batch in one round trip.
+        positions = []
+        for instance in instances:
+            client = pipelines.client(instance._database(), instance.id)
+            pipeline = pipelines.on(client)
+            client.queue_evalsha(
+                pipeline, client.unique_save_script, 2, *instance._save_args(instance._loaded_fields())
+            )
+            positions.append((client, len(pipeline) - 1))
+        return positions
+
+    @staticmethod
+    def _save_results(
+        results: Dict[object, List], positions: List[Tuple[object, int]], instances: Sequence["RedormBase"]
+    ) -> List:
+        # Also records the version each saved instance is now at
+        saved = [results[client][position] for client, position in positions]
+        for instance, result in zip(instances, saved):
+            if not isinstance(result, ResponseError):
+                instance._record_version(result)
+        return saved
+
+    @classmethod
+    def _queue_new_relationships(
+        cls, pipelines: PipelineGroup, created: Sequence[Tuple["RedormBase", dict]]
+    ) -> List[Tuple["IRelationship", str, object, int]]:
+        # Queued after the saves, each script only writes if its instance was saved
+        related = []
+        for instance, others in created:
+            for k, v in others.items():
+                rel = cls._relationships.get(k)
+                if rel is None:
+                    setattr(instance, k, v)
+                    continue
+                related_ids = rel._related_ids(v)
+                related.append((rel, instance.id, *rel._queue_relate(pipelines, instance.id, related_ids)))
+                instance._relationship_cache()[k] = {"ref": related_ids}
+        return related
+
+    @staticmethod
+    def _queue_followups(
+        pipelines: PipelineGroup, results: Dict[object, List], related: List[Tuple["IRelationship", str, object, int]]
+    ) -> bool:
+        # Queues the backref changes left to make on other nodes by each relationship script
+        queued = False
+        for rel, instance_id, client, position in related:
+            queued |= rel._queue_remote_backrefs(pipelines, instance_id, results[client][position])
+        return queued
+
+    @classmethod
+    def _bulk_saved(cls, results: List, offset: int, errors: Dict[int, RedormException]) -> List[int]:
+        saved = []
+        for i, result in enumerate(results):
+            if isinstance(result, ResponseError):
+                errors[offset + i] = cls._save_error(result)
+            else:
+                saved.append(i)
+        return saved
+
+    @staticmethod
+    def _bulk_outcome(instances: List[S], errors: Dict[int, RedormException]) -> List[S]:
+        if errors:
+            saved = [instance for i, instance in enumerate(instances) if i not in errors]
+            if all(isinstance(error, UniqueContstraintViolation) for error in errors.values()):
+                raise BulkUniqueConstraintViolation(errors, saved)
+            raise BulkWriteError(errors, saved)
+        return instances
+
     @classmethod
     def _list_ids(cls, **kwargs) -> Set[str]:
-        field_dict = {f.name: f for f in fields(cls)}
-        pre_pipeline = red.client.pipeline()
-        indexes = set()
         if not kwargs:
             return set()
+        kwargs, refs = cls._split_remote_filters(kwargs)
+        remote = list(cls._fetch_backrefs(refs).values()) if refs else []
+
+        def shard_ids(client) -> Tuple[Set[str], Set[str]]:
+            pre_pipeline = client.read_pipeline()
+            lexical = cls._queue_list_ids(client, pre_pipeline, kwargs)
+            expiring = cls._queue_expired(pre_pipeline)
+            results = cls._lookup_ids(pre_pipeline.execute() if len(pre_pipeline) else [], lexical)
+            expired = set(results.pop()) if expiring else set()
+            return cls._intersect_ids([*results, *remote]), expired
+
+        # Each shard holds its own instances' index entries, so the ids are gathered from all of them
+        return cls._live_ids(gather([partial(shard_ids, client) for client in cls._database().clients]))
+
+    @classmethod
+    async def _alist_ids(cls, **kwargs) -> Set[str]:
+        if not kwargs:
+            return set()
+        kwargs, refs = cls._split_remote_filters(kwargs)
+        remote = list((await cls._afetch_backrefs(refs)).values()) if refs else []
+
+        async def shard_ids(client) -> Tuple[Set[str], Set[str]]:
+            pre_pipeline = client.read_pipeline()
+            lexical = cls._queue_list_ids(client, pre_pipeline, kwargs)
+            expiring = cls._queue_expired(pre_pipeline)
+            results = cls._lookup_ids(await pre_pipeline.execute() if len(pre_pipeline) else [], lexical)
+            expired = set(results.pop()) if expiring else set()
+            return cls._intersect_ids([*results, *remote]), expired
+
+        return cls._live_ids(await asyncio.gather(*(shard_ids(client) for client in cls._database().async_clients)))
+
+    @classmethod
+    def _queue_expired(cls, pipeline) -> bool:
+        # Queues a read of the ids that have expired but haven't been swept yet, for expiring models
+        plan = cls._plan()
+        if not plan.expiring:
+            return False
+        pipeline.zrangebyscore(plan.expiry_key, "-inf", time.time())
+        return True
+
+    @staticmethod
+    def _live_ids(shards: List[Tuple[Set[str], Set[str]]]) -> Set[str]:
+        # The ids found on each shard, less those that have expired on any of them
+        return set().union(*(ids for ids, _ in shards)) - set().union(*(expired for _, expired in shards))
+
+    @classmethod
+    def _expired_ids(cls) -> Set[str]:
+        plan = cls._plan()
+        if not plan.expiring:
+            return set()
+        now = time.time()
+        return set().union(
+            *gather(
+                [
+                    partial(client.reader.zrangebyscore, plan.expiry_key, "-inf", now)
+                    for client in cls._database().clients
+                ]
+            )
+        )
+
+    @classmethod
+    async def _aexpired_ids(cls) -> Set[str]:
+        plan = cls._plan()
+        if not plan.expiring:
+            return set()
+        now = time.time()
+        return set().union(
+            *await asyncio.gather(
+                *(client.reader.zrangebyscore(plan.expiry_key, "-inf", now) for client in cls._database().async_clients)
+            )
+        )
+
+    @staticmethod
+    def _expired(expire_at: Optional[float]) -> bool:
+        return expire_at is not None and float(expire_at) <= time.time()
+
+    @classmethod
+    def _local_backrefs(cls, rel: "IRelationship") -> bool:
+        # Whether a relationship's backrefs are stored alongside this model's indexes, so filters can use them in
+        # the same commands. They aren't when either model is in another database, or this one is sharded.
+        database = cls._database()
+        return not database.sharded and rel.get_foreign_type()._database() is database
+
+    @classmethod
+    def _split_remote_filters(cls, kwargs) -> Tuple[dict, List[Tuple["IRelationship", str]]]:
+        # Separates relationship filters whose backrefs are read from another node
+        local, refs = {}, []
+        for k, v in kwargs.items():
+            rel = cls._relationships.get(k)
+            if rel is not None and rel.backref is not None and not rel.to_many and not cls._local_backrefs(rel):
+                refs.append((rel, v if isinstance(v, str) else v.id))
+            else:
+                local[k] = v
+        return local, refs
+
+    @staticmethod
+    def _queue_backrefs(
+        pipelines: PipelineGroup, refs: List[Tuple["IRelationship", str]]
+    ) -> Dict[str, Tuple[object, int]]:
+        positions = {}
+        for rel, related_id in refs:
+            client = pipelines.client(rel.get_foreign_type()._database(), related_id)
+            pipeline = pipelines.on(client)
+            key = rel.backref_key(related_id)
+            if rel.many_to:
+                pipeline.smembers(key)
+            else:
+                pipeline.get(key)
+            positions[key] = (client, len(pipeline) - 1)
+        return positions
+
+    @staticmethod
+    def _backref_ids(results: Dict[object, List], positions: Dict[str, Tuple[object, int]]) -> Dict[str, Set[str]]:
+        ids = {}
+        for key, (client, position) in positions.items():
+            result = results[client][position]
+            ids[key] = set() if result is None else {result} if isinstance(result, str) else set(result)
+        return ids
+
+    @classmethod
+    def _fetch_backrefs(cls, refs: List[Tuple["IRelationship", str]]) -> Dict[str, Set[str]]:
+        # The ids in backrefs held on other nodes, by backref key
+        pipelines = PipelineGroup(read=True, transaction=False)
+        positions = cls._queue_backrefs(pipelines, refs)
+        return cls._backref_ids(pipelines.execute(), positions)
+
+    @classmethod
+    async def _afetch_backrefs(cls, refs: List[Tuple["IRelationship", str]]) -> Dict[str, Set[str]]:
+        pipelines = PipelineGroup(is_async=True, read=True, transaction=False)
+        positions = cls._queue_backrefs(pipelines, refs)
+        return cls._backref_ids(await pipelines.aexecute(), positions)
+
+    @classmethod
+    def _queue_list_ids(cls, client, pre_pipeline, kwargs) -> Set[int]:
+        # Returns the positions of prefix index lookups, which read members rather than ids
+        plan_fields = cls._plan().fields
+        indexes = set()
+        lexical = set()
         try:
             for k, v in kwargs.items():
-                if k in field_dict:
-                    f: Field = field_dict[k]
-                    if field_dict[k].metadata.get("unique"):
-                        if v is None:
-                            pre_pipeline.smembers(f"{cls.__name__}:keynull:{f.name}")
-                        else:
-                            pre_pipeline.hget(
-                                f"{cls.__name__}:key:{k}",
-                                cls._encode_field(f.type, v, omit_none=False),
-                            )
-                    elif field_dict[k].metadata.get("index"):
+                if "__" in k:
+                    name, lookup = k.split("__", 1)
+                    if cls._queue_range_lookup(pre_pipeline, plan_fields[name], lookup, v):
+                        lexical.add(len(pre_pipeline) - 1)
+                elif k in plan_fields:
+                    f = plan_fields[k]
+                    if f.range_index and not (f.unique or f.index):
+                        cls._queue_range_lookup(pre_pipeline, f, "between", None if v is None else (v, v))
+                    elif f.prefix_index and not (f.unique or f.index):
+                        cls._queue_range_lookup(pre_pipeline, f, "", v)
+                        lexical.add(len(pre_pipeline) - 1)
+                    elif f.unique:
                         if v is None:
-                            indexes.add(f"{cls.__name__}:indexnull:{f.name}")
+                            pre_pipeline.smembers(f.null_key)
                         else:
-                            indexes.add(
-                                f"{cls.__name__}:index:{f.name}:{cls._encode_field(f.type, v, omit_none=False)}"
-                            )
+                            pre_pipeline.hget(f.key, index_value(f.encode_value(v)))
+                    elif f.index:
+                        indexes.add(f.null_key if v is None else f.index_key(f.encode_value(v)))
                     else:
                         raise FilterOnUnindexedField(f"Trying to filter on unindexed field: {k}")
                 elif isinstance(cls.__dict__[k], IRelationship):
@@ -191,10 +920,7 @@ class RedormBase(JsonSchemaMixin):
                         raise NotImplementedError("Can't filter based off to-many relationships")
                     if rel.backref is None:
                         raise NotImplementedError("Filtering on a relationship requires a backref")
-                    rel_type = rel.get_foreign_type().__name__
-                    if not isinstance(v, str):
-                        v = v.id
-                    ref = f"{rel_type}:relationship:{rel.backref}:{v}"
+                    ref = rel.backref_key(v if isinstance(v, str) else v.id)
                     if rel.many_to:
                         indexes.add(ref)
                     else:
@@ -202,10 +928,45 @@ class RedormBase(JsonSchemaMixin):
 
         except KeyError as e:
             raise UnknownFieldName(*e.args) from e
-        if indexes:
-            pre_pipeline.sinter(indexes)
-        results = pre_pipeline.execute()
-        sets = [r if isinstance(r, set) else {r} for r in results if r is not None]
+        # Relationship sets belong to the related model's slot on a cluster, so those are intersected here
+        for group in client.slot_groups(indexes):
+            pre_pipeline.sinter(group)
+        return lexical
+
+    @staticmethod
+    def _queue_range_lookup(pre_pipeline, f: FieldPlan, lookup: str, v) -> bool:
+        # Queues a range or prefix index lookup, returning True for the latter
+        if lookup not in RANGE_LOOKUPS and lookup not in LEX_LOOKUPS and (lookup or not f.prefix_index):
+            raise UnknownFieldName(f"Unknown lookup {lookup!r} on field {f.name!r}")
+        if not f.prefix_index and not (f.range_index and lookup in RANGE_LOOKUPS):
+            raise FilterOnUnindexedField(f"Trying to range filter on field without range or prefix index: {f.name}")
+        if v is None:
+            raise ValueError("Range filters do not match null values")
+        if f.prefix_index:
+            pre_pipeline.zrangebylex(f.lex_key, *f.lex_bounds(lookup, v))
+            return True
+        pre_pipeline.zrangebyscore(f.range_key, *RedormBase._range_bounds(f, lookup, v))
+        return False
+
+    @staticmethod
+    def _lookup_ids(results: List, lexical: Set[int]) -> List:
+        return [lex_ids(result) if i in lexical else result for i, result in enumerate(results)]
+
+    @staticmethod
+    def _range_bounds(f: FieldPlan, lookup: str, v) -> Tuple:
+        if lookup == "between":
+            return tuple(f.encode_value(bound) for bound in v)
+        encoded = f.encode_value(v)
+        return {
+            "gt": (f"({encoded}", "+inf"),
+            "gte": (encoded, "+inf"),
+            "lt": ("-inf", f"({encoded}"),
+            "lte": ("-inf", encoded),
+        }[lookup]
+
+    @staticmethod
+    def _intersect_ids(results: List) -> Set[str]:
+        sets = [set(r) if isinstance(r, (set, list)) else {r} for r in results if r is not None]
         if not sets:
             return set()
         ret = sets[0]
@@ -214,12 +975,288 @@ class RedormBase(JsonSchemaMixin):
         return ret
 
     @classmethod
-    def list(cls: Type[S], **kwargs) -> List[S]:
+    @instrumented("list")
+    def list(cls: Type[S], prefetch: Optional[List[str]] = None, only: Optional[List[str]] = None, **kwargs) -> List[S]:
         if len(kwargs) > 0:
             member_ids = cls._list_ids(**kwargs)
         else:
-            member_ids = red.client.smembers(f"{cls.__name__}:all")
-        return cls.get_bulk(member_ids)
+            member_ids = cls._live_ids(gather([partial(cls._read_all, client) for client in cls._database().clients]))
+        return cls.get_bulk(member_ids, prefetch=prefetch, only=only)
+
+    @classmethod
+    @instrumented("alist")
+    async def alist(
+        cls: Type[S], prefetch: Optional[List[str]] = None, only: Optional[List[str]] = None, **kwargs
+    ) -> List[S]:
+        if len(kwargs) > 0:
+            member_ids = await cls._alist_ids(**kwargs)
+        else:
+            member_ids = cls._live_ids(
+                await asyncio.gather(*(cls._aread_all(client) for client in cls._database().async_clients))
+            )
+        return await cls.aget_bulk(member_ids, prefetch=prefetch, only=only)
+
+    @classmethod
+    def _read_all(cls, client) -> Tuple[Set[str], Set[str]]:
+        # Every id on a node, and those of them that have expired
+        plan = cls._plan()
+        if not plan.expiring:
+            return client.reader.smembers(plan.all_key), set()
+        p = client.read_pipeline(transaction=False)
+        p.smembers(plan.all_key)
+        cls._queue_expired(p)
+        ids, expired = p.execute()
+        return ids, set(expired)
+
+    @classmethod
+    async def _aread_all(cls, client) -> Tuple[Set[str], Set[str]]:
+        plan = cls._plan()
+        if not plan.expiring:
+            return await client.reader.smembers(plan.all_key), set()
+        p = client.read_pipeline(transaction=False)
+        p.smembers(plan.all_key)
+        cls._queue_expired(p)
+        ids, expired = await p.execute()
+        return ids, set(expired)
+
+    @classmethod
+    def iter(cls: Type[S], batch_size: int = 1000, **kwargs) -> Iterator[S]:
+        for ids in cls._id_batches(batch_size, kwargs):
+            yield from cls.get_bulk(ids)
+
+    @classmethod
+    async def aiter(cls: Type[S], batch_size: int = 1000, **kwargs) -> AsyncIterator[S]:
+        async for ids in cls._aid_batches(batch_size, kwargs):
+            for instance in await cls.aget_bulk(ids):
+                yield instance
+
+    @classmethod
+    def _id_batches(cls, batch_size: int, kwargs) -> Iterator[List[str]]:
+        # Matching ids about batch_size at a time, scanned from a set on each node so they're never all held at once.
+        # Filters that aren't backed by sets are looked up first. Scans can return an id more than once, so the ids a
+        # scan has returned are kept to skip those it repeats.
+        sources = [(client, *cls._scan_source(client, kwargs)) for client in cls._database().clients]
+        if any(scan_key is None for _, scan_key, _ in sources):
+            ids = list(cls._list_ids(**kwargs))
+            for i in range(0, len(ids), batch_size):
+                yield ids[i : i + batch_size]
+            return
+        # Shards are scanned one after another
+        for client, scan_key, intersected in sources:
+            assert scan_key is not None
+            try:
+                if intersected:
+                    p = client.pipeline(temporary=True)
+                    p.sinterstore(scan_key, intersected)
+                    p.expire(scan_key, TEMP_KEY_TTL)
+                    p.execute()
+                cursor = 0
+                seen: Set[str] = set()
+                while True:
+                    cursor, member_ids = client.client.sscan(scan_key, cursor, count=batch_size)
+                    fresh = [instance_id for instance_id in cast(List[str], member_ids) if instance_id not in seen]
+                    seen.update(fresh)
+                    if fresh:
+                        yield fresh
+                    if cursor == 0:
+                        break
+            finally:
+                if intersected:
+                    client.client.unlink(scan_key)
+
+    @classmethod
+    async def _aid_batches(cls, batch_size: int, kwargs) -> AsyncIterator[List[str]]:
+        sources = [(client, *cls._scan_source(client, kwargs)) for client in cls._database().async_clients]
+        if any(scan_key is None for _, scan_key, _ in sources):
+            ids = list(await cls._alist_ids(**kwargs))
+            for i in range(0, len(ids), batch_size):
+                yield ids[i : i + batch_size]
+            return
+        for client, scan_key, intersected in sources:
+            assert scan_key is not None
+            try:
+                if intersected:
+                    p = client.pipeline(temporary=True)
+                    p.sinterstore(scan_key, intersected)
+                    p.expire(scan_key, TEMP_KEY_TTL)
+                    await p.execute()
+                cursor = 0
+                seen: Set[str] = set()
+                while True:
+                    cursor, member_ids = await client.client.sscan(scan_key, cursor, count=batch_size)
+                    fresh = [instance_id for instance_id in cast(List[str], member_ids) if instance_id not in seen]
+                    seen.update(fresh)
+                    if fresh:
+                        yield fresh
+                    if cursor == 0:
+                        break
+            finally:
+                if intersected:
+                    await client.client.unlink(scan_key)
+
+    @classmethod
+    def _scan_source(cls, client, kwargs) -> Tuple[Optional[str], List[str]]:
+        # Returns the set to SSCAN, and the sets to intersect into it first when it is a temporary key.
+        # When a filter can't be expressed as a set (unique or range lookups) no key is returned.
+        plan = cls._plan()
+        if not kwargs:
+            return plan.all_key, []
+        set_keys = cls._filter_sets(client, kwargs)
+        if set_keys is None:
+            return None, []
+        if len(set_keys) == 1:
+            return set_keys[0], []
+        scan_key = f"{plan.tmp_prefix}{uuid4()}"
+        if len(client.slot_groups([scan_key, *set_keys])) > 1:
+            return None, []
+        return scan_key, set_keys
+
+    @classmethod
+    def _filter_sets(cls, client, kwargs) -> Optional[List[str]]:
+        # The sets whose intersection holds the matching ids, or None if a filter isn't backed by a set
+        plan = cls._plan()
+        set_keys = []
+        for k, v in kwargs.items():
+            if k in plan.fields:
+                f = plan.fields[k]
+                if v is None and (f.unique or f.index):
+                    set_keys.append(f.null_key)
+                elif f.index:
+                    set_keys.append(f.index_key(f.encode_value(v)))
+                else:
+                    return None
+            else:
+                rel = cls._relationships.get(k)
+                if rel is None or rel.to_many or not rel.many_to or rel.backref is None:
+                    return None
+                if not cls._local_backrefs(rel):
+                    return None
+                set_keys.append(rel.backref_key(v if isinstance(v, str) else v.id))
+        if len(client.slot_groups(set_keys)) > 1:
+            # Sets in different cluster slots can't be intersected by one command
+            return None
+        return set_keys
+
+    @classmethod
+    @instrumented("autocomplete")
+    def autocomplete(cls: Type[S], name: str, prefix: str, limit: int = 10) -> List[S]:
+        # The first limit instances whose prefix indexed field starts with prefix, in the index's order
+        f, bounds = cls._lex_prefix(name, prefix)
+        members = gather(
+            [
+                partial(client.reader.zrangebylex, f.lex_key, *bounds, start=0, num=limit)
+                for client in cls._database().clients
+            ]
+        )
+        ids = cls._first_lex_ids(members, limit)
+        return cls._in_order(cls.get_bulk(set(ids)), ids)
+
+    @classmethod
+    @instrumented("aautocomplete")
+    async def aautocomplete(cls: Type[S], name: str, prefix: str, limit: int = 10) -> List[S]:
+        f, bounds = cls._lex_prefix(name, prefix)
+        members = await asyncio.gather(
+            *(
+                client.reader.zrangebylex(f.lex_key, *bounds, start=0, num=limit)
+                for client in cls._database().async_clients
+            )
+        )
+        ids = cls._first_lex_ids(members, limit)
+        return cls._in_order(await cls.aget_bulk(set(ids)), ids)
+
+    @classmethod
+    def _lex_prefix(cls, name: str, prefix: str) -> Tuple[FieldPlan, Tuple[bytes, bytes]]:
+        f = cls._plan().fields.get(name)
+        if f is None:
+            raise UnknownFieldName(name)
+        if not f.prefix_index:
+            raise FilterOnUnindexedField(f"Trying to autocomplete on field without prefix index: {name}")
+        return f, f.lex_bounds("startswith", prefix)
+
+    @staticmethod
+    def _first_lex_ids(members: List[List[str]], limit: int) -> List[str]:
+        # Each shard returns its first matches, the overall first are taken from those
+        return lex_ids(sorted(member for shard in members for member in shard)[:limit])
+
+    @staticmethod
+    def _in_order(instances: List[S], ids: List[str]) -> List[S]:
+        by_id = {instance.id: instance for instance in instances}
+        return [by_id[instance_id] for instance_id in ids if instance_id in by_id]
+
+    @classmethod
+    def memory_report(cls, samples: int = 100) -> MemoryReport:
+        return memory_report(cls, samples)
+
+    @classmethod
+    def query(cls: Type[S]) -> QuerySet[S]:
+        return QuerySet(cls)
+
+    @classmethod
+    @instrumented("count")
+    def count(cls, **kwargs) -> int:
+        pipelines = [(client, client.read_pipeline(transaction=False)) for client in cls._database().clients]
+        if not all(cls._queue_count(client, p, kwargs) for client, p in pipelines):
+            return len(cls._list_ids(**kwargs))
+        return sum(result[0] - sum(result[1:]) for result in gather([p.execute for _, p in pipelines]))
+
+    @classmethod
+    @instrumented("acount")
+    async def acount(cls, **kwargs) -> int:
+        pipelines = [(client, client.read_pipeline(transaction=False)) for client in cls._database().async_clients]
+        if not all(cls._queue_count(client, p, kwargs) for client, p in pipelines):
+            return len(await cls._alist_ids(**kwargs))
+        return sum(result[0] - sum(result[1:]) for result in await asyncio.gather(*(p.execute() for _, p in pipelines)))
+
+    @classmethod
+    @instrumented("exists")
+    def exists(cls, **kwargs) -> bool:
+        return cls.count(**kwargs) > 0
+
+    @classmethod
+    @instrumented("aexists")
+    async def aexists(cls, **kwargs) -> bool:
+        return await cls.acount(**kwargs) > 0
+
+    @classmethod
+    def _queue_count(cls, client, pipeline, kwargs) -> bool:
+        # Queues a single command counting the matches without reading any ids, if the filters allow one. For expiring
+        # models that's only possible without filters, followed by a count of the expired ids to take off it.
+        plan = cls._plan()
+        if plan.expiring:
+            if kwargs:
+                return False
+            pipeline.scard(plan.all_key)
+            pipeline.zcount(plan.expiry_key, "-inf", time.time())
+            return True
+        if not kwargs:
+            pipeline.scard(plan.all_key)
+            return True
+        set_keys = cls._filter_sets(client, kwargs)
+        if set_keys is not None:
+            if len(set_keys) == 1:
+                pipeline.scard(set_keys[0])
+            else:
+                # Needs Redis 7, but counts on a replica without writing the intersection anywhere
+                pipeline.sintercard(len(set_keys), set_keys)
+            return True
+        if len(kwargs) > 1:
+            return False
+        ((k, v),) = kwargs.items()
+        name, _, lookup = k.partition("__")
+        f = plan.fields.get(name)
+        if f is None:
+            return False
+        if not lookup and f.unique:
+            pipeline.hexists(f.key, index_value(f.encode_value(v)))
+        elif lookup in RANGE_LOOKUPS and f.range_index and v is not None:
+            pipeline.zcount(f.range_key, *cls._range_bounds(f, lookup, v))
+        elif not lookup and f.range_index and not f.index and v is not None:
+            pipeline.zcount(f.range_key, *cls._range_bounds(f, "between", (v, v)))
+        elif f.prefix_index and v is not None and (lookup in LEX_LOOKUPS or not (lookup or f.index)):
+            pipeline.zlexcount(f.lex_key, *f.lex_bounds(lookup, v))
+        else:
+            return False
+        return True
 
     def lock(
         self,
@@ -229,8 +1266,8 @@ class RedormBase(JsonSchemaMixin):
         lock_class=None,
         thread_local=True,
     ) -> Lock:
-        return red.client.lock(
-            f"{self.__class__.__name__}:userlock:{self.id}",
+        return self._client(self.id).client.lock(
+            self._plan().user_lock_prefix + self.id,
             timeout=timeout,
             sleep=sleep,
             lock_class=lock_class,
@@ -238,107 +1275,695 @@ class RedormBase(JsonSchemaMixin):
             thread_local=thread_local,
         )
 
+    @instrumented("delete")
     def delete(self):
-        # TODO: Handle removal of relationships
-        instance_id = self.id
-        cls_name = self.__class__.__name__
-        with red.client.lock(f"{cls_name}:lock:{instance_id}"):
-            self.refresh()
-            instance_dict = self.to_dict(omit_none=True)
-            p = red.client.pipeline()
-            p.srem(f"{cls_name}:all", instance_id)
-            p.unlink(f"{cls_name}:member:{instance_id}")
-            for f in fields(self.__class__):
-                val = instance_dict.get(f.name)
-                if f.metadata.get("unique"):
-                    if val is None:
-                        p.srem(f"{cls_name}:keynull:{f.name}", instance_id)
-                    else:
-                        p.hdel(f"{cls_name}:key:{f.name}", val)
-                elif f.metadata.get("index"):
-                    if val is None:
-                        p.srem(f"{cls_name}:indexnull:{f.name}", instance_id)
-                    else:
-                        p.srem(
-                            f"{cls_name}:index:{f.name}:{self.__class__._encode_field(f.type, instance_dict[f.name], omit_none=True)}",
-                            self.id,
-                        )
-            p.execute(raise_on_error=True)
+        # One script removes the member, its index entries and its relationships, along with the other end of each
+        # relationship when that's on the same node
+        session = current_session.get()
+        if session is not None:
+            session.forget(self)
+        ends = self._relationship_ends()
+        plan = self._plan()
+        removed = self._client(self.id).delete_member(
+            2, plan.member_key(self.id), plan.all_key, self.id, *self._delete_args(ends)
+        )
+        if not removed[0]:
+            raise InstanceNotFound
+        pipelines = PipelineGroup(transaction=False)
+        self._queue_unlinked(pipelines, self.id, ends, removed[1:])
+        pipelines.execute()
+        self._relationship_cache().clear()
+
+    @instrumented("adelete")
+    async def adelete(self):
+        session = current_session.get()
+        if session is not None:
+            session.forget(self)
+        ends = self._relationship_ends()
+        plan = self._plan()
+        removed = await self._aclient(self.id).delete_member(
+            2, plan.member_key(self.id), plan.all_key, self.id, *self._delete_args(ends)
+        )
+        if not removed[0]:
+            raise InstanceNotFound
+        pipelines = PipelineGroup(is_async=True, transaction=False)
+        self._queue_unlinked(pipelines, self.id, ends, removed[1:])
+        await pipelines.aexecute()
+        self._relationship_cache().clear()
+
+    @classmethod
+    @instrumented("delete_where")
+    def delete_where(cls, batch_size: int = BULK_BATCH_SIZE, all: bool = False, **kwargs) -> int:
+        # Deletes every match with the delete script, each batch of ids scanned as the previous one is deleted.
+        # Returns how many were deleted. Without filters every instance is deleted, which has to be asked for with
+        # all=True.
+        cls._check_delete_filters(all, kwargs)
+        ends = cls._relationship_ends()
+        args = cls._delete_args(ends)
+        deleted = 0
+        with red.read_from_primary():
+            for ids in cls._id_batches(batch_size, kwargs):
+                pipelines = PipelineGroup(transaction=False)
+                positions = cls._queue_deletes(pipelines, ids, args)
+                cleanup = PipelineGroup(transaction=False)
+                deleted += cls._deleted(cleanup, pipelines.execute(), positions, ends)
+                cleanup.execute()
+        return deleted
+
+    @classmethod
+    @instrumented("adelete_where")
+    async def adelete_where(cls, batch_size: int = BULK_BATCH_SIZE, all: bool = False, **kwargs) -> int:
+        cls._check_delete_filters(all, kwargs)
+        ends = cls._relationship_ends()
+        args = cls._delete_args(ends)
+        deleted = 0
+        with red_async.read_from_primary():
+            async for ids in cls._aid_batches(batch_size, kwargs):
+                pipelines = PipelineGroup(is_async=True, transaction=False)
+                positions = cls._queue_deletes(pipelines, ids, args)
+                cleanup = PipelineGroup(is_async=True, transaction=False)
+                deleted += cls._deleted(cleanup, await pipelines.aexecute(), positions, ends)
+                await cleanup.aexecute()
+        return deleted
+
+    @staticmethod
+    def _check_delete_filters(everything: bool, filters: dict) -> None:
+        if not filters and not everything:
+            raise ValueError("delete_where() without filters deletes every instance, pass all=True to do that")
+
+    @classmethod
+    @instrumented("sweep")
+    def sweep(cls, batch_size: int = BULK_BATCH_SIZE, batches: Optional[int] = None) -> int:
+        # Deletes the instances that have expired, along with their index entries and relationships, batch_size at a
+        # time per node and at most batches times if given. Returns how many were deleted.
+        plan = cls._plan()
+        if not plan.expiring:
+            return 0
+        previous = last_sweeps.get(cls.__name__, 0.0)
+        last_sweeps[cls.__name__] = now = time.time()
+        ends = cls._relationship_ends()
+        # The script skips instances given a later expiry since they were read
+        args = [*cls._delete_args(ends), repr(now)]
+        clients = cls._database().clients
+        deleted = 0
+        while clients and batches != 0:
+            due = gather(
+                [
+                    partial(client.client.zrangebyscore, plan.expiry_key, "-inf", now, 0, batch_size)
+                    for client in clients
+                ]
+            )
+            pipelines = PipelineGroup(transaction=False)
+            positions = cls._queue_deletes(pipelines, [instance_id for ids in due for instance_id in ids], args)
+            cleanup = PipelineGroup(transaction=False)
+            deleted += cls._deleted(cleanup, pipelines.execute(), positions, ends)
+            cleanup.execute()
+            # Nodes that returned a full batch may have more
+            clients = [client for client, ids in zip(clients, due) if len(ids) == batch_size]
+            batches = None if batches is None else batches - 1
+        if clients:
+            # Stopped with more due, so the next create sweeps again rather than waiting out the interval
+            last_sweeps[cls.__name__] = previous
+        return deleted
+
+    @classmethod
+    @instrumented("asweep")
+    async def asweep(cls, batch_size: int = BULK_BATCH_SIZE, batches: Optional[int] = None) -> int:
+        plan = cls._plan()
+        if not plan.expiring:
+            return 0
+        previous = last_sweeps.get(cls.__name__, 0.0)
+        last_sweeps[cls.__name__] = now = time.time()
+        ends = cls._relationship_ends()
+        args = [*cls._delete_args(ends), repr(now)]
+        clients = cls._database().async_clients
+        deleted = 0
+        while clients and batches != 0:
+            # Replies are decoded, so the ids are str
+            due = cast(
+                List[List[str]],
+                await asyncio.gather(
+                    *(client.client.zrangebyscore(plan.expiry_key, "-inf", now, 0, batch_size) for client in clients)
+                ),
+            )
+            pipelines = PipelineGroup(is_async=True, transaction=False)
+            positions = cls._queue_deletes(pipelines, [instance_id for ids in due for instance_id in ids], args)
+            cleanup = PipelineGroup(is_async=True, transaction=False)
+            deleted += cls._deleted(cleanup, await pipelines.aexecute(), positions, ends)
+            await cleanup.aexecute()
+            clients = [client for client, ids in zip(clients, due) if len(ids) == batch_size]
+            batches = None if batches is None else batches - 1
+        if clients:
+            last_sweeps[cls.__name__] = previous
+        return deleted
+
+    @classmethod
+    def _sweep_due(cls) -> bool:
+        # Creating instances sweeps a batch of an expiring model every sweep_interval seconds, or on the next create
+        # while more are due, so what expired instances hold in Redis stays bounded without a separate process
+        # sweeping
+        if not sweep_interval or not cls._plan().expiring:
+            return False
+        return time.time() - last_sweeps.get(cls.__name__, 0.0) >= sweep_interval
+
+    @classmethod
+    def _sweep_if_due(cls) -> None:
+        if cls._sweep_due():
+            cls.sweep(SWEEP_BATCH_SIZE, batches=1)
+
+    @classmethod
+    async def _asweep_if_due(cls) -> None:
+        if cls._sweep_due():
+            await cls.asweep(SWEEP_BATCH_SIZE, batches=1)
+
+    @InstanceOrIdMethod
+    @instrumented("expire")
+    def expire(cls, target: Union[str, "RedormBase"], seconds: Optional[float]) -> None:
+        # Expires an instance seconds from now, or with None keeps it until it's deleted
+        instance_id, args = cls._expire_args(target, seconds)
+        if not cls._client(instance_id).expire(1, *args):
+            raise InstanceNotFound
+
+    @InstanceOrIdMethod
+    @instrumented("aexpire")
+    async def aexpire(cls, target: Union[str, "RedormBase"], seconds: Optional[float]) -> None:
+        instance_id, args = cls._expire_args(target, seconds)
+        if not await cls._aclient(instance_id).expire(1, *args):
+            raise InstanceNotFound
+
+    @InstanceOrIdMethod
+    @instrumented("expires_at")
+    def expires_at(cls, target: Union[str, "RedormBase"]) -> Optional[float]:
+        # The unix time an instance expires at, None if it doesn't
+        instance_id = target.id if isinstance(target, RedormBase) else target
+        return cls._client(instance_id).reader.zscore(cls._plan().expiry_key, instance_id)
+
+    @InstanceOrIdMethod
+    @instrumented("aexpires_at")
+    async def aexpires_at(cls, target: Union[str, "RedormBase"]) -> Optional[float]:
+        instance_id = target.id if isinstance(target, RedormBase) else target
+        return await cls._aclient(instance_id).reader.zscore(cls._plan().expiry_key, instance_id)
+
+    @classmethod
+    def _expire_args(cls, target: Union[str, "RedormBase"], seconds: Optional[float]) -> Tuple[str, List]:
+        plan = cls._plan()
+        if not plan.expiring:
+            raise ValueError(f"{cls.__name__} instances can't expire without a ttl in its Meta")
+        instance_id = target.id if isinstance(target, RedormBase) else target
+        expire_at = "" if seconds is None else repr(time.time() + seconds)
+        return instance_id, [plan.member_key(instance_id), instance_id, plan.key_prefix, expire_at]
+
+    @classmethod
+    def _queue_deletes(cls, pipelines: PipelineGroup, ids: List[str], args: List) -> List[Tuple[str, object, int]]:
+        plan = cls._plan()
+        positions = []
+        for instance_id in ids:
+            client = pipelines.client(cls._database(), instance_id)
+            pipeline = pipelines.on(client)
+            client.queue_evalsha(
+                pipeline, client.delete_script, 2, plan.member_key(instance_id), plan.all_key, instance_id, *args
+            )
+            positions.append((instance_id, client, len(pipeline) - 1))
+        return positions
+
+    @classmethod
+    def _deleted(
+        cls, pipelines: PipelineGroup, results: Dict[object, List], positions: List[Tuple[str, object, int]], ends
+    ) -> int:
+        # Counts the deletes and queues the cleanup of relationship ends on other nodes
+        deleted = 0
+        for instance_id, client, position in positions:
+            removed = results[client][position]
+            if removed[0]:
+                deleted += 1
+                cls._queue_unlinked(pipelines, instance_id, ends, removed[1:])
+        return deleted
+
+    @classmethod
+    def _same_node(cls, model: Type["RedormBase"]) -> bool:
+        # Whether scripts run for this model can use another model's keys too. A model in a database that isn't bound
+        # can't be, and is only resolved once an instance turns out to be related to one of its instances.
+        database = cls._database()
+        if database.cluster or database.sharded:
+            return False
+        try:
+            return model._database() is database
+        except UnknownDatabase:
+            return False
+
+    @classmethod
+    def _relationship_ends(cls) -> List[Tuple[str, bool, Type["RedormBase"], Optional[str], bool]]:
+        # The relationship keys an instance may hold: the name, whether it's a set, and the other end's model,
+        # relationship name and whether that's a set. Includes backrefs only declared on the other model.
+        ends = [
+            (name, rel.to_many, rel.get_foreign_type(), rel.backref, rel.many_to)
+            for name, rel in cls._relationships.items()
+        ]
+        names = set(cls._relationships)
+        for model in all_models.values():
+            for name, rel in model._relationships.items():
+                if rel.backref is not None and rel.foreign_name == cls.__name__ and rel.backref not in names:
+                    names.add(rel.backref)
+                    ends.append((rel.backref, rel.many_to, model, name, rel.to_many))
+        return ends
+
+    @classmethod
+    def _delete_args(cls, ends) -> List[Union[str, int]]:
+        # Arguments of the delete script after the instance id
+        plan = cls._plan()
+        args = [plan.key_prefix, plan.storage, len(plan.unique), len(plan.index), len(plan.ranged), len(plan.lexical)]
+        args.extend(f.name for f in (*plan.unique, *plan.index, *plan.ranged))
+        for f in plan.lexical:
+            args.extend(("1" if f.casefold else "0", f.name))
+        args.append(len(ends))
+        for name, many, model, other_name, other_many in ends:
+            local = other_name is not None and cls._same_node(model)
+            other_prefix = f"{model._plan().relationship_prefix}{other_name}:" if local else ""
+            args.extend(
+                (f"{plan.relationship_prefix}{name}:", "1" if many else "0", other_prefix, "1" if other_many else "0")
+            )
+        return args
+
+    @classmethod
+    def _queue_unlinked(cls, pipelines: PipelineGroup, instance_id: str, ends, related: List[List[str]]) -> None:
+        # Removes a deleted instance from the other end of its relationships, where the script couldn't reach
+        for (_, _, model, other_name, other_many), related_ids in zip(ends, related):
+            if other_name is None or not related_ids or cls._same_node(model):
+                continue
+            prefix = f"{model._plan().relationship_prefix}{other_name}:"
+            for related_id in related_ids:
+                if other_many:
+                    pipelines.of(model, related_id).srem(prefix + related_id, instance_id)
+                else:
+                    pipelines.of(model, related_id).delete(prefix + related_id)
 
+    @instrumented("refresh")
     def refresh(self) -> None:
-        latest = red.client.get(f"{self.__class__.__name__}:member:{self.id}")
-        if latest is None:
+        if self._plan().storage == "json":
+            self._apply_latest(self._client(self.id).client.get(self._member_key()))
+        else:
+            self._apply_latest(self._client(self.id).client.hgetall(self._member_key()))
+
+    @instrumented("arefresh")
+    async def arefresh(self) -> None:
+        if self._plan().storage == "json":
+            self._apply_latest(await self._aclient(self.id).client.get(self._member_key()))
+        else:
+            self._apply_latest(await self._aclient(self.id).client.hgetall(self._member_key()))
+
+    def _apply_latest(self, latest: Union[None, str, dict]) -> None:
+        if not latest:
             raise InstanceNotFound
-        for k, v in json.loads(latest).items():
-            setattr(self, k, v)
-        for k, v in self._relationships.items():
-            v.cached_class = None
-            v.cached_ref = None
+        stored = self._from_member(latest)
+        for name in self._plan().fields:
+            self.__dict__[name] = stored.__dict__[name]
+        self._fully_loaded()
+        self._relationship_cache().clear()
 
+    def _relationship_cache(self) -> Dict[str, dict]:
+        # Per instance cache of related ids ("ref") and related instances ("loaded") keyed by relationship name
+        return self.__dict__.setdefault("_related", {})
+
+    @instrumented("save")
     def save(self) -> None:
-        old_json = red.client.get(f"{self.__class__.__name__}:member:{self.id}")
-        if old_json is None:
-            old_dict = {}
-            new = True
-        else:
-            old = self.__class__.from_json(old_json)
-            old_dict = old.to_dict(omit_none=False)
-            new = False
-        instance_dict = self.to_dict(omit_none=True)
-        instance_fields = fields(self.__class__)
-        key_changes: List[FieldChange] = [
-            FieldChange(f.name, old_dict.get(f.name), instance_dict.get(f.name))
-            for f in instance_fields
-            if f.metadata.get("unique") and (new or instance_dict.get(f.name) != old_dict.get(f.name))
-        ]
-        index_changes: List[FieldChange] = [
-            FieldChange(f.name, old_dict.get(f.name), instance_dict.get(f.name))
-            for f in instance_fields
-            if not f.metadata.get("unique")
-            and f.metadata.get("index")
-            and (new or instance_dict.get(f.name) != old_dict.get(f.name))
-        ]
-        data = json.dumps(instance_dict, sort_keys=True)
+        session = current_session.get()
+        if session is not None:
+            session.add(self)
+            return
         try:
-            self._atomic_unique_save(key_changes=key_changes, index_changes=index_changes, data=data)
+            result = self._client(self.id).unique_save(2, *self._save_args(self._loaded_fields()))
         except ResponseError as e:
-            raise UniqueContstraintViolation(*e.args) from e
+            raise self._save_error(e) from e
+        self._record_version(result)
 
+    @instrumented("asave")
+    async def asave(self) -> None:
+        session = current_session.get()
+        if session is not None:
+            session.add(self)
+            return
+        try:
+            result = await self._aclient(self.id).unique_save(2, *self._save_args(self._loaded_fields()))
+        except ResponseError as e:
+            raise self._save_error(e) from e
+        self._record_version(result)
+
+    @staticmethod
+    def _save_error(error: ResponseError) -> RedormException:
+        message = str(error)
+        if message.startswith("Version Conflict"):
+            return VersionConflict(*error.args)
+        if message.startswith("Not Found"):
+            return InstanceNotFound(*error.args)
+        if message.startswith("Bounds Exceeded"):
+            return BoundsExceeded(*error.args)
+        return UniqueContstraintViolation(*error.args)
+
+    def _record_version(self, result) -> None:
+        # The save script returns the version it stored for versioned models
+        version = self._plan().version
+        if version is not None and result is not None:
+            self.__dict__[version.name] = int(result)
+
+    def _loaded_fields(self) -> Optional[Set[str]]:
+        # Instances loaded with a projection only write back the fields they hold
+        deferred = self.__dict__.get("_deferred")
+        if not deferred:
+            return None
+        return self._plan().field_names - deferred
+
+    def _save_args(self, patch: Optional[Set[str]] = None) -> List:
+        # The script diffs against the stored document, so every unique, index and range field is sent.
+        # With a patch (hash storage only) just the named fields are written and diffed.
+        plan = self._plan()
+        instance_dict = plan.encode(self, patch)
+        expected = ""
+        if plan.version is not None and patch is None:
+            # Only saved if the stored document is still at the version this instance was read at
+            expected = str(getattr(self, plan.version.name) or 0)
+            instance_dict[plan.version.mapped_name] = int(expected) + 1
+        return self._write_args(self.id, instance_dict, patch, expected)
+
+    @classmethod
+    def _write_args(cls, instance_id: str, instance_dict: dict, patch: Optional[Set[str]], expected: str = "") -> List:
+        plan = cls._plan()
+        if patch is not None and plan.version is not None:
+            # The script increments the version of patched documents itself
+            patch = patch - {plan.version.name}
+        counts, triples = plan.index_args(instance_dict, patch)
+        if plan.storage == "json":
+            if patch is not None:
+                raise NotImplementedError("Partial writes require the hash storage layout")
+            data = plan.codec.dumps(instance_dict)
+            mode = "json"
+        else:
+            if patch is not None:
+                # Nulls are kept so the script can clear those hash fields
+                instance_dict = {name: instance_dict.get(name) for name in patch}
+            data = json.dumps({k: None if v is None else json.dumps(v) for k, v in instance_dict.items()})
+            mode = "hash" if patch is None else "hashpatch"
+        version = "" if plan.version is None else plan.version.name
+        # Only applied by the script when the instance is new
+        expire_at = "" if plan.ttl is None else repr(time.time() + plan.ttl)
+        # Unique values of instances that have expired are free to take, even before they're swept
+        now = repr(time.time()) if plan.expiring else ""
+        return [
+            plan.member_key(instance_id),
+            plan.all_key,
+            data,
+            instance_id,
+            plan.key_prefix,
+            *counts,
+            mode,
+            version,
+            expected,
+            expire_at,
+            now,
+            *triples,
+        ]
+
+    @instrumented("update")
     def update(self, **kwargs):
-        with red.client.lock(f"{self.__class__.__name__}:lock:{self.id}"):
-            self.refresh()
+        session = current_session.get()
+        if session is not None:
             for k, v in kwargs.items():
                 setattr(self, k, v)
+            session.add(self)
+            return
+        if self._plan().storage == "hash":
+            # Written before anything changes here, so a unique or version check failing leaves the instance as it was
+            try:
+                result = self._client(self.id).unique_save(2, *self._patch_args(self.id, kwargs))
+            except ResponseError as e:
+                raise self._save_error(e) from e
+            self._patch(kwargs)
+            self._record_version(result)
+            return
+        self._read_modify_write(
+            lambda: self.__dict__.update((k, v) for k, v in kwargs.items() if k not in self._relationships)
+        )
+        for k, v in kwargs.items():
+            if k in self._relationships:
+                setattr(self, k, v)
+
+    def _read_modify_write(self, modify: Callable[[], None]) -> None:
+        # Lock free on versioned models, retried when another writer saves between the read and the write
+        if self._plan().version is not None:
+            for attempt in range(VERSION_RETRIES):
+                self.refresh()
+                modify()
+                try:
+                    self.save()
+                    return
+                except VersionConflict:
+                    if attempt == VERSION_RETRIES - 1:
+                        raise
+        with self._client(self.id).client.lock(self._plan().lock_prefix + self.id):
+            self.refresh()
+            modify()
             self.save()
 
-    def _atomic_unique_save(self, key_changes: List[FieldChange], index_changes: List[FieldChange], data: str):
-        unique = [change for change in key_changes if change.new is not None]
-        unique_null = [change for change in key_changes if change.new is None]
-        index = [change for change in index_changes if change.new is not None]
-        index_null = [change for change in index_changes if change.new is None]
-        args = [
-            len(unique),
-            len(unique_null),
-            len(index),
-            len(index_null),
-            data,
-            self.id,
-            self.__class__.__name__,
-            *[elem for change in unique for elem in change],
-            *[elem for change in unique_null for elem in change],
-            *[elem for change in index for elem in change],
-            *[elem for change in index_null for elem in change],
+    @instrumented("aupdate")
+    async def aupdate(self, **kwargs):
+        session = current_session.get()
+        if session is not None:
+            for k, v in kwargs.items():
+                setattr(self, k, v)
+            session.add(self)
+            return
+        if self._plan().storage == "hash":
+            try:
+                result = await self._aclient(self.id).unique_save(2, *self._patch_args(self.id, kwargs))
+            except ResponseError as e:
+                raise self._save_error(e) from e
+            for k, v in kwargs.items():
+                if k in self._relationships:
+                    await self._relationships[k].aset(self, v)
+                else:
+                    self.__dict__[k] = v
+            self._record_version(result)
+            return
+        await self._aread_modify_write(
+            lambda: self.__dict__.update((k, v) for k, v in kwargs.items() if k not in self._relationships)
+        )
+        for k, v in kwargs.items():
+            if k in self._relationships:
+                await self._relationships[k].aset(self, v)
+
+    async def _aread_modify_write(self, modify: Callable[[], None]) -> None:
+        if self._plan().version is not None:
+            for attempt in range(VERSION_RETRIES):
+                await self.arefresh()
+                modify()
+                try:
+                    await self.asave()
+                    return
+                except VersionConflict:
+                    if attempt == VERSION_RETRIES - 1:
+                        raise
+        async with self._aclient(self.id).client.lock(self._plan().lock_prefix + self.id):
+            await self.arefresh()
+            modify()
+            await self.asave()
+
+    @classmethod
+    @instrumented("update_where")
+    def update_where(cls, instance_id: str, **changes) -> None:
+        # Hash documents are patched by the save script without being read. JSON documents can only be rewritten
+        # whole, so those are updated as by update().
+        if cls._plan().storage == "json":
+            cls.get(instance_id).update(**changes)
+            return
+        try:
+            cls._client(instance_id).unique_save(2, *cls._patch_args(instance_id, changes))
+        except ResponseError as e:
+            raise cls._save_error(e) from e
+        for k, v in changes.items():
+            if k in cls._relationships:
+                rel = cls._relationships[k]
+                rel._relate(instance_id, "set", rel._id_list(rel._related_ids(v)))
+
+    @classmethod
+    @instrumented("aupdate_where")
+    async def aupdate_where(cls, instance_id: str, **changes) -> None:
+        if cls._plan().storage == "json":
+            await (await cls.aget(instance_id)).aupdate(**changes)
+            return
+        try:
+            await cls._aclient(instance_id).unique_save(2, *cls._patch_args(instance_id, changes))
+        except ResponseError as e:
+            raise cls._save_error(e) from e
+        for k, v in changes.items():
+            if k in cls._relationships:
+                rel = cls._relationships[k]
+                await rel._arelate(instance_id, "set", rel._id_list(rel._related_ids(v)))
+
+    @InstanceOrIdMethod
+    @instrumented("incr")
+    def incr(
+        cls,
+        target: Union[str, "RedormBase"],
+        name: str,
+        amount: Union[int, float] = 1,
+        minimum: Union[int, float, None] = None,
+        maximum: Union[int, float, None] = None,
+    ) -> Union[int, float]:
+        # Adds to a numeric field atomically and returns the new value. Raises BoundsExceeded rather than going
+        # past minimum or maximum.
+        f, number = cls._number_field(name, amount)
+        if cls._plan().storage == "json":
+            # JSON documents can't be changed in place by a script, so they're rewritten as by update()
+            instance = target if isinstance(target, RedormBase) else cls.get(target)
+            instance._read_modify_write(lambda: instance._add(f, amount, minimum, maximum))
+            return getattr(instance, name)
+        instance_id = target.id if isinstance(target, RedormBase) else target
+        try:
+            value, version = cls._client(instance_id).incr(1, *cls._incr_args(instance_id, f, amount, minimum, maximum))
+        except ResponseError as e:
+            raise cls._save_error(e) from e
+        value = number(value)
+        if isinstance(target, RedormBase):
+            target.__dict__[name] = value
+            target._record_version(version)
+        return value
+
+    @InstanceOrIdMethod
+    @instrumented("decr")
+    def decr(cls, target, name: str, amount: Union[int, float] = 1, minimum=None, maximum=None) -> Union[int, float]:
+        return cls.incr(target, name, -amount, minimum, maximum)
+
+    @InstanceOrIdMethod
+    @instrumented("aincr")
+    async def aincr(
+        cls,
+        target: Union[str, "RedormBase"],
+        name: str,
+        amount: Union[int, float] = 1,
+        minimum: Union[int, float, None] = None,
+        maximum: Union[int, float, None] = None,
+    ) -> Union[int, float]:
+        f, number = cls._number_field(name, amount)
+        if cls._plan().storage == "json":
+            instance = target if isinstance(target, RedormBase) else await cls.aget(target)
+            await instance._aread_modify_write(lambda: instance._add(f, amount, minimum, maximum))
+            return getattr(instance, name)
+        instance_id = target.id if isinstance(target, RedormBase) else target
+        try:
+            value, version = await cls._aclient(instance_id).incr(
+                1, *cls._incr_args(instance_id, f, amount, minimum, maximum)
+            )
+        except ResponseError as e:
+            raise cls._save_error(e) from e
+        value = number(value)
+        if isinstance(target, RedormBase):
+            target.__dict__[name] = value
+            target._record_version(version)
+        return value
+
+    @InstanceOrIdMethod
+    @instrumented("adecr")
+    async def adecr(
+        cls, target, name: str, amount: Union[int, float] = 1, minimum=None, maximum=None
+    ) -> Union[int, float]:
+        return await cls.aincr(target, name, -amount, minimum, maximum)
+
+    @classmethod
+    def _number_field(cls, name: str, amount) -> Tuple[FieldPlan, type]:
+        f = cls._plan().fields.get(name)
+        if f is None:
+            raise UnknownFieldName(f"{cls.__name__} has no field {name!r}")
+        if f.number is None or (f.number is int and not isinstance(amount, int)):
+            raise ValueError(f"Can't add {amount!r} to {cls.__name__}.{name}")
+        return f, f.number
+
+    def _add(self, f: FieldPlan, amount, minimum, maximum) -> None:
+        value = (getattr(self, f.name) or 0) + amount
+        if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+            raise BoundsExceeded(f"Bounds Exceeded: {f.name}")
+        self.__dict__[f.name] = value
+
+    @classmethod
+    def _incr_args(cls, instance_id: str, f: FieldPlan, amount, minimum, maximum) -> List:
+        plan = cls._plan()
+        return [
+            plan.member_key(instance_id),
+            instance_id,
+            plan.key_prefix,
+            f.name,
+            amount,
+            "int" if f.number is int else "float",
+            "unique" if f.unique else "index" if f.index else "",
+            "1" if f.range_index else "0",
+            "" if minimum is None else minimum,
+            "" if maximum is None else maximum,
+            "" if plan.version is None else plan.version.name,
+            repr(time.time()) if plan.expiring else "",
         ]
-        args_no_none = ["" if arg is None else arg for arg in args]
-        red.unique_save(0, *args_no_none)
+
+    @classmethod
+    def _patch_args(cls, instance_id: str, changes: dict) -> List:
+        plan = cls._plan()
+        for k in changes:
+            if k not in plan.fields and k not in cls._relationships:
+                raise UnknownFieldName(f"{cls.__name__} has no field {k!r}")
+        fields = {plan.fields[k]: v for k, v in changes.items() if k in plan.fields}
+        document = {f.mapped_name: f.encode_value(v) for f, v in fields.items()}
+        return cls._write_args(instance_id, document, {f.name for f in fields})
+
+    def _patch(self, kwargs: dict) -> None:
+        for k, v in kwargs.items():
+            if k in self._relationships:
+                setattr(self, k, v)
+            else:
+                # Written straight to __dict__ so deferred fields aren't loaded just to be overwritten
+                self.__dict__[k] = v
+
+    async def aget_relationship(self, name: str):
+        return await self._relationships[name].aget(self)
+
+    async def aset_relationship(self, name: str, value) -> None:
+        await self._relationships[name].aset(self, value)
+
+    @instrumented("add_related")
+    def add_related(self, name: str, *related) -> None:
+        self._relationships[name].add(self, *related)
+
+    @instrumented("remove_related")
+    def remove_related(self, name: str, *related) -> None:
+        self._relationships[name].remove(self, *related)
+
+    @instrumented("aadd_related")
+    async def aadd_related(self, name: str, *related) -> None:
+        await self._relationships[name].aadd(self, *related)
+
+    @instrumented("aremove_related")
+    async def aremove_related(self, name: str, *related) -> None:
+        await self._relationships[name].aremove(self, *related)
 
     def __init_subclass__(cls, **kwargs):
-        all_models[cls.__name__] = cls
+        if "_projected_from" not in cls.__dict__:
+            all_models[cls.__name__] = cls
         super().__init_subclass__(**kwargs)
 
     def __hash__(self):
         return hash(f"{self.__class__.__name__}:{self.id}")
 
 
-class IRelationship:
-    pass
+@runtime_checkable
+class IRelationship(Protocol):
+    # What models use of relationships.Relationship, which imports this module
+    relationship_name: str
+    foreign_name: str
+    backref: Optional[str]
+    lazy: bool
+    to_many: bool
+    many_to: bool
+
+    def get_foreign_type(self) -> Type[RedormBase]:
+        ...
+
+    def backref_key(self, related_id: Optional[str]) -> str:
+        ...
+
+    def _queue_remote_backrefs(self, pipelines: PipelineGroup, instance_id: str, result: List[List[str]]) -> bool:
+        ...
@@ -0,0 +1,241 @@
+import string
+from dataclasses import dataclass, MISSING
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TYPE_CHECKING
+
+from dataclasses_jsonschema import is_optional, unwrap_optional
+
+from redorm.codecs import Codec, get_codec
+from redorm.ids import ID_FORMATS
+
+if TYPE_CHECKING:
+    from redorm.model import RedormBase
+
+__all__ = ["FieldPlan", "ModelPlan"]
+
+STORAGE_LAYOUTS = {"json", "hash"}
+LEX_LOOKUPS = {"startswith", "gt", "gte", "lt", "lte", "between"}
+# Case folding of prefix indexes only lowercases ASCII letters, as Lua's string.lower does in the scripts
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+@dataclass(frozen=True)
+class FieldPlan:
+    name: str
+    mapped_name: str
+    type: Any
+    unique: bool
+    index: bool
+    range_index: bool
+    # Kept in a sorted set of "value\0id" members for prefix and lexicographic range lookups
+    prefix_index: bool
+    casefold: bool
+    version: bool
+    # int or float for numeric fields, which can be incremented in place
+    number: Optional[type]
+    required: bool
+    # None where the value is stored as is
+    encode: Optional[Callable[[Any], Any]]
+    decode: Optional[Callable[[Any], Any]]
+    key: str
+    null_key: str
+    index_prefix: str
+    range_key: str
+    lex_key: str
+
+    def index_key(self, value) -> str:
+        return self.index_prefix + index_value(value)
+
+    def encode_value(self, value):
+        return value if value is None or self.encode is None else self.encode(value)
+
+    def decode_value(self, value):
+        return value if value is None or self.decode is None else self.decode(value)
+
+    def lex_value(self, value) -> bytes:
+        text = index_value(self.encode_value(value))
+        return (text.translate(ASCII_LOWER) if self.casefold else text).encode("utf-8")
+
+    def lex_bounds(self, lookup: str, value) -> Tuple[bytes, bytes]:
+        # ZRANGEBYLEX bounds matching members "value\0id". No UTF-8 string contains the byte 0xff, so it sorts
+        # after anything that can follow a value.
+        if lookup == "between":
+            low, high = (self.lex_value(bound) for bound in value)
+            return b"[" + low, b"[" + high + b"\x00\xff"
+        encoded = self.lex_value(value)
+        return {
+            "": (b"[" + encoded + b"\x00", b"[" + encoded + b"\x00\xff"),
+            "startswith": (b"[" + encoded, b"[" + encoded + b"\xff"),
+            "gt": (b"(" + encoded + b"\x00\xff", b"+"),
+            "gte": (b"[" + encoded, b"+"),
+            "lt": (b"-", b"(" + encoded),
+            "lte": (b"-", b"[" + encoded + b"\x00\xff"),
+        }[lookup]
+
+
+def lex_ids(members: List[str]) -> List[str]:
+    # The ids of prefix index members
+    return [member.rpartition("\0")[2] for member in members]
+
+
+def index_value(value) -> str:
+    # Canonical string form of an encoded value in unique and index keys, mirrored by the save script
+    if isinstance(value, str):
+        return value
+    elif isinstance(value, bool):
+        return str(value)
+    elif isinstance(value, float):
+        return "%.17g" % value
+    return str(value)
+
+
+class ModelPlan:
+    # Everything about a model that doesn't change once it's defined: key names, which fields are indexed and how,
+    # and the field encoders. Built once per model on first use, since dataclass fields don't exist yet when
+    # __init_subclass__ runs.
+    def __init__(self, cls: "Type[RedormBase]", hash_tags: bool = False, sharded: bool = False):
+        name = cls.__name__
+        meta = getattr(cls, "Meta", None)
+        self.name = name
+        # On a cluster every key of a model is hash tagged with its name, so they share a slot and can be used
+        # together in scripts and multi-key commands
+        self.hash_tags = hash_tags
+        self.sharded = sharded
+        # A shorter name can be given for the keys, and compact_keys shortens the keys every instance has
+        base = getattr(meta, "key_prefix", name)
+        self.key_prefix = f"{{{base}}}" if hash_tags else base
+        prefix = self.key_prefix
+        compact = getattr(meta, "compact_keys", False)
+        self.storage: str = getattr(meta, "storage", "json")
+        if self.storage not in STORAGE_LAYOUTS:
+            raise ValueError(f"Unknown storage layout {self.storage!r} for {name}, expected 'json' or 'hash'")
+        self.codec: Codec = get_codec(getattr(meta, "codec", None))
+        self.validate: bool = getattr(meta, "validate", False)
+        self.id_format: str = getattr(meta, "id_format", "uuid")
+        if self.id_format not in ID_FORMATS and self.id_format != "int":
+            raise ValueError(
+                f"Unknown id format {self.id_format!r} for {name}, expected one of uuid, base62, ulid or int"
+            )
+        # Counts up the ids of models with int ids
+        self.id_counter_key = f"{prefix}:ids"
+        self.member_prefix = f"{prefix}:m:" if compact else f"{prefix}:member:"
+        self.all_key = f"{prefix}:all"
+        self.lock_prefix = f"{prefix}:lock:"
+        self.user_lock_prefix = f"{prefix}:userlock:"
+        self.tmp_prefix = f"{prefix}:tmp:"
+        self.relationship_prefix = f"{prefix}:r:" if compact else f"{prefix}:relationship:"
+        # Instance ids by the unix time they expire at, for models with a ttl in their Meta (None for no default)
+        self.expiry_key = f"{prefix}:expiry"
+        self.expiring: bool = hasattr(meta, "ttl")
+        # Seconds new instances are kept for
+        self.ttl: Optional[float] = getattr(meta, "ttl", None)
+        self.fields: Dict[str, FieldPlan] = {}
+        for f in cls._get_fields():
+            field_name, field_type = f.field.name, f.field.type
+            metadata = f.field.metadata
+            encode, decode = self._converters(cls, field_name, field_type)
+            prefix_index = bool(metadata.get("prefix_index"))
+            if prefix_index and self._plain_type(field_type) is not str:
+                raise ValueError(f"Prefix index on {name}.{field_name}, which isn't a string field")
+            self.fields[field_name] = FieldPlan(
+                name=field_name,
+                mapped_name=f.mapped_name,
+                type=field_type,
+                unique=bool(metadata.get("unique")),
+                index=bool(metadata.get("index")) and not metadata.get("unique"),
+                range_index=bool(metadata.get("range_index")),
+                prefix_index=prefix_index,
+                casefold=prefix_index and bool(metadata.get("casefold")),
+                version=bool(metadata.get("version")),
+                number=self._number_type(field_type),
+                required=f.field.default is MISSING and f.field.default_factory is MISSING,
+                encode=encode,
+                decode=decode,
+                key=f"{prefix}:key:{field_name}",
+                null_key=f"{prefix}:{'keynull' if metadata.get('unique') else 'indexnull'}:{field_name}",
+                index_prefix=f"{prefix}:index:{field_name}:",
+                range_key=f"{prefix}:range:{field_name}",
+                lex_key=f"{prefix}:lex:{field_name}",
+            )
+        self.field_list: Tuple[FieldPlan, ...] = tuple(self.fields.values())
+        self.unique: Tuple[FieldPlan, ...] = tuple(f for f in self.field_list if f.unique)
+        # A node only enforces unique values among the instances it holds. Ids pick the node, so they stay unique.
+        shared = [f.name for f in self.unique if f.name != "id"]
+        if sharded and shared:
+            raise ValueError(
+                f"{name} is in a sharded database, which can't enforce unique fields ({', '.join(shared)}). "
+                "Use an index instead, or a database with one node."
+            )
+        self.index: Tuple[FieldPlan, ...] = tuple(f for f in self.field_list if f.index)
+        self.ranged: Tuple[FieldPlan, ...] = tuple(f for f in self.field_list if f.range_index)
+        self.lexical: Tuple[FieldPlan, ...] = tuple(f for f in self.field_list if f.prefix_index)
+        self.field_names = frozenset(self.fields)
+        versions = [f for f in self.field_list if f.version]
+        if len(versions) > 1:
+            raise ValueError(f"{name} has more than one version field")
+        # Checked and incremented by every save when present
+        self.version: Optional[FieldPlan] = versions[0] if versions else None
+
+    @staticmethod
+    def _plain_type(field_type):
+        return unwrap_optional(field_type) if is_optional(field_type) else field_type
+
+    @classmethod
+    def _number_type(cls, field_type) -> Optional[type]:
+        plain_type = cls._plain_type(field_type)
+        return plain_type if plain_type in (int, float) else None
+
+    @staticmethod
+    def _converters(cls, field_name: str, field_type) -> Tuple[Optional[Callable], Optional[Callable]]:
+        plain_type = unwrap_optional(field_type) if is_optional(field_type) else field_type
+        if plain_type in (str, int, float, bool):
+            return None, None
+        if plain_type in cls._field_encoders:
+            encoder = cls._field_encoders[plain_type]
+            return encoder.to_wire, encoder.to_python
+        return (
+            lambda v: cls._encode_field(field_type, v, omit_none=True),
+            lambda v: cls._decode_field(field_name, field_type, v),
+        )
+
+    def member_key(self, instance_id: str) -> str:
+        return self.member_prefix + instance_id
+
+    def encode(self, instance, names=None) -> dict:
+        # Equivalent of to_dict(omit_none=True), calling each field's encoder directly
+        document = {}
+        for f in self.field_list:
+            if names is not None and f.name not in names:
+                continue
+            value = getattr(instance, f.name)
+            if value is not None:
+                document[f.mapped_name] = value if f.encode is None else f.encode(value)
+        return document
+
+    def decode(self, document: dict) -> dict:
+        # Field values from a stored document, fields missing from it were None when saved
+        values = {}
+        for f in self.field_list:
+            value = document.get(f.mapped_name)
+            values[f.name] = value if value is None or f.decode is None else f.decode(value)
+        return values
+
+    def index_args(self, document: dict, names=None) -> Tuple[List[int], List[str]]:
+        # Counts of unique, index, range and prefix index fields, and a (name, not null, value) triple for each of
+        # them. Range triples carry the score as their value, and prefix index ones are preceded by '1' if case folded.
+        unique, index, ranged, lexical = self.unique, self.index, self.ranged, self.lexical
+        if names is not None:
+            unique, index, ranged, lexical = (
+                tuple(f for f in group if f.name in names) for group in (unique, index, ranged, lexical)
+            )
+        args: List[str] = []
+        for f in (*unique, *index):
+            value = document.get(f.mapped_name)
+            args.extend((f.name, "0", "") if value is None else (f.name, "1", index_value(value)))
+        for f in ranged:
+            value = document.get(f.mapped_name)
+            args.extend((f.name, "0", "") if value is None else (f.name, "1", repr(float(value))))
+        for f in lexical:
+            value = document.get(f.mapped_name)
+            folded = "1" if f.casefold else "0"
+            args.extend((folded, f.name, "0", "") if value is None else (folded, f.name, "1", index_value(value)))
+        return [len(unique), len(index), len(ranged), len(lexical)], args
@@ -0,0 +1,376 @@
+import asyncio
+from functools import partial
+from typing import Any, Dict, Generic, List, Optional, Set, Tuple, Type, TypeVar, Union, TYPE_CHECKING
+from uuid import uuid4
+
+from redorm.client import gather
+from redorm.exceptions import FilterOnUnindexedField, UnknownFieldName
+from redorm.instrumentation import instrumented
+from redorm.plan import index_value, lex_ids
+
+if TYPE_CHECKING:
+    from redorm.model import RedormBase
+
+__all__ = ["QuerySet"]
+
+S = TypeVar("S", bound="RedormBase")
+
+RANGE_LOOKUPS = {"gt", "gte", "lt", "lte", "between"}
+# Temporary keys are unlinked once used, the TTL only matters if a client dies part way through
+TEMP_KEY_TTL = 300
+
+# A node is either the name of a set in redis, a set of ids already fetched, or a set operation over other nodes
+Node = Union[str, Set[str], Tuple[str, List[Any]]]
+
+
+class Condition:
+    # The union of the sets and looked up ids that satisfy one filter argument
+    def __init__(self):
+        self.keys: List[str] = []
+        self.lookups: List[int] = []
+        # Prefix index lookups, whose results are members rather than ids
+        self.lex_lookups: List[int] = []
+        self.ids: Set[str] = set()
+        self.estimate = 0
+
+    def resolve(self, probe_results: List, scards: Dict[str, int]) -> None:
+        for position in self.lookups:
+            result = probe_results[position]
+            if isinstance(result, list):
+                self.ids.update(result)
+            elif result is not None:
+                self.ids.add(result)
+        for position in self.lex_lookups:
+            self.ids.update(lex_ids(probe_results[position]))
+        # An upper bound on the size of the union
+        self.estimate = len(self.ids) + sum(probe_results[scards[key]] for key in self.keys)
+
+    def node(self) -> Node:
+        parts: List[Node] = list(self.keys)
+        if self.ids:
+            parts.append(self.ids)
+        if not parts:
+            return set()
+        return parts[0] if len(parts) == 1 else ("sunion", parts)
+
+
+class QuerySet(Generic[S]):
+    # A lazy, chainable filter over a model's indexes, evaluated with server side set operations.
+    # filter() ANDs its arguments, filter_any() ORs them and exclude() removes rows matching all of its arguments.
+    # Chained calls are ANDed together.
+
+    def __init__(self, model: Type[S], groups: Tuple[Tuple[str, Tuple[Tuple[str, Any], ...]], ...] = ()):
+        self.model = model
+        self.groups = groups
+
+    def _with(self, kind: str, kwargs: dict) -> "QuerySet[S]":
+        if not kwargs:
+            return self
+        return QuerySet(self.model, self.groups + ((kind, tuple(kwargs.items())),))
+
+    def filter(self, **kwargs) -> "QuerySet[S]":
+        return self._with("all", kwargs)
+
+    def filter_any(self, **kwargs) -> "QuerySet[S]":
+        return self._with("any", kwargs)
+
+    def exclude(self, **kwargs) -> "QuerySet[S]":
+        return self._with("not", kwargs)
+
+    @instrumented("query.ids")
+    def ids(self) -> Set[str]:
+        # Expired instances stay in the indexes until they're swept
+        return set().union(*self._gather(False)) - self.model._expired_ids()
+
+    @instrumented("query.count")
+    def count(self) -> int:
+        if self.model._plan().expiring:
+            return len(self.ids())
+        return sum(self._gather(True))
+
+    @instrumented("query.exists")
+    def exists(self) -> bool:
+        return self.count() > 0
+
+    @instrumented("query.all")
+    def all(self, prefetch: Optional[List[str]] = None, only: Optional[List[str]] = None) -> List[S]:
+        return self.model.get_bulk(self.ids(), prefetch=prefetch, only=only)
+
+    def __iter__(self):
+        return iter(self.all())
+
+    @instrumented("query.aids")
+    async def aids(self) -> Set[str]:
+        return set().union(*await self._agather(False)) - await self.model._aexpired_ids()
+
+    @instrumented("query.acount")
+    async def acount(self) -> int:
+        if self.model._plan().expiring:
+            return len(await self.aids())
+        return sum(await self._agather(True))
+
+    @instrumented("query.aexists")
+    async def aexists(self) -> bool:
+        return await self.acount() > 0
+
+    @instrumented("query.aall")
+    async def aall(self, prefetch: Optional[List[str]] = None, only: Optional[List[str]] = None) -> List[S]:
+        return await self.model.aget_bulk(await self.aids(), prefetch=prefetch, only=only)
+
+    def _gather(self, count: bool) -> List:
+        # Evaluated on every shard of the model, in parallel
+        refs = self._remote_refs()
+        remote = self.model._fetch_backrefs(refs) if refs else {}
+        clients = self.model._database().clients
+        return gather([partial(self._evaluate, client, count, remote) for client in clients])
+
+    async def _agather(self, count: bool) -> List:
+        refs = self._remote_refs()
+        remote = await self.model._afetch_backrefs(refs) if refs else {}
+        clients = self.model._database().async_clients
+        return await asyncio.gather(*(self._aevaluate(client, count, remote) for client in clients))
+
+    def _remote_refs(self) -> List[Tuple[Any, str]]:
+        # Relationship filters whose backrefs are on another node, read before evaluating
+        refs = []
+        for _, items in self.groups:
+            for k, v in items:
+                name, _, lookup = k.partition("__")
+                rel = self.model._relationships.get(name)
+                if rel is None or rel.to_many or rel.backref is None or self.model._local_backrefs(rel):
+                    continue
+                for value in v if lookup == "in" else [v]:
+                    refs.append((rel, value if isinstance(value, str) else value.id))
+        return refs
+
+    def _evaluate(self, client, count: bool, remote: Dict[str, Set[str]]):
+        probe = client.read_pipeline(transaction=False)
+        groups, scards = self._queue_probe(probe, remote)
+        root = self._plan_root(groups, scards, probe.execute() if len(probe) else [])
+        if isinstance(root, set):
+            return len(root) if count else root
+        leaves = self._split_leaves(client, root)
+        if leaves is not None:
+            p = client.read_pipeline(transaction=False)
+            for key in leaves:
+                p.smembers(key)
+            ids = self._compute(root, dict(zip(leaves, p.execute())))
+            return len(ids) if count else ids
+        p = self._root_pipeline(client, root, count)
+        position = self._queue_root(p, root, count)
+        return self._result(p.execute()[position], count)
+
+    async def _aevaluate(self, client, count: bool, remote: Dict[str, Set[str]]):
+        probe = client.read_pipeline(transaction=False)
+        groups, scards = self._queue_probe(probe, remote)
+        root = self._plan_root(groups, scards, await probe.execute() if len(probe) else [])
+        if isinstance(root, set):
+            return len(root) if count else root
+        leaves = self._split_leaves(client, root)
+        if leaves is not None:
+            p = client.read_pipeline(transaction=False)
+            for key in leaves:
+                p.smembers(key)
+            ids = self._compute(root, dict(zip(leaves, await p.execute())))
+            return len(ids) if count else ids
+        p = self._root_pipeline(client, root, count)
+        position = self._queue_root(p, root, count)
+        return self._result((await p.execute())[position], count)
+
+    @staticmethod
+    def _root_pipeline(client, root: Node, count: bool):
+        # Temporary keys have to be written on the primary, anything else can be read from a replica
+        if isinstance(root, str):
+            return client.read_pipeline()
+        op, children = root
+        if (count and op != "sinter") or not all(isinstance(child, str) for child in children):
+            return client.pipeline(temporary=True)
+        return client.read_pipeline()
+
+    def _split_leaves(self, client, root: Node) -> Optional[List[str]]:
+        # On a cluster, relationship sets live in the related model's slot. When the sets can't all be used in one
+        # command, returns them so they are read and combined here instead.
+        leaves: List[str] = []
+        self._collect_leaves(root, leaves)
+        if len(client.slot_groups([self.model._plan().tmp_prefix, *leaves])) > 1:
+            return leaves
+        return None
+
+    def _collect_leaves(self, node: Node, leaves: List[str]) -> None:
+        if isinstance(node, str):
+            if node not in leaves:
+                leaves.append(node)
+        elif not isinstance(node, set):
+            for child in node[1]:
+                self._collect_leaves(child, leaves)
+
+    def _compute(self, node: Node, members: Dict[str, Set[str]]) -> Set[str]:
+        if isinstance(node, str):
+            return set(members[node])
+        if isinstance(node, set):
+            return node
+        op, children = node
+        first, *rest = [self._compute(child, members) for child in children]
+        if op == "sinter":
+            return first.intersection(*rest)
+        if op == "sunion":
+            return first.union(*rest)
+        return first.difference(*rest)
+
+    @staticmethod
+    def _result(result, count: bool):
+        return result if count else set(result)
+
+    def _queue_probe(
+        self, probe, remote: Dict[str, Set[str]]
+    ) -> Tuple[List[Tuple[str, List[Condition]]], Dict[str, int]]:
+        # First round trip: cardinalities of every set involved, and the ids behind unique, range and one-to-one
+        # lookups, so operands can be ordered and empty intersections skipped
+        groups = []
+        for kind, items in self.groups:
+            groups.append((kind, [self._condition(probe, k, v, remote) for k, v in items]))
+        scards: Dict[str, int] = {}
+        for _, conditions in groups:
+            for condition in conditions:
+                for key in condition.keys:
+                    if key not in scards:
+                        probe.scard(key)
+                        scards[key] = len(probe) - 1
+        return groups, scards
+
+    def _condition(self, probe, k: str, v, remote: Dict[str, Set[str]]) -> Condition:
+        condition = Condition()
+        name, _, lookup = k.partition("__")
+        if lookup == "in":
+            for value in v:
+                self._add_atom(probe, condition, name, "", value, remote)
+        else:
+            self._add_atom(probe, condition, name, lookup, v, remote)
+        return condition
+
+    def _add_atom(self, probe, condition: Condition, name: str, lookup: str, v, remote: Dict[str, Set[str]]) -> None:
+        model = self.model
+        plan = model._plan()
+        f = plan.fields.get(name)
+        if f is not None:
+            if lookup or (f.prefix_index and not (f.unique or f.index)):
+                if model._queue_range_lookup(probe, f, lookup, v):
+                    condition.lex_lookups.append(len(probe) - 1)
+                else:
+                    condition.lookups.append(len(probe) - 1)
+            elif v is None and (f.unique or f.index):
+                condition.keys.append(f.null_key)
+            elif f.unique:
+                probe.hget(f.key, index_value(f.encode_value(v)))
+                condition.lookups.append(len(probe) - 1)
+            elif f.index:
+                condition.keys.append(f.index_key(f.encode_value(v)))
+            elif f.range_index:
+                if v is None:
+                    raise ValueError("Range filters do not match null values")
+                probe.zrangebyscore(f.range_key, *model._range_bounds(f, "between", (v, v)))
+                condition.lookups.append(len(probe) - 1)
+            else:
+                raise FilterOnUnindexedField(f"Trying to filter on unindexed field: {name}")
+            return
+        rel = model._relationships.get(name)
+        if rel is None or lookup:
+            raise UnknownFieldName(name)
+        if rel.to_many:
+            raise NotImplementedError("Can't filter based off to-many relationships")
+        if rel.backref is None:
+            raise NotImplementedError("Filtering on a relationship requires a backref")
+        ref = rel.backref_key(v if isinstance(v, str) else v.id)
+        if ref in remote:
+            condition.ids.update(remote[ref])
+        elif rel.many_to:
+            condition.keys.append(ref)
+        else:
+            probe.get(ref)
+            condition.lookups.append(len(probe) - 1)
+
+    def _plan_root(
+        self, groups: List[Tuple[str, List[Condition]]], scards: Dict[str, int], probe_results: List
+    ) -> Node:
+        # Builds the tree of set operations, smallest operands first, pruning whatever can't match.
+        # Returns an empty set when the result is known to be empty without a second round trip.
+        for _, conditions in groups:
+            for condition in conditions:
+                condition.resolve(probe_results, scards)
+        positives: List[Tuple[int, Node]] = []
+        negatives: List[Node] = []
+        for kind, conditions in groups:
+            if kind == "any":
+                matching = [c for c in conditions if c.estimate > 0]
+                if not matching:
+                    return set()
+                nodes = [c.node() for c in matching]
+                positives.append(
+                    (sum(c.estimate for c in matching), nodes[0] if len(nodes) == 1 else ("sunion", nodes))
+                )
+                continue
+            if any(c.estimate == 0 for c in conditions):
+                if kind == "all":
+                    return set()
+                # An exclusion that matches nothing removes nothing
+                continue
+            conditions = sorted(conditions, key=lambda c: c.estimate)
+            nodes = [c.node() for c in conditions]
+            node = nodes[0] if len(nodes) == 1 else ("sinter", nodes)
+            if kind == "all":
+                positives.append((conditions[0].estimate, node))
+            else:
+                negatives.append(node)
+        positives.sort(key=lambda p: p[0])
+        if not positives:
+            root: Node = self.model._plan().all_key
+        elif len(positives) == 1:
+            root = positives[0][1]
+        else:
+            root = ("sinter", [node for _, node in positives])
+        if negatives:
+            root = ("sdiff", [root, *negatives])
+        return root
+
+    def _queue_root(self, p, root: Node, count: bool) -> int:
+        # Second round trip, in one transaction: materialise inner operations into temporary keys,
+        # run the outermost operation directly, then drop the temporary keys.
+        temps: List[str] = []
+        if isinstance(root, str) and count:
+            p.scard(root)
+        elif isinstance(root, str):
+            p.smembers(root)
+        else:
+            op, children = root
+            keys = [self._materialize(p, child, temps) for child in children]
+            if count and op == "sinter":
+                # Redis 7 and later count an intersection without storing it
+                p.sintercard(len(keys), keys)
+            elif count:
+                temp = self._temp_key(p, temps)
+                getattr(p, op + "store")(temp, keys)
+                p.expire(temp, TEMP_KEY_TTL)
+                p.scard(temp)
+            else:
+                getattr(p, op)(keys)
+        position = len(p) - 1
+        if temps:
+            p.unlink(*temps)
+        return position
+
+    def _materialize(self, p, node: Node, temps: List[str]) -> str:
+        if isinstance(node, str):
+            return node
+        temp = self._temp_key(p, temps)
+        if isinstance(node, set):
+            p.sadd(temp, *node)
+        else:
+            op, children = node
+            getattr(p, op + "store")(temp, [self._materialize(p, child, temps) for child in children])
+        p.expire(temp, TEMP_KEY_TTL)
+        return temp
+
+    def _temp_key(self, p, temps: List[str]) -> str:
+        temp = f"{self.model._plan().tmp_prefix}{uuid4()}"
+        temps.append(temp)
+        return temp
@@ -1,7 +1,10 @@
-from typing import List, Type, Optional, TypeVar, Union
+from typing import List, Type, Optional, TypeVar, Union, Set, Tuple
 from enum import Enum, auto
 from redorm.model import RedormBase, all_models, IRelationship
-from redorm.client import red
+from redorm.client import PipelineGroup
+from redorm.exceptions import InstanceNotFound
+from redorm.instrumentation import logger
+from redorm.session import current_session
 
 __all__ = [
     "RelationshipConfigEnum",
@@ -26,6 +29,9 @@ U = TypeVar("U", bound=RedormBase)
 
 # noinspection PyProtectedMember
 class Relationship(IRelationship):
+    # The model the relationship is declared on, set along with its name by __set_name__
+    __owner: Type[RedormBase]
+
     def __init__(
         self,
         foreign_type: Union[str, Type[U]],
@@ -35,11 +41,11 @@ class Relationship(IRelationship):
     ):
         self.config = config
         if isinstance(foreign_type, str):
-            self.foreign_type = None
-            self.__foreign_type = foreign_type
+            self.foreign_type: Optional[Type[RedormBase]] = None
+            self.foreign_name = foreign_type
         else:
             self.foreign_type = foreign_type
-            self.__foreign_type = foreign_type.__name__
+            self.foreign_name = foreign_type.__name__
         self.fdel = None
         self.backref = backref
         self.to_many = config in {
@@ -50,23 +56,28 @@ class Relationship(IRelationship):
             RelationshipConfigEnum.MANY_TO_MANY,
             RelationshipConfigEnum.MANY_TO_ONE,
         }
-        self.relationship_name = None
         self.lazy = lazy
         self.__doc__ = None
-        self.__owner = None
-        self.cached_class = None
-        self.cached_ref = None
-        self.relationship_base = None
 
     def __set_name__(self, owner, name):
         self.__owner = owner
         self.relationship_name = name
-        self.relationship_base = f"{owner.__name__}:relationship:{self.relationship_name}"
         owner._relationships = dict(**owner._relationships, **{name: self})
 
-    def get_foreign_type(self) -> Type[U]:
+    @property
+    def relationship_base(self) -> str:
+        return self.__owner._plan().relationship_prefix + self.relationship_name
+
+    def key(self, instance_id: str) -> str:
+        return f"{self.relationship_base}:{instance_id}"
+
+    def backref_key(self, related_id: Optional[str]) -> str:
+        # The backref's key on the related model, in that model's slot when on a cluster
+        return f"{self.get_foreign_type()._plan().relationship_prefix}{self.backref}:{related_id}"
+
+    def get_foreign_type(self) -> Type[RedormBase]:
         if self.foreign_type is None:
-            self.foreign_type = all_models[self.__foreign_type]
+            self.foreign_type = all_models[self.foreign_name]
             return self.foreign_type
         else:
             return self.foreign_type
@@ -74,129 +85,228 @@ class Relationship(IRelationship):
     def __get__(self, instance: T, objtype=None):
         if instance is None:
             return self
-        if self.cached_class is not None:
-            return self.cached_class
+        pending = self._pending(instance)
+        if pending is not None:
+            related = pending[2]
+            if self.to_many:
+                return self.get_foreign_type().get_bulk(related)
+            return self._get_one(related) if related is not None else None
+        cache = instance._relationship_cache().setdefault(self.relationship_name, {})
+        if "loaded" in cache:
+            return cache["loaded"]
         if not self.lazy:
-            print("Cache miss!")
-        relationship_path = f"{self.relationship_base}:{instance.id}"
+            logger.debug("%s.%s was not loaded eagerly", self.__owner.__name__, self.relationship_name)
+        relationship_path = self.key(instance.id)
+        if self.to_many:
+            if "ref" not in cache:
+                cache["ref"] = self.__owner._client(instance.id).reader.smembers(relationship_path)
+            return self.get_foreign_type().get_bulk(cache["ref"])
+        else:
+            if "ref" not in cache:
+                cache["ref"] = self.__owner._client(instance.id).reader.get(relationship_path)
+            return self._get_one(cache["ref"]) if cache["ref"] is not None else None
+
+    def _get_one(self, related_id: str) -> Optional[U]:
+        # An expired instance that hasn't been swept yet reads as None, as it does when loaded eagerly
+        foreign = self.get_foreign_type()
+        try:
+            return foreign.get(related_id)
+        except InstanceNotFound:
+            if not foreign._plan().expiring:
+                raise
+            return None
+
+    async def aget(self, instance: T):
+        pending = self._pending(instance)
+        if pending is not None:
+            related = pending[2]
+            if self.to_many:
+                return await self.get_foreign_type().aget_bulk(related)
+            return await self._aget_one(related) if related is not None else None
+        cache = instance._relationship_cache().setdefault(self.relationship_name, {})
+        if "loaded" in cache:
+            return cache["loaded"]
+        relationship_path = self.key(instance.id)
         if self.to_many:
-            if self.cached_ref is None:
-                self.cached_ref = red.client.smembers(relationship_path)
-            return self.get_foreign_type().get_bulk(self.cached_ref)
+            if "ref" not in cache:
+                cache["ref"] = await self.__owner._aclient(instance.id).reader.smembers(relationship_path)
+            return await self.get_foreign_type().aget_bulk(cache["ref"])
         else:
-            if self.cached_ref is None:
-                self.cached_ref = red.client.get(relationship_path)
-            return self.get_foreign_type().get(self.cached_ref) if self.cached_ref is not None else None
+            if "ref" not in cache:
+                cache["ref"] = await self.__owner._aclient(instance.id).reader.get(relationship_path)
+            return await self._aget_one(cache["ref"]) if cache["ref"] is not None else None
+
+    async def _aget_one(self, related_id: str) -> Optional[U]:
+        foreign = self.get_foreign_type()
+        try:
+            return await foreign.aget(related_id)
+        except InstanceNotFound:
+            if not foreign._plan().expiring:
+                raise
+            return None
 
     def __set__(
         self,
         instance: T,
         value: Union[None, str, U, List[Union[str, U]]],
     ):
-        foreign_type = self.get_foreign_type()
-        relationship_path = f"{self.relationship_base}:{instance.id}"
-        if self.config in {
-            RelationshipConfigEnum.MANY_TO_ONE,
-            RelationshipConfigEnum.ONE_TO_ONE,
-        }:
-            related_id_new: Optional[str]
-            if isinstance(value, RedormBase):
-                related_id_new = value.id
-            elif isinstance(value, str):
-                related_id_new = value
-            elif value is None:
-                related_id_new = None
+        new = self._related_ids(value)
+        instance._relationship_cache().pop(self.relationship_name, None)
+        session = current_session.get()
+        if session is not None:
+            session.set_relationship(instance, self, new)
+            return
+        self._relate(instance.id, "set", self._id_list(new))
+        instance._relationship_cache()[self.relationship_name] = {"ref": new}
+
+    async def aset(
+        self,
+        instance: T,
+        value: Union[None, str, U, List[Union[str, U]]],
+    ):
+        new = self._related_ids(value)
+        instance._relationship_cache().pop(self.relationship_name, None)
+        session = current_session.get()
+        if session is not None:
+            session.set_relationship(instance, self, new)
+            return
+        await self._arelate(instance.id, "set", self._id_list(new))
+        instance._relationship_cache()[self.relationship_name] = {"ref": new}
+
+    def add(self, instance: T, *related: Union[str, U]) -> None:
+        # Adds members to a to-many relationship without rewriting the rest of it
+        self._change(instance, "add", related)
+
+    def remove(self, instance: T, *related: Union[str, U]) -> None:
+        self._change(instance, "remove", related)
+
+    async def aadd(self, instance: T, *related: Union[str, U]) -> None:
+        await self._achange(instance, "add", related)
+
+    async def aremove(self, instance: T, *related: Union[str, U]) -> None:
+        await self._achange(instance, "remove", related)
+
+    def _change(self, instance: T, mode: str, related) -> None:
+        ids = self._member_ids(related)
+        instance._relationship_cache().pop(self.relationship_name, None)
+        session = current_session.get()
+        if session is not None:
+            # Inside a session the change is made to the whole set, which is written on commit
+            pending = session.pending_relationship(instance, self)
+            if pending is not None:
+                current = pending[2]
             else:
-                raise ValueError("Expected new value of string or Model")
-            if related_id_new is None:
-                pipeline = red.client.pipeline()
-                pipeline.get(relationship_path)
-                pipeline.delete(relationship_path)
-                result = pipeline.execute()
-                related_id_old = result[0]
+                current = self.__owner._client(instance.id).client.smembers(self.key(instance.id))
+            session.set_relationship(instance, self, self._changed(current, mode, ids))
+            return
+        self._relate(instance.id, mode, ids)
+
+    async def _achange(self, instance: T, mode: str, related) -> None:
+        ids = self._member_ids(related)
+        instance._relationship_cache().pop(self.relationship_name, None)
+        session = current_session.get()
+        if session is not None:
+            pending = session.pending_relationship(instance, self)
+            if pending is not None:
+                current = pending[2]
             else:
-                related_id_old = red.client.getset(
-                    relationship_path,
-                    related_id_new,
-                )
-            if related_id_new == related_id_old or self.backref is None:
-                return
-            rel_new = f"{foreign_type.__name__}:relationship:{self.backref}:{related_id_new}"
-            rel_old = f"{foreign_type.__name__}:relationship:{self.backref}:{related_id_old}"
-            if self.config == RelationshipConfigEnum.MANY_TO_ONE:
-                if related_id_old is None:
-                    red.client.sadd(
-                        rel_new,
-                        instance.id,
-                    )
-                elif related_id_new is None:
-                    red.client.srem(
-                        rel_old,
-                        instance.id,
-                    )
-                else:
-                    red.client.smove(
-                        rel_old,
-                        rel_new,
-                        instance.id,
-                    )
+                current = await self.__owner._aclient(instance.id).client.smembers(self.key(instance.id))
+            session.set_relationship(instance, self, self._changed(current, mode, ids))
+            return
+        await self._arelate(instance.id, mode, ids)
+
+    def _member_ids(self, related) -> List[str]:
+        if not self.to_many:
+            raise ValueError(f"{self.relationship_name} isn't a to-many relationship, assign it instead")
+        return [r.id if isinstance(r, RedormBase) else r for r in related]
+
+    @staticmethod
+    def _changed(current: Set[str], mode: str, ids: List[str]) -> Set[str]:
+        return set(current) | set(ids) if mode == "add" else set(current) - set(ids)
+
+    @staticmethod
+    def _id_list(related_ids: Union[None, str, Set[str]]) -> List[str]:
+        if related_ids is None:
+            return []
+        return [related_ids] if isinstance(related_ids, str) else list(related_ids)
+
+    def _relate(self, instance_id: str, mode: str, ids: List[str]) -> None:
+        # The relationship and any backrefs on the same node change in one script, other backrefs follow it
+        result = self.__owner._client(instance_id).relate(2, *self._script_args(instance_id, mode, ids))
+        pipelines = PipelineGroup()
+        if self._queue_remote_backrefs(pipelines, instance_id, result):
+            pipelines.execute()
+
+    async def _arelate(self, instance_id: str, mode: str, ids: List[str]) -> None:
+        result = await self.__owner._aclient(instance_id).relate(2, *self._script_args(instance_id, mode, ids))
+        pipelines = PipelineGroup(is_async=True)
+        if self._queue_remote_backrefs(pipelines, instance_id, result):
+            await pipelines.aexecute()
+
+    def _script_args(self, instance_id: str, mode: str, ids: List[str], saved_only: bool = False) -> List[str]:
+        foreign_type = self.get_foreign_type()
+        local = self.backref is not None and self.__owner._same_node(foreign_type)
+        backref_prefix = f"{foreign_type._plan().relationship_prefix}{self.backref}:" if local else ""
+        return [
+            self.key(instance_id),
+            self.__owner._plan().member_key(instance_id),
+            instance_id,
+            mode,
+            "1" if self.to_many else "0",
+            backref_prefix,
+            "1" if self.many_to else "0",
+            "1" if saved_only else "0",
+            *ids,
+        ]
+
+    def _queue_relate(
+        self, pipelines: PipelineGroup, instance_id: str, related_ids: Union[None, str, Set[str]]
+    ) -> Tuple[object, int]:
+        # Queues setting the relationship of an instance whose save is queued before it, returns where the result
+        # will be for _queue_remote_backrefs
+        client = pipelines.client(self.__owner._database(), instance_id)
+        pipeline = pipelines.on(client)
+        client.queue_evalsha(
+            pipeline, client.relate_script, 2, *self._script_args(instance_id, "set", self._id_list(related_ids), True)
+        )
+        return client, len(pipeline) - 1
+
+    def _queue_remote_backrefs(self, pipelines: PipelineGroup, instance_id: str, result: List[List[str]]) -> bool:
+        # Queues the backref changes the script couldn't make, on the nodes holding the related instances
+        if self.backref is None or self.__owner._same_node(self.get_foreign_type()):
+            return False
+        foreign_type = self.get_foreign_type()
+        added, removed = result
+        for related_id in removed:
+            if self.many_to:
+                pipelines.of(foreign_type, related_id).srem(self.backref_key(related_id), instance_id)
             else:
-                if related_id_old is None:
-                    red.client.set(
-                        rel_new,
-                        instance.id,
-                    )
-                elif related_id_new is None:
-                    red.client.delete(
-                        rel_new,
-                    )
-                else:
-                    red.client.rename(
-                        rel_old,
-                        rel_new,
-                    )
-        else:
+                pipelines.of(foreign_type, related_id).delete(self.backref_key(related_id))
+        for related_id in added:
+            if self.many_to:
+                pipelines.of(foreign_type, related_id).sadd(self.backref_key(related_id), instance_id)
+            else:
+                pipelines.of(foreign_type, related_id).set(self.backref_key(related_id), instance_id)
+        return bool(added or removed)
+
+    def _pending(self, instance: T):
+        # A change set inside the current session that hasn't been flushed yet
+        session = current_session.get()
+        if session is None:
+            return None
+        return session.pending_relationship(instance, self)
+
+    def _related_ids(self, value: Union[None, str, U, List[Union[str, U]]]) -> Union[None, str, Set[str]]:
+        if self.to_many:
             if (not isinstance(value, list)) and (not isinstance(value, set)):
                 raise ValueError("Expected list or set for new relationships")
-            old_related_ids = {r for r in red.client.smembers(relationship_path)}
-            new_related_ids = {(r.id if isinstance(r, RedormBase) else r) for r in value}
-            if len(old_related_ids.symmetric_difference(new_related_ids)) == 0:
-                return
-            pipeline = red.client.pipeline()
-            pipeline.delete(relationship_path)
-            if new_related_ids:
-                pipeline.sadd(
-                    relationship_path,
-                    *new_related_ids,
-                )
-            if self.backref is None:
-                pipeline.execute()
-                return
-            ids_to_remove = old_related_ids - new_related_ids
-            ids_to_add = new_related_ids - old_related_ids
-            reverse_path = f"{foreign_type.__name__}:relationship:{self.backref}"
-            if self.config == RelationshipConfigEnum.MANY_TO_MANY:
-                for idr in ids_to_remove:
-                    pipeline.srem(
-                        f"{reverse_path}:{idr}",
-                        instance.id,
-                    )
-                for ida in ids_to_add:
-                    pipeline.sadd(
-                        f"{reverse_path}:{ida}",
-                        instance.id,
-                    )
-            elif self.config == RelationshipConfigEnum.ONE_TO_MANY:
-                for idr in ids_to_remove:
-                    pipeline.delete(f"{reverse_path}:{idr}")
-                for ida in ids_to_add:
-                    pipeline.set(
-                        f"{reverse_path}:{ida}",
-                        instance.id,
-                    )
-            else:
-                raise ValueError("Expected relationship config to be of type RelationshipConfigEnum")
-            pipeline.execute()
+            return {(r.id if isinstance(r, RedormBase) else r) for r in value}
+        if isinstance(value, RedormBase):
+            return value.id
+        elif isinstance(value, str) or value is None:
+            return value
+        else:
+            raise ValueError("Expected new value of string or Model")
 
 
 def one_to_many(
@@ -0,0 +1,159 @@
+from contextvars import ContextVar, Token
+from typing import Dict, Tuple, Optional, List, Iterable, Any
+
+from redis import ResponseError
+
+from redorm.client import PipelineGroup
+
+__all__ = ["Session", "current_session"]
+
+InstanceKey = Tuple[str, str]
+
+current_session: ContextVar[Optional["Session"]] = ContextVar("redorm_session", default=None)
+
+
+class Session:
+    def __init__(self):
+        self.identity_map: Dict[InstanceKey, Any] = {}
+        self.snapshots: Dict[InstanceKey, dict] = {}
+        self.pending_saves: Dict[InstanceKey, Any] = {}
+        # Keyed by instance key and relationship name, holds the instance, relationship and new related ids
+        self.pending_relationships: Dict[Tuple[str, str, str], Tuple[Any, Any, Any]] = {}
+        self._tokens: List[Token] = []
+
+    def __enter__(self) -> "Session":
+        self._tokens.append(current_session.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        current_session.reset(self._tokens.pop())
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    async def __aenter__(self) -> "Session":
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        current_session.reset(self._tokens.pop())
+        if exc_type is None:
+            await self.acommit()
+        else:
+            self.rollback()
+
+    @staticmethod
+    def _key(instance) -> InstanceKey:
+        return instance.__class__.__name__, instance.id
+
+    def lookup(self, cls, instance_id: str):
+        return self.identity_map.get((cls.__name__, instance_id))
+
+    def partition(self, cls, instance_ids: Iterable[str]) -> Tuple[List, List[str]]:
+        # Splits ids into instances already in the identity map and ids that still need fetching
+        found, missing = [], []
+        for instance_id in instance_ids:
+            instance = self.lookup(cls, instance_id)
+            if instance is None:
+                missing.append(instance_id)
+            else:
+                found.append(instance)
+        return found, missing
+
+    def track(self, instance):
+        key = self._key(instance)
+        existing = self.identity_map.get(key)
+        if existing is not None:
+            return existing
+        self.identity_map[key] = instance
+        self.snapshots[key] = self._snapshot(instance)
+        return instance
+
+    @staticmethod
+    def _snapshot(instance) -> dict:
+        # Only the fields an instance has loaded, so projected instances aren't read in full to be compared
+        return instance._to_document(instance._loaded_fields())
+
+    def add(self, instance) -> None:
+        key = self._key(instance)
+        self.identity_map[key] = instance
+        self.pending_saves[key] = instance
+
+    def forget(self, instance) -> None:
+        key = self._key(instance)
+        self.identity_map.pop(key, None)
+        self.snapshots.pop(key, None)
+        self.pending_saves.pop(key, None)
+        for rel_key in [k for k in self.pending_relationships if k[:2] == key]:
+            del self.pending_relationships[rel_key]
+
+    def set_relationship(self, instance, relationship, related_ids) -> None:
+        self.pending_relationships[(*self._key(instance), relationship.relationship_name)] = (
+            instance,
+            relationship,
+            related_ids,
+        )
+
+    def pending_relationship(self, instance, relationship) -> Optional[Tuple[Any, Any, Any]]:
+        return self.pending_relationships.get((*self._key(instance), relationship.relationship_name))
+
+    def dirty(self) -> List:
+        dirty = dict(self.pending_saves)
+        for key, instance in self.identity_map.items():
+            if key not in dirty and self._snapshot(instance) != self.snapshots.get(key):
+                dirty[key] = instance
+        return list(dirty.values())
+
+    def commit(self) -> None:
+        instances = self.dirty()
+        pipelines = PipelineGroup(transaction=False)
+        positions, related = self._queue_flush(pipelines, instances)
+        results = pipelines.execute(raise_on_error=False) if len(pipelines) else {}
+        followups = PipelineGroup(transaction=False)
+        if self._queue_followups(followups, results, related):
+            followups.execute()
+        self._finish(instances, results, positions)
+
+    async def acommit(self) -> None:
+        instances = self.dirty()
+        pipelines = PipelineGroup(is_async=True, transaction=False)
+        positions, related = self._queue_flush(pipelines, instances)
+        results = await pipelines.aexecute(raise_on_error=False) if len(pipelines) else {}
+        followups = PipelineGroup(is_async=True, transaction=False)
+        if self._queue_followups(followups, results, related):
+            await followups.aexecute()
+        self._finish(instances, results, positions)
+
+    def rollback(self) -> None:
+        self.pending_saves.clear()
+        self.pending_relationships.clear()
+
+    def _queue_flush(self, pipelines: PipelineGroup, instances: List) -> Tuple[List, List]:
+        # Returns where each save's result will be, and each relationship script's. Relationship scripts are
+        # queued after the saves and skip instances that weren't saved.
+        positions = type(instances[0])._queue_saves(pipelines, instances) if instances else []
+        related = [
+            (relationship, instance.id, *relationship._queue_relate(pipelines, instance.id, related_ids))
+            for instance, relationship, related_ids in self.pending_relationships.values()
+        ]
+        return positions, related
+
+    @staticmethod
+    def _queue_followups(pipelines: PipelineGroup, results: Dict, related: List) -> bool:
+        queued = False
+        for relationship, instance_id, client, position in related:
+            queued |= relationship._queue_remote_backrefs(pipelines, instance_id, results[client][position])
+        return queued
+
+    def _finish(self, instances: List, results: Dict, positions: List) -> None:
+        self.rollback()
+        saved = type(instances[0])._save_results(results, positions, instances) if instances else []
+        # Instances that failed to save keep their old snapshot, so they're still dirty when commit raises
+        for instance, result in zip(instances, saved):
+            if not isinstance(result, ResponseError):
+                self.snapshots[self._key(instance)] = self._snapshot(instance)
+        if instances:
+            errors: Dict = {}
+            model = type(instances[0])
+            model._bulk_saved(saved, 0, errors)
+            model._bulk_outcome(instances, errors)
@@ -1,5 +1,21 @@
+from typing import List
+
 from environs import Env
 
 env = Env()
 env.read_env()
 REDORM_URL = env.str("REDORM_URL", default="")
+REDORM_CLUSTER = env.bool("REDORM_CLUSTER", default=False)
+# Read replicas, given directly or discovered through Sentinel
+REDORM_REPLICA_URLS: List[str] = env.list("REDORM_REPLICA_URLS", default=[])
+REDORM_SENTINELS: List[str] = env.list("REDORM_SENTINELS", default=[])
+REDORM_SENTINEL_SERVICE = env.str("REDORM_SENTINEL_SERVICE", default="mymaster")
+# 'replica' sends reads to replicas when there are any, 'primary' keeps every read on the primary
+REDORM_READ_FROM = env.str("REDORM_READ_FROM", default="replica")
+# Seconds a process keeps reading from the primary after it writes, so it reads its own writes despite replication lag
+REDORM_REPLICA_LAG = env.float("REDORM_REPLICA_LAG", default=1.0)
+REDORM_CODEC = env.str("REDORM_CODEC", default="json")
+# Model operations slower than this are logged as warnings by the "redorm" logger
+REDORM_SLOW_OPERATION_MS = env.float("REDORM_SLOW_OPERATION_MS", default=None)
+# Seconds between the sweeps of expired instances that creating instances of an expiring model runs, 0 turns them off
+REDORM_SWEEP_INTERVAL = env.float("REDORM_SWEEP_INTERVAL", default=10.0)
@@ -7,3 +7,4 @@ def clean_db():
     # red.bind("redis://localhost")
     red.client.flushdb(asynchronous=False)
     red.setup_scripts()
+    red.load_scripts()
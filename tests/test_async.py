@@ -0,0 +1,166 @@
+import asyncio
+from dataclasses import dataclass, field
+import pytest
+from redorm import RedormBase, many_to_one, one_to_many
+from redorm.exceptions import InstanceNotFound, UniqueContstraintViolation, VersionConflict
+
+
+@dataclass
+class Pet(RedormBase):
+    name: str = field(metadata={"unique": True})
+    species: str = field(metadata={"index": True})
+    owner = many_to_one("Owner", backref="pets")
+
+
+@dataclass
+class Owner(RedormBase):
+    name: str
+    pets = one_to_many(Pet, backref="owner")
+
+
+@dataclass
+class Tip(RedormBase):
+    waiter: str
+    amount: float = 0.0
+    version: int = field(default=0, metadata={"version": True})
+
+    class Meta:
+        storage = "hash"
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_async_create_and_get(clean_db):
+    async def scenario():
+        rex = await Pet.acreate(name="Santa's Little Helper", species="dog")
+        fetched = await Pet.aget(rex.id)
+        assert fetched == rex
+        assert (await Pet.aget(name="Santa's Little Helper")).id == rex.id
+        return rex
+
+    rex = run(scenario())
+    # Sync and async clients share the same database
+    assert Pet.get(rex.id) == rex
+
+
+def test_async_list_and_filter(clean_db):
+    async def scenario():
+        await Pet.acreate(name="Snowball II", species="cat")
+        await Pet.acreate(name="Snowball V", species="cat")
+        await Pet.acreate(name="Santa's Little Helper", species="dog")
+        assert len(await Pet.alist()) == 3
+        assert len(await Pet.alist(species="cat")) == 2
+        # Many concurrent reads share one connection pool
+        results = await asyncio.gather(*[Pet.alist(species="dog") for _ in range(20)])
+        assert all(len(r) == 1 for r in results)
+        assert await Pet.acount(species="cat") == 2
+        assert not await Pet.aexists(name="Snowball I")
+
+    run(scenario())
+
+
+def test_async_update_and_delete(clean_db):
+    async def scenario():
+        cat = await Pet.acreate(name="Snowball II", species="cat")
+        await cat.aupdate(species="ghost")
+        assert (await Pet.aget(cat.id)).species == "ghost"
+        assert await Pet.alist(species="cat") == []
+        await cat.adelete()
+        with pytest.raises(InstanceNotFound):
+            await Pet.aget(cat.id)
+
+    run(scenario())
+
+
+def test_async_unique(clean_db):
+    async def scenario():
+        await Pet.acreate(name="Snowball II", species="cat")
+        with pytest.raises(UniqueContstraintViolation):
+            await Pet.acreate(name="Snowball II", species="cat")
+
+    run(scenario())
+
+
+def test_async_relationships(clean_db):
+    async def scenario():
+        homer = await Owner.acreate(name="Homer")
+        dog = await Pet.acreate(name="Santa's Little Helper", species="dog", owner=homer)
+        assert (await dog.aget_relationship("owner")).id == homer.id
+        pets = await homer.aget_relationship("pets")
+        assert [p.id for p in pets] == [dog.id]
+        await dog.aset_relationship("owner", None)
+        assert await dog.aget_relationship("owner") is None
+
+    run(scenario())
+
+
+def test_async_iter(clean_db):
+    async def scenario():
+        for i in range(5):
+            await Pet.acreate(name=f"Snowball {i}", species="cat")
+        await Pet.acreate(name="Santa's Little Helper", species="dog")
+        assert len([p async for p in Pet.aiter(batch_size=2)]) == 6
+        assert len([p async for p in Pet.aiter(batch_size=2, species="cat")]) == 5
+
+    run(scenario())
+
+
+def test_async_create_bulk_with_relationships(clean_db):
+    async def scenario():
+        homer = await Owner.acreate(name="Homer")
+        pets = await Pet.acreate_bulk(
+            [
+                dict(name="Santa's Little Helper", species="dog", owner=homer),
+                dict(name="Snowball II", species="cat", owner=homer.id),
+            ]
+        )
+        homer = await Owner.aget(homer.id)
+        assert {p.id for p in await homer.aget_relationship("pets")} == {p.id for p in pets}
+        pets[1].species = "ghost"
+        await Pet.asave_many(pets)
+        assert (await Pet.aget(species="ghost")).id == pets[1].id
+
+    run(scenario())
+
+
+def test_async_add_and_remove_related(clean_db):
+    async def scenario():
+        owner = await Owner.acreate(name="Simpsons")
+        dog = await Pet.acreate(name="Santa's Little Helper", species="dog")
+        cat = await Pet.acreate(name="Snowball II", species="cat", owner=owner)
+        await owner.aadd_related("pets", dog)
+        assert {p.name for p in await owner.aget_relationship("pets")} == {dog.name, cat.name}
+        await owner.aremove_related("pets", cat)
+        assert await (await Pet.aget(cat.id)).aget_relationship("owner") is None
+        fetched = await Owner.aget(owner.id)
+        assert [p.name for p in await fetched.aget_relationship("pets")] == [dog.name]
+
+    run(scenario())
+
+
+def test_async_versioned_updates(clean_db):
+    async def scenario():
+        tip = await Tip.acreate(waiter="Akira")
+        stale = await Tip.aget(tip.id)
+        await tip.aupdate(amount=5.0)
+        assert tip.version == 2
+        with pytest.raises(VersionConflict):
+            await stale.asave()
+        await Tip.aupdate_where(tip.id, amount=7.5)
+        stored = await Tip.aget(tip.id)
+        assert (stored.amount, stored.version) == (7.5, 3)
+
+    run(scenario())
+
+
+def test_async_incr(clean_db):
+    async def scenario():
+        tip = await Tip.acreate(waiter="Akira")
+        assert await tip.aincr("amount", 2.5) == 2.5
+        assert await Tip.adecr(tip.id, "amount", 1.0) == 1.5
+        assert tip.version == 2
+        assert (await Tip.aget(tip.id)).version == 3
+
+    run(scenario())
@@ -0,0 +1,46 @@
+from redorm import red
+from benchmarks.suite import BenchResult, compare, run
+
+
+def test_benchmarks_run(clean_db):
+    red.client.set("precious", "data")
+    results = {result.name: result for result in run(ops=5, sizes=[10], log=lambda line: None)}
+    # Run in a fake redis of their own rather than whatever red is bound to
+    assert red.client.keys("*") == ["precious"]
+    assert set(results) == {
+        "create",
+        "get_by_id",
+        "get_by_unique",
+        "list_filtered",
+        "relationship_read",
+        "relationship_write",
+        "update",
+        "delete",
+        "get_bulk_10",
+    }
+    # Counted with the SCRIPT commands redis-py sends itself, which the suite gets out of the way before measuring.
+    # Updates of JSON documents take a lock, which can take more than one try.
+    round_trips = {name: result.round_trips for name, result in results.items() if name != "update"}
+    assert round_trips == {
+        "create": 1,
+        "get_by_id": 1,
+        "get_by_unique": 2,
+        "list_filtered": 2,
+        "relationship_read": 2,
+        "relationship_write": 1,
+        "delete": 2,
+        "get_bulk_10": 1,
+    }
+    assert all(result.ops_per_sec > 0 and result.p99_ms >= result.p50_ms for result in results.values())
+
+
+def test_compare_to_baseline():
+    baseline = {"get_by_id": {"ops_per_sec": 1000.0, "p99_ms": 1.0, "round_trips": 1.0}}
+    same = BenchResult("get_by_id", 100, 900.0, 0.5, 1.1, 1.0, 50.0)
+    assert compare(baseline, [same], tolerance=0.2) == []
+    slower = BenchResult("get_by_id", 100, 500.0, 0.5, 1.1, 2.0, 50.0)
+    assert compare(baseline, [slower], tolerance=0.2) == [
+        "get_by_id: 500 ops/s, was 1000",
+        "get_by_id: 2 round trips, was 1",
+    ]
+    assert compare({}, [slower], tolerance=0.2) == []
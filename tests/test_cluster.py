@@ -0,0 +1,148 @@
+import asyncio
+import os
+from dataclasses import dataclass, field
+from typing import Optional
+import pytest
+from fakeredis._socket import BaseFakeSocket
+from redorm import RedormBase, red, red_async, many_to_one, one_to_many
+from redorm.client import key_slot
+from redorm.migrate import reindex
+
+
+@dataclass
+class Depot(RedormBase):
+    name: str = field(metadata={"unique": True})
+    trains = one_to_many("Train", backref="depot")
+
+
+@dataclass
+class Train(RedormBase):
+    name: str = field(metadata={"unique": True})
+    line: Optional[str] = field(metadata={"index": True}, default=None)
+    carriages: int = field(metadata={"range_index": True}, default=1)
+    depot = many_to_one(Depot, backref="trains", lazy=False)
+
+
+def command_keys(name: str, args: list) -> list:
+    # The keys of the multi-key commands redorm uses, which a cluster requires to share a slot
+    if name in ("sinter", "sunion", "sdiff", "sinterstore", "sunionstore", "sdiffstore", "del", "unlink", "mget"):
+        return args
+    if name == "sintercard":
+        return args[1 : 1 + int(args[0])]
+    if name in ("smove", "rename"):
+        return args[:2]
+    if name in ("eval", "evalsha"):
+        return args[2 : 2 + int(args[1])]
+    return []
+
+
+@pytest.fixture
+def cluster(clean_db, monkeypatch):
+    process_command = BaseFakeSocket._process_command
+
+    def checked(self, fields):
+        if fields:
+            args = [f.decode("utf-8", "surrogateescape") for f in fields[1:]]
+            keys = command_keys(fields[0].decode().lower(), args)
+            assert len({key_slot(key) for key in keys}) <= 1, f"Cross slot command {fields!r}"
+        return process_command(self, fields)
+
+    monkeypatch.setattr(BaseFakeSocket, "_process_command", checked)
+    red.bind("", cluster=True)
+    red_async.bind("", cluster=True)
+    yield
+    red.bind("", cluster=False)
+    red_async.bind("", cluster=False)
+
+
+@pytest.fixture
+def network(cluster):
+    springfield = Depot.create(name="Springfield")
+    capital = Depot.create(name="Capital City")
+    Train.create(name="Monorail", line="north", carriages=4, depot=springfield)
+    Train.create(name="Express", line="north", carriages=8, depot=capital)
+    Train.create(name="Shuttle", carriages=2, depot=springfield)
+    return springfield
+
+
+def names(instances):
+    return {instance.name for instance in instances}
+
+
+def test_keys_are_hash_tagged(network):
+    assert red.client.keys("*")
+    assert all(key.startswith(("{Depot}", "{Train}")) for key in red.client.keys("*"))
+
+
+def test_reads_and_writes(network):
+    monorail = Train.get(name="Monorail")
+    assert monorail.depot == network
+    assert names(network.trains) == {"Monorail", "Shuttle"}
+    monorail.update(line="south", carriages=5)
+    assert Train.get(line="south", carriages=5) == monorail
+    assert names(Train.list(line="north")) == {"Express"}
+    assert names(Train.list(line=None)) == {"Shuttle"}
+    assert names(Train.get_bulk({monorail.id}, prefetch=["depot"])) == {"Monorail"}
+    monorail.delete()
+    assert names(Train.list()) == {"Express", "Shuttle"}
+
+
+def test_cross_slot_filters(network):
+    assert names(Train.list(depot=network, line=None)) == {"Shuttle"}
+    assert Train.count(depot=network, carriages__gt=3) == 1
+    assert names(Train.iter(depot=network, line="north")) == {"Monorail"}
+    queryset = Train.query().filter_any(depot=network, line="north").exclude(carriages__lt=3)
+    assert names(queryset) == {"Monorail", "Express"}
+    assert Train.query().filter(line="north").exclude(depot=network).count() == 1
+
+
+def test_cluster_relationship_changes(network):
+    express = Train.get(name="Express")
+    network.add_related("trains", express)
+    assert Train.get(express.id).depot == network
+    network.remove_related("trains", express)
+    assert names(Depot.get(network.id).trains) == {"Monorail", "Shuttle"}
+    assert Train.get(express.id).depot is None
+
+
+def test_cluster_deletes(network):
+    network.delete()
+    assert Train.get(name="Shuttle").depot is None
+    assert not any(network.id in key for key in red.client.keys("*"))
+    assert Train.delete_where(line="north") == 2
+    assert names(Train.list()) == {"Shuttle"}
+    assert not red.client.keys("{Train}:relationship:*")
+
+
+def test_cluster_reindex(network):
+    for key in red.client.keys("{Train}:index:*") + red.client.keys("{Train}:range:*"):
+        red.client.delete(key)
+    assert Train.list(line="north") == []
+    report = reindex(Train, batch_size=2)
+    assert report.scanned == 3 and report.conflicts == []
+    assert names(Train.list(line="north", carriages__gt=5)) == {"Express"}
+
+
+def test_async_cluster(cluster):
+    async def scenario():
+        depot = await Depot.acreate(name="Ogdenville")
+        trains = await Train.acreate_bulk([{"name": "Local", "depot": depot}, {"name": "Sleeper", "depot": depot}])
+        fetched = await Train.aget(trains[0].id)
+        assert fetched.depot == depot
+        assert names(await Train.alist(depot=depot)) == {"Local", "Sleeper"}
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.skipif(not os.environ.get("REDORM_CLUSTER_URL"), reason="needs a Redis Cluster in REDORM_CLUSTER_URL")
+def test_real_cluster():
+    red.bind(os.environ["REDORM_CLUSTER_URL"], cluster=True)
+    try:
+        for train in Train.list():
+            train.delete()
+        depot = Depot.create(name="North Haverbrook")
+        Train.create_bulk([{"name": "Loop", "line": "east", "depot": depot}])
+        assert names(Train.list(depot=depot, line="east")) == {"Loop"}
+        assert Train.get(name="Loop").depot == depot
+    finally:
+        red.bind("", cluster=False)
@@ -0,0 +1,71 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional
+import pytest
+from redorm import RedormBase, red
+from redorm.codecs import get_codec
+from redorm.types import Binary, DateTime
+
+
+@dataclass
+class Sandwich(RedormBase):
+    name: str = field(metadata={"unique": True})
+    filling: str = field(metadata={"index": True})
+    photo: Optional[Binary] = None
+    eaten_at: Optional[DateTime] = None
+
+    class Meta:
+        codec = "orjson"
+
+
+@dataclass
+class Burger(RedormBase):
+    name: str = field(metadata={"unique": True})
+    patties: int = field(metadata={"index": True})
+    photo: Optional[Binary] = None
+
+    class Meta:
+        codec = "msgpack"
+
+
+def cmsgpack_available() -> bool:
+    return red.client.eval("return type(cmsgpack) == 'table'", 0) == 1
+
+
+@pytest.mark.parametrize("codec", ["json", "orjson", "msgpack"])
+def test_codec_round_trip(codec):
+    documents = [{"name": "Krusty", "patties": 2, "price": 1.5, "vegan": False}, {"name": "Ribwich"}]
+    encoded = [get_codec(codec).dumps(document) for document in documents]
+    assert [get_codec(codec).loads(payload) for payload in encoded] == documents
+    assert get_codec(codec).loads_many(encoded) == documents
+
+
+def test_orjson_model(clean_db):
+    eaten_at = datetime(1990, 1, 14, 20, 30)
+    sandwich = Sandwich.create(name="Moon Waffle", filling="caramel", photo="AAE=", eaten_at=eaten_at.timestamp())
+    assert sandwich.photo == b"\x00\x01"
+    fetched = Sandwich.get(name="Moon Waffle")
+    assert fetched == sandwich
+    assert fetched.eaten_at == eaten_at
+    fetched.update(filling="waffle")
+    assert Sandwich.list(filling="waffle") == [fetched]
+
+
+def test_msgpack_model(clean_db):
+    burger = Burger.create(name="Krusty Burger", patties=2, photo="AAE=")
+    assert not red.client.get(f"Burger:member:{burger.id}").startswith("{")
+    assert Burger.get(name="Krusty Burger") == burger
+    assert Burger.list(patties=2) == [burger]
+    if cmsgpack_available():
+        burger.update(patties=3)
+        assert Burger.list(patties=3) == [burger]
+
+
+def test_msgpack_reads_json_documents(clean_db):
+    # Documents written before a model switched codec are still readable
+    burger = Burger.create(name="Ribwich", patties=1)
+    red.client.set(f"Burger:member:{burger.id}", get_codec("json").dumps(burger.to_dict()))
+    assert Burger.get(burger.id) == burger
+    burger.update(patties=0)
+    assert Burger.list(patties=0) == [burger]
+    assert not red.client.get(f"Burger:member:{burger.id}").startswith("{")
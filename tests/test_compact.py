@@ -0,0 +1,129 @@
+import asyncio
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+import pytest
+from fakeredis._socket import BaseFakeSocket
+from redorm import RedormBase, red, many_to_one, one_to_many
+from redorm.ids import base62_id, ulid_id
+from redorm.migrate import reindex
+
+
+@dataclass
+class Ledger(RedormBase):
+    name: str = field(metadata={"unique": True})
+    entries = one_to_many("Entry", backref="ledger")
+
+    class Meta:
+        id_format = "int"
+        key_prefix = "L"
+        compact_keys = True
+
+
+@dataclass
+class Entry(RedormBase):
+    memo: str = field(metadata={"index": True})
+    amount: float = field(metadata={"range_index": True}, default=0.0)
+    ledger = many_to_one(Ledger, backref="entries")
+
+    class Meta:
+        storage = "hash"
+        id_format = "ulid"
+        key_prefix = "E"
+        compact_keys = True
+
+
+@dataclass
+class Coupon(RedormBase):
+    code: Optional[str] = field(metadata={"unique": True}, default=None)
+
+    class Meta:
+        id_format = "base62"
+
+
+@pytest.fixture
+def books(clean_db):
+    ledger = Ledger.create(name="Moe's")
+    Entry.create_bulk([{"memo": "Duff", "amount": 2.5, "ledger": ledger}, {"memo": "Flaming Moe", "amount": 6}])
+    return ledger
+
+
+def test_id_formats():
+    assert re.fullmatch("[0-9A-Za-z]{22}", base62_id())
+    first = ulid_id()
+    time.sleep(0.002)
+    assert re.fullmatch("[0-9A-HJKMNP-TV-Z]{26}", first) and first < ulid_id()
+    with pytest.raises(ValueError):
+
+        @dataclass
+        class Voucher(RedormBase):
+            class Meta:
+                id_format = "serial"
+
+        Voucher._plan()
+
+
+def test_int_ids(clean_db):
+    assert Ledger.create(name="Springfield").id == "1"
+    ledgers = Ledger.create_bulk([{"name": "Shelbyville"}, {"name": "Capital City"}])
+    assert [ledger.id for ledger in ledgers] == ["2", "3"]
+    assert Ledger.get(name="Shelbyville").id == "2"
+    assert red.client.smembers("L:all") == {"1", "2", "3"}
+    assert asyncio.run(Ledger.acreate(name="Ogdenville")).id == "4"
+
+
+def test_compact_keys(books):
+    keys = red.client.keys("*")
+    assert all(key.startswith(("L:", "E:")) for key in keys)
+    assert red.client.exists(f"L:m:{books.id}")
+    assert red.client.scard(f"L:r:entries:{books.id}") == 1
+    duff = Entry.get(memo="Duff")
+    assert duff.ledger == books
+    assert {entry.memo for entry in books.entries} == {"Duff"}
+    assert {entry.memo for entry in Entry.list(amount__gt=1)} == {"Duff", "Flaming Moe"}
+    assert Coupon.create(code="FREEDONUT").id == Coupon.get(code="FREEDONUT").id
+
+
+def test_compact_deletes(books):
+    books.delete()
+    assert not any(key.startswith("L:r:") or key.startswith("E:r:") for key in red.client.keys("*"))
+    assert Entry.get(memo="Duff").ledger is None
+    assert Entry.delete_where(memo="Duff") == 1
+    assert len(red.client.keys("E:m:*")) == 1
+
+
+def test_compact_reindex(books):
+    for key in red.client.keys("E:index:*"):
+        red.client.delete(key)
+    red.client.sadd("E:index:memo:Tab", "missing")
+    report = reindex(Entry)
+    assert report.fixed == 2 and report.removed == 1
+    assert {entry.memo for entry in Entry.list(memo="Duff")} == {"Duff"}
+
+
+@pytest.fixture
+def key_counts(monkeypatch):
+    # fakeredis has no MEMORY USAGE, so each key is taken to use one byte and the report counts keys
+    process_command = BaseFakeSocket._process_command
+
+    def memory_usage(self, fields):
+        if fields and fields[0].lower() == b"memory":
+            fields = [b"EXISTS", fields[2]]
+        return process_command(self, fields)
+
+    monkeypatch.setattr(BaseFakeSocket, "_process_command", memory_usage)
+
+
+def test_memory_report(books, key_counts):
+    Entry.create_bulk([{"memo": f"Tab {i}", "ledger": books} for i in range(20)])
+    report = Entry.memory_report(samples=5)
+    assert report.instances == 22 and report.members == 22
+    # The all set, the id hash, the amount range and the index set of each memo
+    assert report.indexes == 25
+    # Every entry but one has a ledger
+    assert 0 < report.relationships <= 22
+    # Seven keys the model has one of, five index sets, and five entries with their ledger keys
+    assert report.sampled == 7 + 5 + 5 * 2
+    assert report.total == report.members + report.indexes + report.relationships
+    assert Ledger.memory_report().relationships == 1
@@ -0,0 +1,210 @@
+import asyncio
+from dataclasses import dataclass, field
+from uuid import uuid4
+import pytest
+from fakeredis._socket import BaseFakeSocket
+from redorm import RedormBase, red, many_to_one, one_to_many, bind_database, assert_max_round_trips
+from redorm.client import HashRing, databases
+from redorm.exceptions import UnknownDatabase
+
+
+@dataclass
+class Channel(RedormBase):
+    name: str = field(metadata={"unique": True})
+    shows = one_to_many("Show", backref="channel")
+
+
+@dataclass
+class Show(RedormBase):
+    title: str = field(metadata={"index": True, "prefix_index": True})
+    season: int = field(metadata={"index": True})
+    rating: float = field(metadata={"range_index": True}, default=0.0)
+    channel = many_to_one(Channel, backref="shows")
+
+    class Meta:
+        database = "shows"
+
+
+@dataclass
+class Broadcast(RedormBase):
+    slot: str = field(metadata={"unique": True})
+    show = many_to_one(Show)
+
+    class Meta:
+        database = "schedule"
+
+
+@dataclass
+class Simulcast(RedormBase):
+    code: str = field(metadata={"unique": True})
+
+    class Meta:
+        database = "shows"
+
+
+@dataclass
+class Rerun(RedormBase):
+    slot: str
+
+    class Meta:
+        database = "nowhere"
+
+
+@pytest.fixture
+def shards(clean_db):
+    bind_database("shows", "", "", "")
+    bind_database("schedule", "")
+    yield databases["shows"]
+    del databases["shows"]
+    del databases["schedule"]
+
+
+@pytest.fixture
+def fox(shards):
+    fox = Channel.create(name="Fox")
+    Show.create_bulk(
+        [
+            {"title": f"Episode {season}x{number}", "season": season, "rating": number / 2, "channel": fox}
+            for season in range(1, 4)
+            for number in range(1, 11)
+        ]
+    )
+    return fox
+
+
+def titles(instances):
+    return {instance.title for instance in instances}
+
+
+def test_databases_are_separate(fox):
+    Broadcast.create(slot="Sunday 8pm", show=Show.get(title="Episode 1x1"))
+    assert red.client.keys("Show:*") == []
+    assert red.client.keys("Broadcast:*") == []
+    assert databases["schedule"].client().client.keys("Broadcast:*")
+    assert Broadcast.get(slot="Sunday 8pm").show.title == "Episode 1x1"
+    with pytest.raises(UnknownDatabase):
+        Rerun.create(slot="Monday")
+
+
+def test_deletes_only_resolve_related_databases_in_use(clean_db):
+    # Show's database isn't bound, which only matters to channels with shows
+    Channel.create(name="Fox").delete()
+    Channel.create(name="NBC")
+    assert Channel.delete_where(all=True) == 1
+
+
+def test_instances_are_sharded(fox, shards):
+    per_shard = [len(client.client.smembers("Show:all")) for client in shards.clients]
+    assert sum(per_shard) == 30
+    assert all(count > 0 for count in per_shard)
+    show = Show.get(title="Episode 2x3")
+    assert shards.client(show.id).client.exists(f"Show:member:{show.id}")
+
+
+def test_sharded_unique_fields_are_refused(shards):
+    # Each node could only check the codes of its own instances
+    with pytest.raises(ValueError):
+        Simulcast.create(code="FOX-1")
+    assert not any(client.client.keys("Simulcast:*") for client in shards.clients)
+
+
+def test_sharded_reads(fox):
+    assert len(Show.list()) == 30
+    assert titles(Show.list(season=2, rating__gte=4.5)) == {"Episode 2x9", "Episode 2x10"}
+    assert Show.count(season=3) == 10
+    assert Show.count() == 30
+    assert len(list(Show.iter(batch_size=4, season=1))) == 10
+    assert len(Show.list(channel=fox, season=1)) == 10
+    assert len(fox.shows) == 30
+    assert Show.get(title="Episode 1x1").channel == fox
+    queryset = Show.query().filter(channel=fox).filter_any(season=1, rating__gt=4.5).exclude(season=3)
+    assert titles(queryset) == {f"Episode 1x{number}" for number in range(1, 11)} | {"Episode 2x10"}
+    assert queryset.count() == 11
+
+
+def test_sharded_autocomplete(fox):
+    # The first matches of every shard are merged in order
+    assert [show.title for show in Show.autocomplete("title", "Episode 2", limit=3)] == [
+        "Episode 2x1",
+        "Episode 2x10",
+        "Episode 2x2",
+    ]
+    assert Show.count(title__startswith="Episode 3x") == 10
+    assert titles(Show.list(title__startswith="Episode 1x1", season=1)) == {"Episode 1x1", "Episode 1x10"}
+
+
+def test_sharded_round_trips(fox):
+    # One round trip per shard, made in parallel threads
+    with assert_max_round_trips(3) as stats:
+        assert Show.count(season=2) == 10
+    assert stats.round_trips == 3
+
+
+def test_sharded_writes(fox):
+    show = Show.get(title="Episode 3x7")
+    show.update(season=4)
+    assert Show.list(season=4) == [show]
+    show.channel = None
+    assert len(fox.shows) == 29
+    show.delete()
+    assert Show.count() == 29
+
+
+def test_sharded_relationship_changes(fox):
+    abc = Channel.create(name="ABC")
+    shows = Show.list(season=1)
+    abc.add_related("shows", *shows[:3])
+    assert {show.channel.id for show in Show.get_bulk({s.id for s in shows[:3]})} == {abc.id}
+    abc.remove_related("shows", shows[0])
+    assert Show.get(shows[0].id).channel is None
+    assert len(abc.shows) == 2
+
+
+def test_sharded_deletes(fox):
+    assert Show.delete_where(batch_size=4, season=1) == 10
+    assert Show.count() == 20
+    assert len(fox.shows) == 20
+    assert asyncio.run(Show.adelete_where(season=2, rating__lt=2)) == 3
+    assert Show.count(season=2) == 7
+    with pytest.raises(ValueError):
+        asyncio.run(Show.adelete_where())
+    assert Show.count() == 17
+    fox.delete()
+    assert Show.get(title="Episode 3x1").channel is None
+    assert not any(client.client.keys("Show:relationship:*") for client in databases["shows"].clients)
+
+
+def test_deletes_scan_their_ids(fox, monkeypatch):
+    # Ids are scanned a batch at a time rather than all read up front
+    sent = []
+    process_command = BaseFakeSocket._process_command
+
+    def recording(self, fields):
+        sent.append(fields[0].lower())
+        return process_command(self, fields)
+
+    monkeypatch.setattr(BaseFakeSocket, "_process_command", recording)
+    assert Show.delete_where(batch_size=4, season=1) == 10
+    assert asyncio.run(Show.adelete_where(batch_size=4, all=True)) == 20
+    assert b"sscan" in sent and b"smembers" not in sent
+    assert Show.count() == 0
+
+
+def test_sharded_async(fox):
+    async def scenario():
+        show = await Show.acreate(title="Episode 4x1", season=4, channel=fox)
+        assert await Show.aget(show.id) == show
+        assert await Show.acount(season=4) == 1
+        assert len(await Show.alist(channel=fox)) == 31
+        assert await Show.query().filter(season=4).aids() == {show.id}
+
+    asyncio.run(scenario())
+
+
+def test_hash_ring_moves_few_keys():
+    keys = [str(uuid4()) for _ in range(2000)]
+    before = HashRing(["a", "b", "c"])
+    after = HashRing(["a", "b", "c", "d"])
+    moved = [key for key in keys if before.node(key) != after.node(key)]
+    assert all(after.node(key) == 3 for key in moved)
+    assert len(moved) < len(keys) * 0.4
@@ -0,0 +1,218 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+import pytest
+from redorm import RedormBase, red, InstanceNotFound, many_to_one, one_to_many
+from redorm import model as redorm_model
+from redorm.instrumentation import measure
+from redorm.migrate import reindex
+
+
+@dataclass
+class Ticket(RedormBase):
+    code: str = field(metadata={"unique": True, "prefix_index": True})
+    kind: Optional[str] = field(metadata={"index": True}, default=None)
+    price: float = field(metadata={"range_index": True}, default=0.0)
+    stamps = one_to_many("Stamp", backref="ticket")
+
+    class Meta:
+        ttl = 3600
+
+
+@dataclass
+class Stamp(RedormBase):
+    place: str = field(metadata={"index": True})
+    ticket = many_to_one(Ticket, backref="stamps")
+
+    class Meta:
+        storage = "hash"
+        # Instances only expire when told to
+        ttl = None
+
+
+@dataclass
+class Turnstile(RedormBase):
+    number: int = field(metadata={"unique": True})
+
+
+@dataclass
+class Pass(RedormBase):
+    code: str = field(metadata={"unique": True})
+    number: int = field(metadata={"unique": True}, default=0)
+
+    class Meta:
+        storage = "hash"
+        ttl = 0.05
+
+
+@pytest.fixture
+def tickets(clean_db, monkeypatch):
+    monkeypatch.setattr(redorm_model, "sweep_interval", 0)
+    day = Ticket.create(code="DAY", kind="adult", price=5)
+    child = Ticket.create(code="CHILD", kind="child", price=2.5)
+    Stamp.create(place="Springfield", ticket=day)
+    Stamp.create(place="Shelbyville", ticket=child)
+    return day, child
+
+
+def codes(instances):
+    return {instance.code for instance in instances}
+
+
+def test_ttl_on_create(tickets):
+    day, _ = tickets
+    assert time.time() + 3590 < day.expires_at() <= time.time() + 3600
+    stamp = Stamp.get(place="Springfield")
+    assert stamp.expires_at() is None
+    # Saves leave the expiry time as it was
+    expires_at = day.expires_at()
+    day.update(price=6)
+    assert Ticket.expires_at(day.id) == expires_at
+
+
+def test_expired_instances_are_hidden(tickets):
+    day, child = tickets
+    day.expire(0)
+    with pytest.raises(InstanceNotFound):
+        Ticket.get(day.id)
+    with pytest.raises(InstanceNotFound):
+        Ticket.get(code="DAY")
+    assert Ticket.get_bulk({day.id, child.id}) == [child]
+    assert codes(Ticket.list()) == {"CHILD"}
+    assert Ticket.list(kind="adult") == []
+    assert codes(Ticket.list(price__gte=1)) == {"CHILD"}
+    assert Ticket.count() == 1
+    assert Ticket.count(kind="adult") == 0
+    assert not Ticket.exists(code__startswith="D")
+    assert Ticket.query().filter(price__gt=0).count() == 1
+    assert Ticket.query().filter(kind="adult").ids() == set()
+    assert Ticket.autocomplete("code", "") == [child]
+    assert Stamp.get(place="Springfield").ticket is None
+
+
+def test_sweep(tickets):
+    day, child = tickets
+    stamp = Stamp.get(place="Springfield")
+    day.expire(0)
+    assert Ticket.sweep() == 1
+    assert Ticket.sweep() == 0
+    assert not red.client.exists(Ticket._plan().member_key(day.id))
+    assert not any(day.id in key for key in red.client.keys("*"))
+    assert day.id not in red.client.zrange("Ticket:expiry", 0, -1)
+    assert red.client.smembers("Ticket:all") == {child.id}
+    assert Stamp.get(stamp.id).ticket is None
+    # Unique values of swept instances can be taken again
+    assert Ticket.create(code="DAY").code == "DAY"
+
+
+def test_expired_unique_values_are_free(clean_db, monkeypatch):
+    monkeypatch.setattr(redorm_model, "sweep_interval", 0)
+    old = Pass.create(code="DAY", number=1)
+    week = Pass.create(code="WEEK", number=2)
+    time.sleep(0.1)
+    # Taken from the expired instances before they're swept
+    day = Pass.create(code="DAY")
+    day.expire(60)
+    assert day.incr("number") == 1
+    assert Pass.sweep() == 2
+    assert Pass.get(code="DAY") == day
+    assert Pass.get(number=1) == day
+    assert not red.client.exists(Pass._plan().member_key(old.id))
+    with pytest.raises(InstanceNotFound):
+        week.refresh()
+
+
+def test_sweep_in_batches(clean_db, monkeypatch):
+    monkeypatch.setattr(redorm_model, "sweep_interval", 0)
+    created = Ticket.create_bulk([{"code": f"T{i}"} for i in range(7)])
+    for ticket in created[:5]:
+        ticket.expire(-1)
+    assert Ticket.sweep(batch_size=2) == 5
+    assert codes(Ticket.list()) == {"T5", "T6"}
+
+
+def test_persist_and_extend(tickets):
+    day, child = tickets
+    day.expire(None)
+    assert day.expires_at() is None
+    child.expire(0)
+    # Given a new expiry time after the sweep read it, so the sweep leaves it
+    Ticket.expire(child.id, 60)
+    assert Ticket.sweep() == 0
+    assert codes(Ticket.list()) == {"DAY", "CHILD"}
+    with pytest.raises(InstanceNotFound):
+        Ticket.expire("missing", 60)
+
+
+def test_expiring_models_only(tickets):
+    gate = Turnstile.create(number=1)
+    with pytest.raises(ValueError):
+        gate.expire(60)
+    assert gate.expires_at() is None
+    stamp = Stamp.get(place="Springfield")
+    stamp.expire(0)
+    assert Stamp.list(place="Springfield") == []
+    assert Stamp.count() == 1
+
+
+def test_creates_sweep(tickets, monkeypatch):
+    day, _ = tickets
+    monkeypatch.setattr(redorm_model, "sweep_interval", 60)
+    day.expire(0)
+    redorm_model.last_sweeps.pop("Ticket", None)
+    Ticket.create(code="WEEK")
+    assert not red.client.exists(Ticket._plan().member_key(day.id))
+    # Not again until the interval has passed
+    child = Ticket.get(code="CHILD")
+    child.expire(0)
+    Ticket.create(code="MONTH")
+    assert red.client.exists(Ticket._plan().member_key(child.id))
+    assert codes(Ticket.list()) == {"WEEK", "MONTH"}
+
+
+def test_creates_sweep_a_batch(clean_db, monkeypatch):
+    monkeypatch.setattr(redorm_model, "sweep_interval", 60)
+    monkeypatch.setattr(redorm_model, "SWEEP_BATCH_SIZE", 10)
+    created = Ticket.create_bulk([{"code": f"T{i}"} for i in range(25)])
+    red.client.zadd("Ticket:expiry", {ticket.id: 0 for ticket in created})
+    redorm_model.last_sweeps.pop("Ticket", None)
+    with measure() as stats:
+        Ticket.create(code="WEEK")
+    # The batch's deletes and the create's own commands, rather than a delete for every expired instance
+    assert stats.commands <= 10 + 5 and stats.round_trips <= 4
+    assert Ticket.count() == 1
+    assert red.client.scard("Ticket:all") == 16
+    # More are due, so the next creates carry on until they're gone
+    Ticket.create(code="MONTH")
+    Ticket.create(code="YEAR")
+    assert red.client.scard("Ticket:all") == 3
+    # Caught up, so the interval applies again
+    Ticket.get(code="WEEK").expire(0)
+    Ticket.create(code="DECADE")
+    assert Ticket.sweep() == 1
+
+
+def test_reindex_prunes_expiry(tickets):
+    day, _ = tickets
+    red.client.zadd("Ticket:expiry", {"gone": 1})
+    report = reindex(Ticket)
+    assert report.removed == 1
+    assert set(red.client.zrange("Ticket:expiry", 0, -1)) == {day.id, tickets[1].id}
+
+
+def test_async_expiry(tickets):
+    day, child = tickets
+
+    async def scenario():
+        await day.aexpire(0)
+        assert codes(await Ticket.alist()) == {"CHILD"}
+        assert await Ticket.acount() == 1
+        assert await Ticket.query().filter(price__gte=0).acount() == 1
+        with pytest.raises(InstanceNotFound):
+            await Ticket.aget(day.id)
+        assert await child.aexpires_at() is not None
+        assert await Ticket.asweep() == 1
+
+    asyncio.run(scenario())
+    assert red.client.smembers("Ticket:all") == {child.id}
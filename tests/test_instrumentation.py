@@ -0,0 +1,103 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+import pytest
+from redorm import RedormBase, add_listener, remove_listener, assert_max_round_trips, measure, one_to_many, many_to_one
+from redorm import instrumentation, red
+
+
+@dataclass
+class Tavern(RedormBase):
+    name: str = field(metadata={"unique": True})
+    regulars = one_to_many("Regular", backref="tavern")
+
+
+@dataclass
+class Regular(RedormBase):
+    name: str = field(metadata={"unique": True})
+    stool: int = field(metadata={"index": True}, default=0)
+    tavern = many_to_one(Tavern, backref="regulars", lazy=False)
+
+
+@pytest.fixture
+def reports(clean_db):
+    reported = []
+    add_listener(reported.append)
+    yield reported
+    remove_listener(reported.append)
+
+
+def test_round_trips(clean_db):
+    with assert_max_round_trips(1):
+        moes = Tavern.create(name="Moe's")
+    with assert_max_round_trips(1):
+        Regular.create_bulk([{"name": "Barney", "stool": 1, "tavern": moes}, {"name": "Lenny", "stool": 2}])
+    barney = Regular.get(name="Barney")
+    with assert_max_round_trips(1):
+        assert Regular.get(barney.id).tavern == moes
+    with assert_max_round_trips(2):
+        assert Regular.list(stool=2)[0].name == "Lenny"
+    with pytest.raises(AssertionError, match="2 round trips"):
+        with assert_max_round_trips(1):
+            Regular.get(barney.id)
+            Regular.get(barney.id)
+
+
+def test_immediate_pipeline_commands(clean_db):
+    # redis-py checks and loads the scripts registered on a pipeline with commands of their own before sending it
+    script = red.client.register_script("return 1")
+    with measure() as stats:
+        pipeline = red.pipeline()
+        script(client=pipeline)
+        pipeline.execute()
+    assert stats.round_trips == 3 and stats.commands == 3
+
+
+def test_listeners(reports):
+    moes = Tavern.create(name="Moe's")
+    carl = Regular.create(name="Carl", stool=3, tavern=moes)
+    assert [(stats.model, stats.operation) for stats in reports] == [("Tavern", "create"), ("Regular", "create")]
+    reports.clear()
+    assert Regular.query().filter(stool=3).count() == 1
+    carl = Regular.get(carl.id)
+    carl.update(stool=4)
+    assert [(stats.model, stats.operation) for stats in reports] == [
+        ("Regular", "query.count"),
+        ("Regular", "get"),
+        ("Regular", "update"),
+    ]
+    get = reports[1]
+    assert get.commands >= 1 and get.round_trips == 1
+    assert get.bytes_out > len(carl.id) and get.bytes_in > len("Carl")
+    assert get.duration > 0
+
+
+def test_measure_nested_operations(reports):
+    with measure() as stats:
+        Tavern.create(name="Flaming Moe's")
+        Tavern.count()
+    assert stats.round_trips == 2
+    # Operations inside a measured block are counted towards it rather than reported
+    assert reports == []
+
+
+def test_slow_operation_log(clean_db, monkeypatch, caplog):
+    monkeypatch.setattr(instrumentation, "slow_operation_threshold", 0)
+    with caplog.at_level(logging.WARNING, logger="redorm"):
+        Tavern.create(name="The Gilded Truffle")
+    assert "Slow Tavern.create" in caplog.text
+    assert "1 round trips" in caplog.text
+
+
+def test_async_round_trips(reports):
+    async def scenario():
+        with assert_max_round_trips(1):
+            moes = await Tavern.acreate(name="Moe's")
+        homer = await Regular.acreate(name="Homer", tavern=moes)
+        with assert_max_round_trips(1):
+            homer = await Regular.aget(homer.id)
+        assert homer.tavern == moes
+        assert (await Regular.query().filter(stool=0).acount()) == 1
+
+    asyncio.run(scenario())
+    assert [stats.operation for stats in reports] == ["acreate", "query.acount"]
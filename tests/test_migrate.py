@@ -0,0 +1,122 @@
+import json
+from dataclasses import dataclass, field
+from typing import Optional
+import pytest
+from redorm import RedormBase, red
+from redorm import migrate
+from redorm.migrate import reindex
+
+
+@dataclass
+class Diner(RedormBase):
+    name: str = field(metadata={"unique": True, "prefix_index": True, "casefold": True})
+    town: Optional[str] = field(metadata={"index": True}, default=None)
+    seats: int = field(metadata={"range_index": True}, default=0)
+
+
+@dataclass
+class Booth(RedormBase):
+    number: int = field(metadata={"unique": True})
+    side: str = field(metadata={"index": True})
+    width: float = field(metadata={"range_index": True}, default=1.0)
+
+    class Meta:
+        storage = "hash"
+
+
+def forget_indexes(model) -> None:
+    # Leaves stored instances as they would be if their fields had only just been indexed
+    prefix = model._plan().key_prefix
+    for pattern in (":key:*", ":keynull:*", ":index:*", ":indexnull:*", ":range:*", ":lex:*"):
+        for key in red.client.keys(prefix + pattern):
+            red.client.delete(key)
+
+
+@pytest.fixture
+def diners(clean_db):
+    Diner.create_bulk(
+        [
+            {"name": "Krusty Burger", "town": "Springfield", "seats": 40},
+            {"name": "Lard Lad", "town": "Springfield", "seats": 12},
+            {"name": "The Frying Dutchman", "seats": 80},
+        ]
+    )
+    forget_indexes(Diner)
+
+
+def test_backfill(diners):
+    assert Diner.list(town="Springfield") == []
+    report = reindex(Diner, batch_size=2)
+    assert report.scanned == 3
+    # The id, name, town, seats and name prefix entries of each
+    assert report.fixed == 15
+    assert report.conflicts == []
+    assert {diner.name for diner in Diner.list(town="Springfield")} == {"Krusty Burger", "Lard Lad"}
+    assert Diner.get(town=None).name == "The Frying Dutchman"
+    assert Diner.get(name="Lard Lad").seats == 12
+    assert Diner.count(seats__gte=40) == 2
+    assert Diner.get(name__startswith="lard").seats == 12
+    assert not red.client.exists("Diner:reindex")
+    assert reindex(Diner).fixed == 0
+
+
+def test_verify_and_drop(diners):
+    reindex(Diner)
+    krusty = Diner.get(name="Krusty Burger")
+    red.client.sadd("Diner:index:town:Shelbyville", krusty.id, "gone")
+    red.client.sadd("Diner:indexnull:town", krusty.id)
+    red.client.hset("Diner:key:name", "Moe's", krusty.id)
+    red.client.zadd("Diner:range:seats", {"gone": 3})
+    red.client.sadd("Diner:all", "gone")
+    red.client.zadd("Diner:lex:name", {f"moe's\0{krusty.id}": 0})
+    red.client.sadd("Diner:index:chef:Luigi", krusty.id)
+    red.client.hset("Diner:key:town", "Springfield", krusty.id)
+    report = reindex(Diner)
+    # Krusty Burger's null town entry goes when its town is indexed again, the rest when verifying
+    assert report.fixed == 1
+    assert report.removed == 6
+    assert sorted(report.dropped) == ["Diner:index:chef:Luigi", "Diner:key:town"]
+    assert Diner.list(town="Shelbyville") == []
+    assert Diner.count(town=None) == 1
+    assert not red.client.hexists("Diner:key:name", "Moe's")
+    assert Diner.count() == 3
+    assert Diner.count(seats__lt=100) == 3
+    assert Diner.list(name__startswith="moe") == []
+
+
+def test_unique_conflicts(diners):
+    ids = red.client.smembers("Diner:all")
+    for instance_id in ids:
+        document = json.loads(red.client.get(Diner._plan().member_key(instance_id)))
+        document["name"] = "Krusty Burger"
+        red.client.set(Diner._plan().member_key(instance_id), json.dumps(document))
+    report = reindex(Diner)
+    # The first one scanned gets the name, the other two conflict with it
+    assert len(report.conflicts) == 2
+    owner = red.client.hget("Diner:key:name", "Krusty Burger")
+    assert report.conflicts[0][1:] == ("name", owner)
+    assert {instance_id for instance_id, _, _ in report.conflicts} == ids - {owner}
+
+
+def test_hash_storage(clean_db):
+    Booth.create_bulk([{"number": 1, "side": "left", "width": 1.5}, {"number": 2, "side": "right"}])
+    forget_indexes(Booth)
+    report = reindex(Booth)
+    assert report.scanned == 2 and report.fixed == 8
+    assert Booth.get(number=2).side == "right"
+    assert Booth.get(side="left", width__gt=1.2).number == 1
+
+
+def test_resume(diners, monkeypatch):
+    def interrupt(seconds):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(migrate.time, "sleep", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        reindex(Diner, batch_size=1, pause=0.1)
+    assert red.client.hget("Diner:reindex", "backfill:Diner:all") not in (None, "done")
+    monkeypatch.undo()
+    report = reindex(Diner, batch_size=1)
+    assert 0 < report.scanned < 3
+    assert Diner.count(town="Springfield") == 2
+    assert Diner.count(seats__gte=0) == 3
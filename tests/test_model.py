@@ -1,7 +1,22 @@
 from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional
 import pytest
-from redorm import RedormBase
-from redorm.exceptions import MultipleInstancesReturned, UniqueContstraintViolation
+from dataclasses_jsonschema import ValidationError
+from redorm import RedormBase, red
+from redorm.exceptions import (
+    BoundsExceeded,
+    BulkUniqueConstraintViolation,
+    BulkWriteError,
+    FilterOnUnindexedField,
+    InstanceNotFound,
+    MultipleInstancesReturned,
+    UniqueContstraintViolation,
+    UnknownFieldName,
+    VersionConflict,
+)
+from redorm.migrate import reindex
+from redorm.types import Binary, DateTime
 
 
 # All data from https://simpsons.fandom.com/wiki or madeup
@@ -85,3 +100,400 @@ def test_unique(clean_db, bart):
         other_bart = User.create(username="bart", favourite_colour="red", phrase="Ay Caramba", job="Student")
     user = User.get(username="bart")
     assert user.id == bart.id
+
+
+@dataclass
+class Episode(RedormBase):
+    title: str
+    season: int = field(metadata={"index": True, "range_index": True})
+    rating: Optional[float] = field(metadata={"range_index": True}, default=None)
+    aired: Optional[DateTime] = field(metadata={"range_index": True}, default=None)
+
+
+@pytest.fixture
+def episodes():
+    return [
+        Episode.create(
+            title="Simpsons Roasting on an Open Fire", season=1, rating=8.2, aired=datetime(1989, 12, 17).timestamp()
+        ),
+        Episode.create(title="Bart the Genius", season=1, rating=7.7, aired=datetime(1990, 1, 14).timestamp()),
+        Episode.create(title="Bart Gets an F", season=2, rating=8.1, aired=datetime(1990, 10, 11).timestamp()),
+        Episode.create(title="Treehouse of Horror V", season=6),
+    ]
+
+
+def test_range_filters(clean_db, episodes):
+    assert len(Episode.list(season__gt=1)) == 2
+    assert len(Episode.list(season__gte=1)) == 4
+    assert len(Episode.list(season__lt=2)) == 2
+    assert len(Episode.list(season__between=(2, 6))) == 2
+    assert len(Episode.list(rating__lte=8.1)) == 2
+    assert {e.title for e in Episode.list(aired__between=(datetime(1990, 1, 1), datetime(1990, 12, 31)))} == {
+        "Bart the Genius",
+        "Bart Gets an F",
+    }
+    # Range lookups combine with set indexes
+    assert [e.title for e in Episode.list(season=1, rating__gt=8)] == ["Simpsons Roasting on an Open Fire"]
+
+
+def test_range_index_maintained(clean_db, episodes):
+    genius = episodes[1]
+    genius.update(rating=9.5)
+    assert [e.id for e in Episode.list(rating__gt=9)] == [genius.id]
+    genius.update(rating=None)
+    assert Episode.list(rating__gt=9) == []
+    episodes[0].delete()
+    assert len(Episode.list(season__lte=1)) == 1
+
+
+def test_range_filter_requires_range_index(clean_db):
+    with pytest.raises(FilterOnUnindexedField):
+        User.list(job__gt="A")
+
+
+def test_iter(clean_db, homer, bart, marge):
+    assert {u.id for u in User.iter(batch_size=1)} == {homer.id, bart.id, marge.id}
+    assert {u.id for u in User.iter(batch_size=2, favourite_colour="red")} == {homer.id, bart.id}
+    assert [u.id for u in User.iter(favourite_colour="red", job="Student")] == [bart.id]
+    assert [u.id for u in User.iter(username="marge")] == [marge.id]
+
+
+def test_iter_skips_rescanned_ids(clean_db, homer, bart, marge, monkeypatch):
+    sscan = red.client.sscan
+    scanned = []
+
+    def rescan(*args, **kwargs):
+        # Returns the ids of earlier calls again, as a scan can while a set is rehashed
+        cursor, member_ids = sscan(*args, **kwargs)
+        scanned.extend(member_ids)
+        return cursor, list(scanned)
+
+    monkeypatch.setattr(red.client, "sscan", rescan)
+    assert sorted(u.id for u in User.iter(batch_size=1)) == sorted([homer.id, bart.id, marge.id])
+
+
+def test_iter_cleans_up_temporary_keys(clean_db, homer, bart):
+    assert len(list(User.iter(favourite_colour="red", job="Student"))) == 1
+    assert red.client.keys("User:tmp:*") == []
+
+
+def test_create_bulk(clean_db):
+    users = User.create_bulk(
+        [
+            dict(username="homer", favourite_colour="red", phrase="Doh", job="Safety Inspector"),
+            dict(username="bart", favourite_colour="red", phrase="Ay Caramba", job="Student"),
+        ]
+    )
+    assert [u.username for u in users] == ["homer", "bart"]
+    assert User.get(username="bart").id == users[1].id
+    assert len(User.list(favourite_colour="red")) == 2
+
+
+def test_create_bulk_reports_unique_violations(clean_db, bart):
+    with pytest.raises(BulkUniqueConstraintViolation) as exc_info:
+        User.create_bulk(
+            [
+                dict(username="lisa", favourite_colour="blue", phrase="If anyone wants me...", job="Student"),
+                dict(username="bart", favourite_colour="red", phrase="Eat my shorts", job="Student"),
+                dict(username="lisa", favourite_colour="blue", phrase="Duplicate", job="Student"),
+            ],
+            batch_size=2,
+        )
+    assert set(exc_info.value.errors) == {1, 2}
+    assert [u.username for u in exc_info.value.saved] == ["lisa"]
+    assert len(User.list(job="Student")) == 2
+
+
+def test_bulk_saves_after_a_script_flush(clean_db, bart):
+    # The scripts were loaded when the client was set up, a server that lost them runs them with EVAL
+    red.client.script_flush()
+    with pytest.raises(BulkUniqueConstraintViolation):
+        User.create_bulk(
+            [
+                dict(username="lisa", favourite_colour="blue", phrase="If anyone wants me...", job="Student"),
+                dict(username="bart", favourite_colour="red", phrase="Eat my shorts", job="Student"),
+            ]
+        )
+    assert User.get(username="lisa").job == "Student"
+    assert red.client.script_exists(red.unique_save_script.sha) == [True]
+
+
+def test_save_many(clean_db, homer, bart):
+    homer.job = "Astronaut"
+    bart.favourite_colour = "blue"
+    User.save_many([homer, bart])
+    assert User.get(job="Astronaut").id == homer.id
+    assert User.get(favourite_colour="blue").id == bart.id
+    assert User.list(favourite_colour="red") == [homer]
+
+
+@dataclass
+class Donut(RedormBase):
+    flavour: str = field(metadata={"unique": True})
+    price: float = field(metadata={"index": True})
+    sprinkles: bool = field(metadata={"index": True})
+    code: Optional[int] = field(metadata={"unique": True}, default=None)
+
+
+def test_save_diffs_against_stored_document(clean_db, homer):
+    stale = User.get(homer.id)
+    homer.update(job="Astronaut")
+    stale.job = "Clown"
+    stale.save()
+    assert User.list(job="Astronaut") == []
+    assert User.get(job="Clown").id == homer.id
+
+
+def test_index_values_of_other_types(clean_db):
+    pink = Donut.create(flavour="pink", price=0.1, sprinkles=True)
+    plain = Donut.create(flavour="plain", price=2.0, sprinkles=False, code=7)
+    assert Donut.get(price=0.1).id == pink.id
+    assert Donut.get(sprinkles=False).id == plain.id
+    assert Donut.get(code=7).id == plain.id
+    assert Donut.get(code=None).id == pink.id
+    pink.code = 7
+    with pytest.raises(UniqueContstraintViolation):
+        pink.save()
+    plain.update(price=0.1, code=None)
+    assert len(Donut.list(price=0.1)) == 2
+    assert len(Donut.list(code=None)) == 2
+
+
+def test_index_values_of_large_ints(clean_db):
+    # Past 2^53 integers don't survive being decoded to doubles, so the scripts have to index their stored digits
+    big = 2 ** 60 + 1
+    jelly = Donut.create(flavour="jelly", price=1.0, sprinkles=False, code=big)
+    jelly.code = 5
+    jelly.save()
+    assert red.client.hkeys("Donut:key:code") == ["5"]
+    glazed = Donut.create(flavour="glazed", price=1.0, sprinkles=False, code=big)
+    assert Donut.get(code=big).id == glazed.id
+    report = reindex(Donut)
+    assert (report.fixed, report.removed) == (0, 0)
+    glazed.delete()
+    assert red.client.hkeys("Donut:key:code") == ["5"]
+    duff = Tally.create(name="Duff Dry", pints=big)
+    assert duff.incr("pints") == big + 1
+    assert Tally.get(pints=big + 1).id == duff.id
+    duff.update(pints=0)
+    assert red.client.keys("Tally:index:pints:*") == ["Tally:index:pints:0"]
+
+
+@dataclass
+class Character(RedormBase):
+    name: str = field(metadata={"unique": True})
+    town: str = field(metadata={"index": True})
+    age: int = field(metadata={"range_index": True})
+    catchphrase: Optional[str] = None
+
+    class Meta:
+        storage = "hash"
+
+
+def test_hash_storage(clean_db):
+    ned = Character.create(name="ned", town="Springfield", age=60, catchphrase="Okily dokily")
+    assert red.client.hget(f"Character:member:{ned.id}", "name") == '"ned"'
+    assert Character.get(name="ned") == ned
+    assert Character.list(age__gte=50) == [ned]
+    ned.update(catchphrase=None)
+    assert not red.client.hexists(f"Character:member:{ned.id}", "catchphrase")
+    assert Character.get(ned.id).catchphrase is None
+
+
+def test_projection(clean_db, homer):
+    ned = Character.create(name="ned", town="Springfield", age=60, catchphrase="Okily dokily")
+    partial = Character.list(only=["name"])[0]
+    assert partial.__dict__.keys() >= {"id", "name"}
+    assert "catchphrase" not in partial.__dict__
+    # Deferred fields are loaded on first access
+    assert partial.catchphrase == "Okily dokily"
+    assert type(partial) is Character and partial == ned
+    # The model's own defaults are left alone
+    assert Character.__dict__["catchphrase"] is None
+    assert Character.list(only=["name"])[0] == ned
+    with pytest.raises(NotImplementedError):
+        User.list(only=["username"])
+
+
+def test_partial_update(clean_db):
+    ned = Character.create(name="ned", town="Springfield", age=60, catchphrase="Okily dokily")
+    partial = Character.get_bulk({ned.id}, only=["town"])[0]
+    partial.update(town="Shelbyville", age=61)
+    assert "catchphrase" not in partial.__dict__
+    stored = Character.get(ned.id)
+    assert (stored.town, stored.age, stored.catchphrase) == ("Shelbyville", 61, "Okily dokily")
+    assert Character.list(town="Springfield") == []
+    assert Character.list(age__gt=60) == [stored]
+    moe = Character.create(name="moe", town="Springfield", age=50)
+    with pytest.raises(UniqueContstraintViolation):
+        moe.update(name="ned", age=51)
+    # Nothing is changed by an update that fails
+    assert (moe.name, moe.age) == ("moe", 50)
+
+
+@dataclass
+class Photo(RedormBase):
+    title: str
+    data: Binary
+
+    class Meta:
+        storage = "hash"
+
+
+def test_projection_skips_binary_fields(clean_db):
+    photo = Photo.create(title="Homer at the bat", data="AAE=")
+    partial = Photo.list(only=["title"])[0]
+    assert "data" not in partial.__dict__
+    assert partial.data == b"\x00\x01"
+    assert partial == photo
+
+
+@dataclass
+class Checked(RedormBase):
+    name: str
+    count: int
+
+    class Meta:
+        validate = True
+
+
+def test_validation_is_opt_in(clean_db):
+    assert User.create(username=1, favourite_colour="red", phrase="Doh", job="Safety Inspector").username == 1
+    with pytest.raises(ValidationError):
+        Checked.create(name=1, count=2)
+    assert Checked.create(name="Lenny", count=2).count == 2
+
+
+def test_count_and_exists(clean_db, homer, bart, marge, episodes, monkeypatch):
+    monkeypatch.setattr(User, "get_bulk", None)
+    assert User.count() == 3
+    assert User.count(favourite_colour="red") == 2
+    assert User.count(favourite_colour="red", job="Student") == 1
+    assert User.count(username="homer") == 1
+    assert User.count(username="ned") == 0
+    assert User.exists(job="Housewife")
+    assert not User.exists(favourite_colour="blue")
+    assert Episode.count(season__gt=1) == 2
+    assert Episode.count(rating=7.7) == 1
+    assert Episode.count(season=1, rating__gt=8) == 1
+    with pytest.raises(ValueError):
+        Episode.count(rating=None)
+    with pytest.raises(FilterOnUnindexedField):
+        User.count(phrase="Doh")
+
+
+@dataclass
+class Tab(RedormBase):
+    customer: str = field(metadata={"unique": True})
+    total: float = 0.0
+    version: int = field(default=0, metadata={"version": True})
+
+
+@dataclass
+class Tally(RedormBase):
+    name: str = field(metadata={"unique": True})
+    pints: int = field(default=0, metadata={"index": True})
+    rating: Optional[float] = field(default=None, metadata={"range_index": True})
+    version: int = field(default=0, metadata={"version": True})
+
+    class Meta:
+        storage = "hash"
+
+
+def test_versioned_save(clean_db):
+    tab = Tab.create(customer="Barney")
+    assert tab.version == 1
+    stale = Tab.get(tab.id)
+    tab.total = 4.5
+    tab.save()
+    assert tab.version == 2
+    stale.total = 1.0
+    with pytest.raises(VersionConflict):
+        stale.save()
+    assert Tab.get(tab.id).total == 4.5
+    with pytest.raises(BulkWriteError) as e:
+        Tab.save_many([stale])
+    assert not isinstance(e.value, BulkUniqueConstraintViolation)
+    assert str(e.value) == "1 rows couldn't be saved"
+    assert isinstance(e.value.errors[0], VersionConflict)
+
+
+def test_versioned_update_is_lock_free(clean_db, monkeypatch):
+    tab = Tab.create(customer="Moe")
+    stale = Tab.get(tab.id)
+    monkeypatch.setattr(red.client, "lock", None)
+    tab.update(total=2.0)
+    # Reads the latest version before writing, so a stale instance still updates
+    stale.update(customer="Moe Szyslak")
+    assert stale.version == 3
+    assert Tab.get(tab.id).total == 2.0
+    refresh = Tab.refresh
+    writes = []
+
+    def racing_refresh(self):
+        refresh(self)
+        if not writes:
+            # Another writer saves between this update's read and write
+            writes.append(Tab.get(self.id))
+            writes[0].update(total=10.0)
+
+    monkeypatch.setattr(Tab, "refresh", racing_refresh)
+    stale.update(customer="Moe's Tavern")
+    assert Tab.get(tab.id).total == 10.0
+    assert Tab.get(tab.id).customer == "Moe's Tavern"
+    assert Tab.get(tab.id).version == 5
+
+
+def test_update_where(clean_db):
+    tally = Tally.create(name="Duff")
+    Tally.update_where(tally.id, pints=5)
+    stored = Tally.get(tally.id)
+    assert (stored.pints, stored.version) == (5, 2)
+    assert Tally.get(pints=5).id == tally.id
+    assert Tally.list(pints=0) == []
+    tally.update(name="Duff Beer")
+    assert tally.version == 3
+    assert Tally.get(name="Duff Beer").pints == 5
+    with pytest.raises(InstanceNotFound):
+        Tally.update_where("missing", pints=1)
+    assert Tally.count() == 1
+    with pytest.raises(UnknownFieldName):
+        Tally.update_where(tally.id, colour="red")
+    tab = Tab.create(customer="Lenny")
+    Tab.update_where(tab.id, total=3.0)
+    assert Tab.get(tab.id).total == 3.0
+
+
+def test_incr_and_decr(clean_db):
+    duff = Tally.create(name="Duff")
+    assert duff.incr("pints") == 1
+    assert Tally.incr(duff.id, "pints", 4) == 5
+    assert duff.pints == 1
+    assert duff.decr("pints", 2) == 3
+    assert (duff.pints, duff.version) == (3, 4)
+    assert Tally.get(pints=3).id == duff.id
+    assert Tally.list(pints=0) == []
+    assert duff.incr("rating", 2.5) == 2.5
+    assert Tally.incr(duff.id, "rating", 0.25) == 2.75
+    assert [t.id for t in Tally.list(rating__gt=2.5)] == [duff.id]
+    with pytest.raises(BoundsExceeded):
+        duff.decr("pints", 4, minimum=0)
+    with pytest.raises(BoundsExceeded):
+        Tally.incr(duff.id, "pints", maximum=3)
+    assert Tally.get(duff.id).pints == 3
+    with pytest.raises(ValueError):
+        duff.incr("pints", 0.5)
+    with pytest.raises(ValueError):
+        duff.incr("name")
+    with pytest.raises(InstanceNotFound):
+        Tally.incr("missing", "pints")
+
+
+def test_incr_json_document(clean_db, monkeypatch):
+    tab = Tab.create(customer="Carl")
+    monkeypatch.setattr(red.client, "lock", None)
+    assert tab.incr("total", 3.5) == 3.5
+    assert Tab.decr(tab.id, "total", 1.0, minimum=0) == 2.5
+    with pytest.raises(BoundsExceeded):
+        tab.decr("total", 5.0, minimum=0)
+    assert Tab.get(tab.id).total == 2.5
@@ -0,0 +1,166 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Optional
+import pytest
+from redorm import RedormBase, red, many_to_one, one_to_many
+from redorm.exceptions import FilterOnUnindexedField, UnknownFieldName
+
+
+@dataclass
+class Town(RedormBase):
+    name: str = field(metadata={"unique": True})
+    residents = one_to_many("Resident", backref="town")
+
+
+@dataclass
+class Resident(RedormBase):
+    name: str = field(metadata={"unique": True})
+    job: Optional[str] = field(metadata={"index": True}, default=None)
+    age: int = field(metadata={"range_index": True}, default=0)
+    hair: str = field(metadata={"index": True}, default="")
+    town = many_to_one(Town, backref="residents")
+
+
+@dataclass
+class Customer(RedormBase):
+    name: str = field(metadata={"prefix_index": True, "casefold": True})
+    email: str = field(metadata={"unique": True, "prefix_index": True})
+    tier: str = field(metadata={"index": True}, default="basic")
+
+
+@pytest.fixture
+def springfield(clean_db):
+    springfield = Town.create(name="Springfield")
+    shelbyville = Town.create(name="Shelbyville")
+    Resident.create(name="Homer", job="Safety Inspector", age=39, hair="bald", town=springfield)
+    Resident.create(name="Marge", job="Housewife", age=36, hair="blue", town=springfield)
+    Resident.create(name="Bart", age=10, hair="spiky", town=springfield)
+    Resident.create(name="Lisa", age=8, hair="spiky", town=springfield)
+    Resident.create(name="Shelbyville Manhattan", job="Mayor", age=60, hair="white", town=shelbyville)
+    return springfield
+
+
+def names(queryset):
+    return {r.name for r in queryset}
+
+
+def test_filter(springfield):
+    assert names(Resident.query()) == {"Homer", "Marge", "Bart", "Lisa", "Shelbyville Manhattan"}
+    assert names(Resident.query().filter(hair="spiky", town=springfield)) == {"Bart", "Lisa"}
+    assert names(Resident.query().filter(hair="spiky").filter(age__gt=9)) == {"Bart"}
+    assert names(Resident.query().filter(job=None)) == {"Bart", "Lisa"}
+    assert names(Resident.query().filter(name="Homer")) == {"Homer"}
+
+
+def test_filter_any_and_in(springfield):
+    assert names(Resident.query().filter_any(job="Mayor", hair="blue")) == {"Shelbyville Manhattan", "Marge"}
+    assert names(Resident.query().filter(hair__in=["bald", "blue"])) == {"Homer", "Marge"}
+    assert names(Resident.query().filter(name__in=["Bart", "Nelson"])) == {"Bart"}
+    assert names(Resident.query().filter_any(name="Lisa", age__gte=39).filter(town=springfield)) == {"Lisa", "Homer"}
+
+
+def test_exclude(springfield):
+    assert names(Resident.query().exclude(town=springfield)) == {"Shelbyville Manhattan"}
+    assert names(Resident.query().filter(town=springfield).exclude(hair="spiky", age__lt=9)) == {
+        "Homer",
+        "Marge",
+        "Bart",
+    }
+    assert names(Resident.query().filter(hair="spiky").exclude(job="Mayor")) == {"Bart", "Lisa"}
+
+
+def test_count_ids_and_cleanup(springfield):
+    queryset = Resident.query().filter_any(hair="spiky", job="Mayor").exclude(name="Lisa")
+    assert queryset.count() == 2
+    assert queryset.exists()
+    assert len(queryset.ids()) == 2
+    assert not Resident.query().filter(name="Nelson", hair="spiky").exists()
+    assert red.client.keys("Resident:tmp:*") == []
+
+
+def test_invalid_filters(springfield):
+    with pytest.raises(FilterOnUnindexedField):
+        Town.query().filter(name__gt="S").ids()
+    with pytest.raises(UnknownFieldName):
+        Resident.query().filter(shoe_size=12).ids()
+
+
+def test_async_queryset(springfield):
+    async def scenario():
+        queryset = Resident.query().filter(town=springfield).exclude(hair="spiky")
+        assert await queryset.acount() == 2
+        assert {r.name for r in await queryset.aall()} == {"Homer", "Marge"}
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def customers(clean_db):
+    Customer.create(name="Homer", email="homer@plant.com", tier="gold")
+    Customer.create(name="Hans Moleman", email="Hans@moleman.com")
+    Customer.create(name="hank scorpio", email="hank@globex.com", tier="gold")
+    Customer.create(name="Herman", email="herman@militaryantiques.com")
+    Customer.create(name="Apu", email="apu@kwikemart.com")
+
+
+def test_prefix_index(customers):
+    assert names(Customer.list(name__startswith="h")) == {"Homer", "Hans Moleman", "hank scorpio", "Herman"}
+    assert names(Customer.list(name__startswith="HA")) == {"Hans Moleman", "hank scorpio"}
+    assert names(Customer.list(name__startswith="h", tier="gold")) == {"Homer", "hank scorpio"}
+    assert names(Customer.list(name__gte="he", name__lt="ho")) == {"Herman"}
+    assert names(Customer.list(name__gte="he", name__lt="hoz")) == {"Herman", "Homer"}
+    assert names(Customer.list(name__between=("hank scorpio", "herman"))) == {"hank scorpio", "Hans Moleman", "Herman"}
+    assert names(Customer.list(name__gt="hank scorpio", name__lte="Homer")) == {"Hans Moleman", "Herman", "Homer"}
+    assert names(Customer.list(name="HOMER")) == {"Homer"}
+    assert {c.email for c in Customer.list(email__startswith="h")} == {
+        "homer@plant.com",
+        "hank@globex.com",
+        "herman@militaryantiques.com",
+    }
+    assert Customer.count(name__startswith="h") == 4
+    assert Customer.count(name__startswith="h", tier="basic") == 2
+    queryset = Customer.query().filter_any(name__startswith="a", tier="gold").exclude(name__startswith="hom")
+    assert names(queryset) == {"Apu", "hank scorpio"}
+    assert queryset.count() == 2
+
+
+def test_prefix_index_writes(customers):
+    homer = Customer.get(email="homer@plant.com")
+    homer.update(name="Max Power")
+    assert names(Customer.list(name__startswith="ho")) == set()
+    assert names(Customer.list(name__startswith="max")) == {"Max Power"}
+    Customer.get(email="apu@kwikemart.com").delete()
+    assert red.client.zrange("Customer:lex:name", 0, -1) == [
+        f"hank scorpio\0{Customer.get(email='hank@globex.com').id}",
+        f"hans moleman\0{Customer.get(email='Hans@moleman.com').id}",
+        f"herman\0{Customer.get(email='herman@militaryantiques.com').id}",
+        f"max power\0{homer.id}",
+    ]
+
+
+def test_autocomplete(customers):
+    assert [c.name for c in Customer.autocomplete("name", "h", limit=3)] == ["hank scorpio", "Hans Moleman", "Herman"]
+    assert [c.email for c in Customer.autocomplete("email", "h")] == [
+        "hank@globex.com",
+        "herman@militaryantiques.com",
+        "homer@plant.com",
+    ]
+    assert Customer.autocomplete("name", "z") == []
+    with pytest.raises(FilterOnUnindexedField):
+        Customer.autocomplete("tier", "g")
+    with pytest.raises(FilterOnUnindexedField):
+        Customer.list(tier__startswith="g")
+    with pytest.raises(ValueError):
+
+        @dataclass
+        class Receipt(RedormBase):
+            total: int = field(metadata={"prefix_index": True})
+
+        Receipt._plan()
+
+    async def scenario():
+        assert [c.name for c in await Customer.aautocomplete("name", "ha")] == ["hank scorpio", "Hans Moleman"]
+        assert {c.name for c in await Customer.alist(name__startswith="a")} == {"Apu"}
+        assert await Customer.query().filter(name__startswith="h").acount() == 4
+
+    asyncio.run(scenario())
@@ -0,0 +1,145 @@
+from dataclasses import dataclass, field
+import pytest
+from redorm import RedormBase, red, many_to_many, many_to_one, one_to_many, one_to_one
+from redorm.exceptions import InstanceNotFound, UniqueContstraintViolation, UnknownFieldName
+
+
+@dataclass
+class Person(RedormBase):
+    name: str = field(metadata={"unique": True})
+    siblings = many_to_many(foreign_type="Person", backref="siblings")
+    dad = many_to_one(foreign_type="Person", backref="children")
+    children = one_to_many(foreign_type="Person", backref="dad")
+    favourite_color = one_to_one("Color", backref="liker")
+
+
+@dataclass
+class Color(RedormBase):
+    name: str
+    liker = one_to_one(Person, backref="favourite_color")
+
+
+@dataclass
+class Band(RedormBase):
+    name: str
+    members = one_to_many("Musician", backref="band", lazy=False)
+
+
+@dataclass
+class Musician(RedormBase):
+    name: str
+    band = many_to_one(Band, backref="members", lazy=False)
+
+
+@pytest.fixture
+def simpsons(clean_db):
+    abe = Person.create(name="Abe")
+    homer = Person.create(name="Homer", dad=abe, favourite_color=Color.create(name="Red"))
+    bart = Person.create(name="Bart", dad=homer, favourite_color=Color.create(name="Blue"))
+    lisa = Person.create(name="Lisa", dad=homer, siblings=[bart])
+    return abe, homer, bart, lisa
+
+
+def test_cache_is_per_instance(simpsons):
+    abe, homer, bart, lisa = simpsons
+    people = {p.name: p for p in Person.list()}
+    assert people["Bart"].dad.id == homer.id
+    assert people["Homer"].dad.id == abe.id
+    assert people["Abe"].dad is None
+
+
+def test_prefetch_many_to_one(simpsons):
+    abe, homer, bart, lisa = simpsons
+    people = Person.list(prefetch=["dad"])
+    red.client.flushdb()
+    # Everything needed was loaded up front
+    assert {p.name: p.dad.name if p.dad else None for p in people} == {
+        "Abe": None,
+        "Homer": "Abe",
+        "Bart": "Homer",
+        "Lisa": "Homer",
+    }
+
+
+def test_prefetch_nested(simpsons):
+    abe, homer, bart, lisa = simpsons
+    [grandpa] = Person.get_bulk({abe.id}, prefetch=["children.children.favourite_color", "children.siblings"])
+    red.client.flushdb()
+    [son] = grandpa.children
+    assert son.id == homer.id
+    assert {c.name: c.favourite_color.name if c.favourite_color else None for c in son.children} == {
+        "Bart": "Blue",
+        "Lisa": None,
+    }
+    assert son.siblings == []
+
+
+def test_prefetch_unknown_relationship(simpsons):
+    with pytest.raises(UnknownFieldName):
+        Person.list(prefetch=["uncle"])
+
+
+def test_assignment_updates_instance_cache(simpsons):
+    abe, homer, bart, lisa = simpsons
+    bart = Person.get(bart.id)
+    assert bart.dad.id == homer.id
+    bart.dad = abe
+    assert bart.dad.id == abe.id
+    assert {c.name for c in Person.get(abe.id).children} == {"Homer", "Bart"}
+
+
+def test_eager_relationships(clean_db):
+    band = Band.create(name="Be Sharps")
+    barney = Musician.create(name="Barney", band=band)
+    loner = Musician.create(name="Loner")
+    assert [m.id for m in Band.get(band.id).members] == [barney.id]
+    assert Musician.get(barney.id).band.id == band.id
+    assert Musician.get(loner.id).band is None
+
+
+def test_delete_removes_relationships(simpsons):
+    abe, homer, bart, lisa = simpsons
+    red_id = homer.favourite_color.id
+    homer.delete()
+    assert not any(homer.id in key for key in red.client.keys("*"))
+    assert Person.get(abe.id).children == []
+    assert Person.get(bart.id).dad is None
+    assert Color.get(red_id).liker is None
+    assert Person.get(lisa.id).siblings[0].id == bart.id
+    with pytest.raises(InstanceNotFound):
+        homer.delete()
+
+
+def test_delete_where(simpsons):
+    abe, homer, bart, lisa = simpsons
+    assert Person.delete_where(batch_size=1, dad=homer) == 2
+    assert {p.name for p in Person.list()} == {"Abe", "Homer"}
+    assert Person.get(homer.id).children == []
+    with pytest.raises(ValueError):
+        Color.delete_where()
+    assert Color.delete_where(all=True) == 2
+    assert Person.get(homer.id).favourite_color is None
+    assert not red.client.keys("Color:*")
+
+
+def test_add_and_remove_related(simpsons):
+    abe, homer, bart, lisa = simpsons
+    maggie = Person.create(name="Maggie")
+    homer.add_related("children", maggie, lisa)
+    assert {c.name for c in Person.get(homer.id).children} == {"Bart", "Lisa", "Maggie"}
+    assert Person.get(maggie.id).dad.id == homer.id
+    homer.remove_related("children", bart.id)
+    assert {c.name for c in Person.get(homer.id).children} == {"Lisa", "Maggie"}
+    assert Person.get(bart.id).dad is None
+    lisa.add_related("siblings", maggie)
+    assert {s.name for s in Person.get(maggie.id).siblings} == {"Lisa"}
+    with pytest.raises(ValueError):
+        bart.add_related("dad", homer)
+
+
+def test_failed_create_writes_no_relationships(simpsons):
+    abe, homer, bart, lisa = simpsons
+    with pytest.raises(UniqueContstraintViolation):
+        Person.create(name="Bart", dad=abe, siblings=[lisa])
+    assert {c.name for c in Person.get(abe.id).children} == {"Homer"}
+    assert [s.name for s in Person.get(lisa.id).siblings] == ["Bart"]
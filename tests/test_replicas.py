@@ -0,0 +1,98 @@
+import asyncio
+from dataclasses import dataclass, field
+import fakeredis
+import pytest
+from redorm import RedormBase, red, red_async, InstanceNotFound
+from redorm.client import fake_server
+
+
+@dataclass
+class Bart(RedormBase):
+    prank: str = field(metadata={"unique": True})
+    victim: str = field(metadata={"index": True})
+
+
+replica_server = fakeredis.FakeServer()
+
+
+def replicate():
+    # Copies the primary's data to the replica, standing in for replication catching up
+    primary = fakeredis.FakeRedis(server=fake_server)
+    replica = fakeredis.FakeRedis(server=replica_server)
+    replica.flushall()
+    for key in primary.keys("*"):
+        replica.restore(key, 0, primary.dump(key), replace=True)
+
+
+@pytest.fixture
+def replicas(clean_db):
+    fakeredis.FakeRedis(server=replica_server).flushall()
+    red.replicas = [fakeredis.FakeRedis(server=replica_server, decode_responses=True)]
+    red_async.replicas = [fakeredis.FakeAsyncRedis(server=replica_server, decode_responses=True)]
+    yield
+    for client in (red, red_async):
+        client.replicas = []
+        for name in ("read_from", "replica_lag", "last_write"):
+            client.__dict__.pop(name, None)
+
+
+def test_reads_go_to_replicas(replicas):
+    prank = Bart.create(prank="Prank call", victim="Moe")
+    # Straight after a write this process reads from the primary
+    assert Bart.get(prank.id) == prank
+    red.replica_lag = 0
+    with pytest.raises(InstanceNotFound):
+        Bart.get(prank.id)
+    assert Bart.list() == []
+    assert Bart.count(victim="Moe") == 0
+    replicate()
+    assert Bart.get(prank="Prank call") == prank
+    assert Bart.query().filter(victim="Moe").ids() == {prank.id}
+
+
+def test_writes_stay_on_primary(replicas):
+    red.replica_lag = 0
+    prank = Bart.create(prank="Cherry bomb", victim="Skinner")
+    replicate()
+    prank.update(victim="Krabappel")
+    assert Bart.get(prank.id).victim == "Skinner"
+    with red.read_from_primary():
+        assert Bart.get(prank.id).victim == "Krabappel"
+    red.read_from = "primary"
+    assert Bart.list(victim="Krabappel") == [prank]
+
+
+def test_async_reads_go_to_replicas(replicas):
+    async def scenario():
+        red_async.replica_lag = 0
+        prank = await Bart.acreate(prank="Radio down the well", victim="Springfield")
+        assert await Bart.acount() == 0
+        replicate()
+        assert await Bart.aget(prank.id) == prank
+        assert await Bart.alist(victim="Springfield") == [prank]
+
+    asyncio.run(scenario())
+
+
+def test_direct_writes_are_marked(replicas):
+    # Flushed by clean_db
+    for client in (red, red_async):
+        client.__dict__.pop("last_write", None)
+    red.client.get("Bart:all")
+    red.client.smembers("Bart:all")
+    # Reads leave the replicas in use, writes from anywhere mark them as behind
+    assert red.last_write == float("-inf")
+    red.pipeline()
+    assert red.last_write == float("-inf")
+    red.client.sadd("Bart:all", "forged")
+    assert red.last_write > float("-inf")
+    assert Bart.count() == 1
+
+    async def scenario():
+        await red_async.client.smembers("Bart:all")
+        assert red_async.last_write == float("-inf")
+        await red_async.client.delete("Bart:all")
+        assert red_async.last_write > float("-inf")
+        assert await Bart.acount() == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,126 @@
+import asyncio
+from dataclasses import dataclass, field
+import pytest
+from redorm import RedormBase, Session, many_to_one, one_to_many, red
+from redorm.exceptions import UniqueContstraintViolation
+from redorm.instrumentation import assert_max_round_trips
+
+
+@dataclass
+class Student(RedormBase):
+    name: str = field(metadata={"unique": True})
+    grade: int = field(metadata={"index": True})
+    teacher = many_to_one("Teacher", backref="students")
+
+
+@dataclass
+class Teacher(RedormBase):
+    name: str
+    students = one_to_many(Student, backref="teacher")
+
+
+@dataclass
+class Janitor(RedormBase):
+    name: str
+    shed: str = field(metadata={"index": True})
+    motto: str = ""
+
+    class Meta:
+        storage = "hash"
+
+
+def test_identity_map(clean_db):
+    bart = Student.create(name="Bart", grade=4)
+    with Session():
+        first = Student.get(bart.id)
+        red.client.flushdb()
+        # Served from the identity map without going to redis
+        assert Student.get(bart.id) is first
+    with Session():
+        lisa = Student.create(name="Lisa", grade=2)
+        assert Student.get(lisa.id) is lisa
+
+
+def test_list_returns_tracked_instances(clean_db):
+    bart = Student.create(name="Bart", grade=4)
+    with Session():
+        got = Student.get(bart.id)
+        assert Student.list(grade=4)[0] is got
+
+
+def test_dirty_instances_flushed_on_exit(clean_db):
+    bart = Student.create(name="Bart", grade=4)
+    with Session():
+        got = Student.get(bart.id)
+        got.grade = 5
+        assert Student.list(grade=5) == []
+    assert Student.get(grade=5).id == bart.id
+    assert Student.list(grade=4) == []
+
+
+def test_projected_instances_stay_projected(clean_db):
+    Janitor.create_bulk([{"name": f"Willie {i}", "shed": "boiler room"} for i in range(20)])
+    # Tracking and flushing only compare the fields that were loaded, without reading the rest
+    with assert_max_round_trips(2):
+        with Session():
+            janitors = Janitor.list(only=["name"])
+    assert len(janitors) == 20
+    with Session():
+        willie = Janitor.list(only=["name"])[0]
+        willie.name = "Groundskeeper Willie"
+    assert Janitor.get(willie.id).name == "Groundskeeper Willie"
+    assert len(Janitor.list(shed="boiler room")) == 20
+
+
+def test_creates_and_relationships_deferred(clean_db):
+    with Session():
+        krabappel = Teacher.create(name="Edna")
+        bart = Student.create(name="Bart", grade=4, teacher=krabappel)
+        assert Student.list() == []
+        # Reads inside the session see the pending state
+        assert bart.teacher is krabappel
+    assert Student.get(name="Bart").teacher.id == krabappel.id
+    assert [s.id for s in Teacher.get(krabappel.id).students] == [bart.id]
+
+
+def test_rollback_on_error(clean_db):
+    with pytest.raises(RuntimeError):
+        with Session():
+            Student.create(name="Bart", grade=4)
+            raise RuntimeError
+    assert Student.list() == []
+
+
+def test_unique_violation_on_commit(clean_db):
+    Student.create(name="Bart", grade=4)
+    with pytest.raises(UniqueContstraintViolation):
+        with Session():
+            Student.create(name="Bart", grade=5)
+            Student.create(name="Milhouse", grade=4)
+    assert len(Student.list(grade=4)) == 2
+
+
+def test_failed_saves_stay_dirty(clean_db):
+    Student.create(name="Bart", grade=4)
+    lisa = Student.create(name="Lisa", grade=2)
+    session = Session()
+    with pytest.raises(UniqueContstraintViolation):
+        with session:
+            tracked = Student.get(lisa.id)
+            tracked.name = "Bart"
+    assert session.dirty() == [tracked]
+    tracked.name = "Maggie"
+    session.commit()
+    assert Student.get(lisa.id).name == "Maggie"
+
+
+def test_async_session(clean_db):
+    async def scenario():
+        bart = await Student.acreate(name="Bart", grade=4)
+        async with Session():
+            got = await Student.aget(bart.id)
+            assert await Student.aget(bart.id) is got
+            await got.aupdate(grade=6)
+        assert (await Student.aget(grade=6)).id == bart.id
+
+    asyncio.run(scenario())